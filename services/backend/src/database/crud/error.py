@@ -2,6 +2,8 @@ from __future__ import annotations
 
 from collections.abc import Iterable
 
+from sqlalchemy import delete
+from sqlalchemy import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from src.database.models import Errors
 from src.utils import ErrorTypeEnum
@@ -48,6 +50,33 @@ def _map_error_type(type_str: str | None) -> ErrorTypeEnum:
     return ErrorTypeEnum.style
 
 
+def error_fields(it: dict) -> dict:
+    """Column values of one worker feedback item."""
+    type_raw = it.get('type') or it.get(
+        'error_type',
+    ) or it.get('errorType') or ''
+
+    original = (
+        it.get('original')
+        or it.get('user_text')
+        or it.get('source')
+        or ''
+    ).strip()
+
+    corrected = (
+        it.get('corrected')
+        or it.get('text_corrected')
+        or ''
+    ).strip()
+
+    return {
+        'type': _map_error_type(type_raw),
+        'subtype': (it.get('subtype') or '').strip(),
+        'original': original,
+        'corrected': corrected,
+    }
+
+
 async def create_errors_bulk(
     session: AsyncSession,
     msg_id: int,
@@ -59,33 +88,7 @@ async def create_errors_bulk(
         if not isinstance(it, dict):
             continue
 
-        type_raw = it.get('type') or it.get(
-            'error_type',
-        ) or it.get('errorType') or ''
-        err_type = _map_error_type(type_raw)
-
-        subtype = (it.get('subtype') or '').strip()
-
-        original = (
-            it.get('original')
-            or it.get('user_text')
-            or it.get('source')
-            or ''
-        ).strip()
-
-        corrected = (
-            it.get('corrected')
-            or it.get('text_corrected')
-            or ''
-        ).strip()
-
-        err = Errors(
-            msg_id=msg_id,
-            type=err_type,
-            subtype=subtype,
-            original=original,
-            corrected=corrected,
-        )
+        err = Errors(msg_id=msg_id, **error_fields(it))
         session.add(err)
         created.append(err)
 
@@ -95,3 +98,28 @@ async def create_errors_bulk(
             await session.refresh(e)
 
     return created
+
+
+async def replace_errors_bulk(
+    session: AsyncSession,
+    items_by_msg: dict[int, list],
+) -> int:
+    """
+    Swap the errors of many messages for new ones with one DELETE and one
+    multi-row INSERT. Returns the number of rows inserted.
+    """
+    if not items_by_msg:
+        return 0
+
+    rows = [
+        {'msg_id': msg_id, **error_fields(it)}
+        for msg_id, items in items_by_msg.items()
+        for it in items
+        if isinstance(it, dict)
+    ]
+    await session.execute(
+        delete(Errors).where(Errors.msg_id.in_(list(items_by_msg))),
+    )
+    if rows:
+        await session.execute(insert(Errors), rows)
+    return len(rows)
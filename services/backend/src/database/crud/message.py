@@ -1,7 +1,11 @@
 from __future__ import annotations
 
+from sqlalchemy import select
+from sqlalchemy import update
 from sqlalchemy.ext.asyncio import AsyncSession
 from src.database.models import Messages
+from src.database.models import Users
+from src.utils import LevelTypeEnum
 
 
 async def create_message(
@@ -23,3 +27,39 @@ async def create_message(
     await session.flush()
     await session.refresh(msg)
     return msg
+
+
+async def get_messages_page(
+    session: AsyncSession,
+    after_id: int,
+    limit: int,
+    until_id: int | None = None,
+) -> list[tuple[int, str, LevelTypeEnum | None]]:
+    """
+    (id, text_original, user level) of the next `limit` messages with an
+    id above `after_id`: keyset pagination, so every page is an index
+    range scan however deep into the table it is.
+    """
+    q = (
+        select(Messages.id, Messages.text_original, Users.level)
+        .join(Users, Users.id == Messages.user_id, isouter=True)
+        .where(Messages.id > after_id)
+        .order_by(Messages.id)
+        .limit(limit)
+    )
+    if until_id is not None:
+        q = q.where(Messages.id <= until_id)
+    res = await session.execute(q)
+    return [tuple(row) for row in res.all()]
+
+
+async def update_feedback_bulk(
+    session: AsyncSession,
+    rows: list[dict],
+) -> None:
+    """
+    Set `text_corrected` and `explanation` of many messages in one
+    executemany; each row holds `id` and the two columns.
+    """
+    if rows:
+        await session.execute(update(Messages), rows)
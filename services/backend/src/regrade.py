@@ -0,0 +1,262 @@
+"""
+Re-grade stored messages after a feedback prompt or model change.
+
+    python -m src.regrade --checkpoint regrade.json --concurrency 4
+
+Messages are read in id order, a page at a time, and each page goes to
+the worker's feedback:batch endpoint in one call. The answers replace
+the message's `text_corrected`, `explanation` and `errors` rows. After
+every finished page its last id is saved to the checkpoint file, so a
+rerun continues where an interrupted one stopped. Rewriting a message
+twice is harmless, so the pages after the checkpoint are simply redone.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from dataclasses import asdict
+from dataclasses import dataclass
+from pathlib import Path
+
+import aiohttp
+from src.database.crud.error import replace_errors_bulk
+from src.database.crud.message import get_messages_page
+from src.database.crud.message import update_feedback_bulk
+from src.database.session import async_session
+from src.routers.messages import WORKER_URL
+from src.utils import feedback_fields
+from src.utils import LevelTypeEnum
+from src.utils import stream_ndjson
+
+
+logger = logging.getLogger(__name__)
+
+# worker answers that mean "later": queue full or over its deadline
+RETRY_STATUSES = (429, 503)
+
+
+@dataclass
+class Checkpoint:
+    last_id: int = 0
+    messages: int = 0
+    errors: int = 0
+    skipped: int = 0
+    failed: int = 0
+
+    @classmethod
+    def load(cls, path: Path) -> Checkpoint:
+        if not path.exists():
+            return cls()
+        return cls(**json.loads(path.read_text(encoding='utf-8')))
+
+    def save(self, path: Path) -> None:
+        # write and rename, so a crash never leaves half a checkpoint
+        tmp = path.with_suffix(path.suffix + '.tmp')
+        tmp.write_text(json.dumps(asdict(self)), encoding='utf-8')
+        os.replace(tmp, path)
+
+
+@dataclass
+class PageResult:
+    last_id: int
+    messages: int = 0
+    errors: int = 0
+    skipped: int = 0
+    failed: int = 0
+
+
+async def _grade(
+    worker_url: str,
+    items: list[dict],
+    timeout_s: float,
+    retries: int,
+) -> list[dict]:
+    for attempt in range(retries + 1):
+        try:
+            return [
+                line async for line in stream_ndjson(
+                    f"{worker_url}/feedback:batch",
+                    {'items': items},
+                    timeout_s=timeout_s,
+                )
+            ]
+        except aiohttp.ClientResponseError as e:
+            if e.status not in RETRY_STATUSES or attempt == retries:
+                raise
+            delay = 2 ** attempt * 5
+            try:
+                delay = float(e.headers['Retry-After'])
+            except (KeyError, TypeError, ValueError):
+                pass
+            logger.warning(
+                f"Worker busy ({e.status}), retrying in {delay}s",
+            )
+            await asyncio.sleep(delay)
+    return []
+
+
+async def regrade_page(
+    rows: list[tuple[int, str, LevelTypeEnum | None]],
+    args: argparse.Namespace,
+) -> PageResult:
+    """Grade one page of messages and write the answers back."""
+    page = PageResult(last_id=rows[-1][0])
+    msg_ids: list[int] = []
+    items: list[dict] = []
+    for msg_id, text, level in rows:
+        if not (text or '').strip():
+            page.skipped += 1
+            continue
+        msg_ids.append(msg_id)
+        items.append({
+            'user_id': 'regrade',
+            'session_id': 'regrade',
+            'message': text,
+            'meta': {
+                'level': (level or LevelTypeEnum.a2).value,
+                'platform': 'telegram',
+            },
+        })
+    if not items:
+        return page
+
+    lines = await _grade(
+        args.worker_url, items, args.timeout_s, args.retries,
+    )
+
+    message_rows: list[dict] = []
+    errors_by_msg: dict[int, list] = {}
+    for line in lines:
+        result = line.get('result') or {}
+        if 'error' in result or (result.get('meta') or {}).get('fallback'):
+            page.failed += 1
+            continue
+        msg_id = msg_ids[line['index']]
+        errors, corrected, explanation = feedback_fields(line)
+        message_rows.append({
+            'id': msg_id,
+            'text_corrected': corrected,
+            'explanation': explanation,
+        })
+        errors_by_msg[msg_id] = errors
+    # a stream cut short leaves the missing messages as they were
+    page.failed += len(items) - len(lines)
+
+    async with async_session() as session:
+        await update_feedback_bulk(session, message_rows)
+        page.errors = await replace_errors_bulk(session, errors_by_msg)
+        await session.commit()
+    page.messages = len(message_rows)
+    return page
+
+
+async def run(args: argparse.Namespace) -> Checkpoint:
+    path = Path(args.checkpoint)
+    ckpt = Checkpoint() if args.restart else Checkpoint.load(path)
+    if args.from_id is not None:
+        ckpt.last_id = max(ckpt.last_id, args.from_id)
+    logger.info(f"Re-grading messages after id {ckpt.last_id}")
+
+    started = time.monotonic()
+    done_before = ckpt.messages
+    # pages in flight, oldest first: the checkpoint only moves past a
+    # page once every page before it is written as well
+    pending: deque[asyncio.Task] = deque()
+
+    async def finish_oldest() -> None:
+        page = await pending.popleft()
+        ckpt.last_id = page.last_id
+        ckpt.messages += page.messages
+        ckpt.errors += page.errors
+        ckpt.skipped += page.skipped
+        ckpt.failed += page.failed
+        ckpt.save(path)
+
+        elapsed = time.monotonic() - started
+        rate = (ckpt.messages - done_before) / elapsed if elapsed else 0.0
+        print(
+            f"last_id={ckpt.last_id} messages={ckpt.messages} "
+            f"errors={ckpt.errors} skipped={ckpt.skipped} "
+            f"failed={ckpt.failed} rate={rate:.1f} msg/s",
+            flush=True,
+        )
+
+    after_id = ckpt.last_id
+    try:
+        while True:
+            async with async_session() as session:
+                rows = await get_messages_page(
+                    session, after_id, args.page_size, args.until_id,
+                )
+            if not rows:
+                break
+            after_id = rows[-1][0]
+            pending.append(asyncio.create_task(regrade_page(rows, args)))
+            while len(pending) >= args.concurrency:
+                await finish_oldest()
+        while pending:
+            await finish_oldest()
+    finally:
+        for task in pending:
+            task.cancel()
+
+    elapsed = time.monotonic() - started
+    print(
+        f"done in {elapsed:.0f}s: {ckpt.messages - done_before} messages "
+        f"re-graded this run, "
+        f"{(ckpt.messages - done_before) / max(elapsed, 1e-9):.1f} msg/s",
+        flush=True,
+    )
+    return ckpt
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='python -m src.regrade',
+        description='Re-grade stored messages with the current worker.',
+    )
+    parser.add_argument('--checkpoint', default='regrade.json')
+    parser.add_argument(
+        '--restart', action='store_true',
+        help='ignore the checkpoint and start from the first message',
+    )
+    parser.add_argument('--from-id', type=int, default=None)
+    parser.add_argument('--until-id', type=int, default=None)
+    parser.add_argument(
+        '--page-size', type=int, default=200,
+        help='messages per worker call (the worker takes at most 1000)',
+    )
+    parser.add_argument(
+        '--concurrency', type=int, default=4,
+        help='pages in flight at once',
+    )
+    parser.add_argument('--worker-url', default=WORKER_URL)
+    parser.add_argument('--timeout-s', type=float, default=3600)
+    parser.add_argument('--retries', type=int, default=5)
+    args = parser.parse_args(argv)
+    if args.page_size < 1 or args.concurrency < 1:
+        parser.error('--page-size and --concurrency must be at least 1')
+    return args
+
+
+def main(argv: list[str] | None = None) -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(levelname)-8s [%(asctime)s] - %(message)s',
+    )
+    args = parse_args(argv)
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        print('interrupted, rerun to continue', file=sys.stderr)
+        sys.exit(130)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ from fastapi import APIRouter
 from fastapi import Depends
 from fastapi import HTTPException
 from fastapi import status
+from fastapi.responses import StreamingResponse
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 from src.database.crud.error import create_errors_bulk
@@ -16,18 +17,113 @@ from src.database.crud.user import get_user_by_id
 from src.database.crud.user import get_user_id_by_id
 from src.database.crud.user import update_user_last_seen
 from src.database.deps import get_session
+from src.database.session import async_session
 from src.routers.users import create_user_endpoint
 from src.schemas.chat import ChatMessage
 from src.schemas.message import MessageCreate
 from src.schemas.message import MessageRead
 from src.schemas.user import UserCreate
+from src.utils import feedback_fields
 from src.utils import post_response
 from src.utils import send_notice
+from src.utils import sse_event
+from src.utils import stream_sse
 
 
 router = APIRouter(prefix='/api/v1/messages', tags=['messages'])
 
 
+WORKER_URL = 'http://ai_worker_api:8002/api/v1/worker'
+
+
+async def _get_history_payload(
+    session: AsyncSession,
+    user_id: int,
+) -> list[dict]:
+    msgs = await get_last_messages_by_user_id(
+        session, user_id,
+        limit=18,
+    )
+
+    msgs.reverse()
+    out: list[ChatMessage] = []
+    for m in msgs:
+        if m.text_original:
+            out.append(ChatMessage(role='user', content=m.text_original))
+        if m.answer:
+            out.append(ChatMessage(role='assistant', content=m.answer))
+    payload = [m.dict() for m in out]
+    if not payload:
+        return payload
+
+    # send only the newest messages that fit the worker's token budget
+    budget = await post_response(
+        url=f"{WORKER_URL}/history/budget",
+        data={'history': payload},
+    )
+    try:
+        keep = int(budget.get('result').get('keep'))
+    except Exception:
+        return payload
+    return payload[len(payload) - keep:]
+
+
+def _reply_payload(
+    user_id: int,
+    text: str,
+    level: str,
+    history_payload: list[dict],
+) -> dict:
+    return {
+        'user_id': str(user_id),
+        'session_id': 'string',
+        'message': f"{text}",
+        'history': history_payload,
+        'meta': {
+            'level': level,
+            'platform': 'telegram',
+        },
+    }
+
+
+async def _save_turn(
+    session: AsyncSession,
+    tg_id: int,
+    user_id: int,
+    text_original: str,
+    reply_text: str,
+    feed_json: dict | None,
+):
+    await update_user_last_seen(session, user_id)
+
+    items, corrected_text, explanation_text = feedback_fields(feed_json)
+
+    msg = await create_message(
+        session,
+        user_id,
+        text_original,
+        corrected_text,
+        explanation_text,
+        reply_text,
+    )
+    logging.getLogger().info(
+        f"Correected text = {corrected_text}, \
+            explanation_text = {explanation_text}",
+    )
+    if items:
+        await create_errors_bulk(session, msg.id, items)
+
+    new_ach_ids = await check_and_award_on_message(session, user_id)
+    if len(new_ach_ids) > 0:
+        await send_notice(
+            tg_id,
+            """🎉 New Achievement Unlocked!
+You’ve just earned a new achievement — great progress!
+Use the /achievements command to see all your achievements.""",
+        )
+    return msg
+
+
 @router.post(
     '', response_model=MessageRead,
     status_code=status.HTTP_201_CREATED,
@@ -42,130 +138,113 @@ async def create_message_endpoint(
             await create_user_endpoint(UserCreate(tg_id=message.tg_id))
             user_id = await get_user_id_by_id(session, message.tg_id)
 
-        msgs = await get_last_messages_by_user_id(
-            session, user_id,
-            limit=18,
-        )
-
-        msgs.reverse()
-        out: list[ChatMessage] = []
-        for m in msgs:
-            if m.text_original:
-                out.append(ChatMessage(role='user', content=m.text_original))
-            if m.answer:
-                out.append(ChatMessage(role='assistant', content=m.answer))
-        history_payload = [m.dict() for m in out]
+        history_payload = await _get_history_payload(session, user_id)
 
         user = await get_user_by_id(session, message.tg_id)
-        reply_json = await post_response(
-            url='http://ai_worker_api:8002/api/v1/worker/reply',
-            data={
-                'user_id': str(user_id),
-                'session_id': 'string',
-                'message': f"{message.text_original}",
-                'history': history_payload,
-                'meta': {
-                    'level': user.level.value,
-                    'platform': 'telegram',
-                },
-            },
-        )
-
-        feed_json = await post_response(
-            url='http://ai_worker_api:8002/api/v1/worker/feedback',
-            data={
-                'user_id': str(user_id),
-                'session_id': 'string',
-                'message': f"{message.text_original}",
-                'meta': {
-                    'level': user.level.value,
-                    'platform': 'telegram',
-                },
-            },
+        # one worker job generates both the reply and the feedback
+        turn_json = await post_response(
+            url=f"{WORKER_URL}/turn",
+            data=_reply_payload(
+                user_id, message.text_original,
+                user.level.value, history_payload,
+            ),
         )
 
         if user_id is None:
             return
 
-        await update_user_last_seen(session, user_id)
-
-        items = []
-        try:
-            items = feed_json.get('result', None).get(
-                'language_feedback', {},
-            ).get('items', [])
-            if items is None:
-                items = []
-        except Exception:
-            items = []
-
-        corrected_text = ''
-        explanation_text = ''
-        if items:
-            for it in items:
-                tc = (
-                    it.get('text_corrected') or it.get(
-                        'corrected',
-                    ) or ''
-                ).strip()
-                if tc:
-                    corrected_text = tc
-                    break
-
-            explanations = []
-            for idx, it in enumerate(items, start=1):
-                field_expl = it.get('explanation') or it.get('message') or ''
-                typ = it.get('type') or ''
-                orig = it.get('original') or it.get('source') or ''
-                corr = it.get('text_corrected') or it.get('corrected') or ''
-                part = f"{idx}. {field_expl}".strip()
-                if not field_expl:
-                    part = f"{idx}. {typ} — original: {
-                        orig
-                    }; corrected: {corr}"
-                explanations.append(part)
-                logging.getLogger(__name__).info('typ')
-            explanation_text = '\n'.join(explanations)
-        else:
-            corrected_text = ''
-            explanation_text = ''
-
         reply_text = ''
         try:
-            reply_text = reply_json.get(
+            reply_text = turn_json.get(
                 'result',
                 None,
             ).get('reply', '') or ''
         except Exception:
             reply_text = ''
 
-        msg = await create_message(
+        return await _save_turn(
             session,
+            message.tg_id,
             user_id,
             message.text_original,
-            corrected_text,
-            explanation_text,
             reply_text,
+            turn_json,
         )
-        logging.getLogger().info(
-            f"Correected text = {corrected_text}, \
-                explanation_text = {explanation_text}",
-        )
-        if items:
-            await create_errors_bulk(session, msg.id, items)
-
-        new_ach_ids = await check_and_award_on_message(session, user_id)
-        if len(new_ach_ids) > 0:
-            await send_notice(
-                message.tg_id,
-                """🎉 New Achievement Unlocked!
-You’ve just earned a new achievement — great progress!
-Use the /achievements command to see all your achievements.""",
-            )
-        return msg
 
     except SQLAlchemyError:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail='Database not available.',
         )
+
+
+@router.post('/stream')
+async def stream_message_endpoint(message: MessageCreate):
+    """
+    Same turn as `create_message_endpoint`, but the reply is relayed
+    chunk by chunk as SSE (`chunk` events) and the saved message is sent
+    as the final `message` event.
+    """
+
+    async def events():
+        # The session lives inside the generator: dependencies with yield
+        # are closed before a StreamingResponse body starts.
+        async with async_session() as session:
+            try:
+                user_id = await get_user_id_by_id(session, message.tg_id)
+                if user_id is None:
+                    await create_user_endpoint(
+                        UserCreate(tg_id=message.tg_id),
+                    )
+                    user_id = await get_user_id_by_id(
+                        session, message.tg_id,
+                    )
+
+                history_payload = await _get_history_payload(
+                    session, user_id,
+                )
+                user = await get_user_by_id(session, message.tg_id)
+
+                # one worker job: the feedback comes with the `done` event
+                reply_text = ''
+                turn_json = None
+                async for event, data in stream_sse(
+                    url=f"{WORKER_URL}/turn/stream",
+                    data=_reply_payload(
+                        user_id, message.text_original,
+                        user.level.value, history_payload,
+                    ),
+                ):
+                    if event == 'chunk':
+                        yield sse_event('chunk', data)
+                    elif event == 'done':
+                        reply_text = data.get('reply', '') or ''
+                        turn_json = {'result': data}
+                    elif event == 'error':
+                        logging.getLogger(__name__).error(
+                            f"Turn stream error: {data.get('detail')}",
+                        )
+
+                msg = await _save_turn(
+                    session,
+                    message.tg_id,
+                    user_id,
+                    message.text_original,
+                    reply_text,
+                    turn_json,
+                )
+                await session.commit()
+
+                yield sse_event(
+                    'message',
+                    MessageRead.model_validate(msg).model_dump(mode='json'),
+                )
+
+            except SQLAlchemyError:
+                await session.rollback()
+                logging.getLogger(__name__).exception(
+                    'Database error while streaming message',
+                )
+                yield sse_event('error', {'detail': 'Database not available.'})
+
+    return StreamingResponse(events(), media_type='text/event-stream')
@@ -2,7 +2,9 @@ from __future__ import annotations
 
 import asyncio
 import enum
+import json
 import logging
+from collections.abc import AsyncIterator
 
 import aiohttp
 from src.settings import get_bot_settings
@@ -109,3 +111,103 @@ async def get_response(url: str) -> None | dict:
         logging.getLogger(__name__).error('Unknow error.')
 
     return None
+
+
+def feedback_fields(feed_json: dict | None) -> tuple[list, str, str]:
+    items = []
+    try:
+        items = feed_json.get('result', None).get(
+            'language_feedback', {},
+        ).get('items', [])
+        if items is None:
+            items = []
+    except Exception:
+        items = []
+
+    corrected_text = ''
+    explanation_text = ''
+    if items:
+        for it in items:
+            tc = (
+                it.get('text_corrected') or it.get(
+                    'corrected',
+                ) or ''
+            ).strip()
+            if tc:
+                corrected_text = tc
+                break
+
+        explanations = []
+        for idx, it in enumerate(items, start=1):
+            field_expl = it.get('explanation') or it.get('message') or ''
+            typ = it.get('type') or ''
+            orig = it.get('original') or it.get('source') or ''
+            corr = it.get('text_corrected') or it.get('corrected') or ''
+            part = f"{idx}. {field_expl}".strip()
+            if not field_expl:
+                part = f"{idx}. {typ} — original: {
+                    orig
+                }; corrected: {corr}"
+            explanations.append(part)
+            logging.getLogger(__name__).info('typ')
+        explanation_text = '\n'.join(explanations)
+    else:
+        corrected_text = ''
+        explanation_text = ''
+
+    return items, corrected_text, explanation_text
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def stream_sse(url: str, data: dict) -> AsyncIterator[tuple[str, dict]]:
+    """POST `data` and yield (event, data) pairs of the SSE response."""
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(
+                url,
+                json=data,
+                timeout=200,
+            ) as resp:
+
+                if resp.status < 200 or resp.status >= 300:
+                    logging.getLogger(__name__).error(
+                        f'Responce error. Status: {resp.status}',
+                    )
+                    return
+
+                event = 'message'
+                async for raw in resp.content:
+                    line = raw.decode('utf-8').rstrip('\r\n')
+                    if line.startswith('event:'):
+                        event = line[len('event:'):].strip()
+                    elif line.startswith('data:'):
+                        yield event, json.loads(line[len('data:'):].strip())
+                    elif not line:
+                        event = 'message'
+
+    except aiohttp.ClientError:
+        logging.getLogger(__name__).error('Server error.')
+    except asyncio.TimeoutError:
+        logging.getLogger(__name__).error('Timeout error.')
+
+
+async def stream_ndjson(
+    url: str,
+    data: dict,
+    timeout_s: float = 3600,
+) -> AsyncIterator[dict]:
+    """POST `data` and yield the lines of an NDJSON response."""
+    async with aiohttp.ClientSession() as session:
+        async with session.post(
+            url,
+            json=data,
+            timeout=aiohttp.ClientTimeout(total=timeout_s),
+        ) as resp:
+            resp.raise_for_status()
+            async for raw in resp.content:
+                line = raw.decode('utf-8').strip()
+                if line:
+                    yield json.loads(line)
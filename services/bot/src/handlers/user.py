@@ -1,6 +1,8 @@
 from __future__ import annotations
 
+import html
 import logging
+import time
 from datetime import datetime
 
 from aiogram import F
@@ -18,10 +20,13 @@ from utils import format_daily_stats
 from utils import format_leaderboard
 from utils import get_response
 from utils import post_response
+from utils import stream_response
 
 
 router = Router()
 
+STREAM_EDIT_INTERVAL_S = 1.5
+
 
 @router.message(CommandStart())
 async def start_cmd(msg: Message):
@@ -120,16 +125,39 @@ I'm always here to help — just send a message!
 
 @router.message(F.text & ~F.text.startswith('/'))
 async def message(msg: Message):
-    res = await post_response(
-        url='http://backend:8000/api/v1/messages',
+    reply = await msg.reply('✍️ ...')
+
+    answer = ''
+    last_edit = time.monotonic()
+    res = None
+    async for event, data in stream_response(
+        url='http://backend:8000/api/v1/messages/stream',
         data={
             'tg_id': msg.from_user.id,
             'text_original': msg.text,
         },
         msg=msg,
-    )
+    ):
+        if event == 'chunk':
+            answer += data.get('text', '')
+            # Telegram rate-limits edits, so partial text is throttled
+            if time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL_S:
+                last_edit = time.monotonic()
+                try:
+                    await reply.edit_text(
+                        f"<b>Answer:</b>\n{html.escape(answer)} ...",
+                    )
+                except TelegramBadRequest:
+                    pass
+        elif event == 'message':
+            res = data
+        elif event == 'error':
+            logging.getLogger(__name__).error(
+                f"Message stream error: {data.get('detail')}",
+            )
 
     if res is None:
+        await reply.delete()
         return
 
     text_parts = []
@@ -150,7 +178,7 @@ async def message(msg: Message):
     if text == '':
         text = 'An error occurred, please try again later.  '
 
-    await msg.reply(text, reply_markup=rate_beyboard)
+    await reply.edit_text(text, reply_markup=rate_beyboard)
 
 
 @router.message(Command('achievements'))
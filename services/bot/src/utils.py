@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 import asyncio
+import json
 import logging
+from collections.abc import AsyncIterator
 from datetime import datetime
 
 import aiohttp
@@ -40,6 +42,57 @@ async def post_response(url: str, data: dict, msg: Message) -> None | dict:
     return None
 
 
+async def stream_response(
+    url: str,
+    data: dict,
+    msg: Message,
+) -> AsyncIterator[tuple[str, dict]]:
+    """POST `data` and yield (event, data) pairs of the SSE response.
+
+    The user gets the error reply when the stream ends without a
+    `message` event, e.g. after an `error` event.
+    """
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(
+                url,
+                json=data,
+                timeout=100,
+            ) as resp:
+
+                if resp.status < 200 or resp.status >= 300:
+                    await send_error_msg(msg)
+                    logging.getLogger(__name__).error(
+                        f'Responce error. Status: {resp.status}',
+                    )
+                    return
+
+                event = 'message'
+                answered = False
+                async for raw in resp.content:
+                    line = raw.decode('utf-8').rstrip('\r\n')
+                    if line.startswith('event:'):
+                        event = line[len('event:'):].strip()
+                    elif line.startswith('data:'):
+                        answered = answered or event == 'message'
+                        yield event, json.loads(line[len('data:'):].strip())
+                    elif not line:
+                        event = 'message'
+
+                if not answered:
+                    await send_error_msg(msg)
+                    logging.getLogger(__name__).error(
+                        'Stream ended without a message.',
+                    )
+
+    except aiohttp.ClientError:
+        await send_error_msg(msg)
+        logging.getLogger(__name__).error('Server error.')
+    except asyncio.TimeoutError:
+        await send_error_msg(msg)
+        logging.getLogger(__name__).error('Timeout error.')
+
+
 async def send_error_msg(msg: Message) -> None:
     await msg.answer(
         '''
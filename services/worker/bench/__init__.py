@@ -0,0 +1,6 @@
+"""
+CPU benchmark of the worker on a tiny random-weight model.
+
+    python -m bench run --out bench-report.json
+    python -m bench compare base.json bench-report.json
+"""
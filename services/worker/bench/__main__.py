@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import sys
+
+# the suite measures the CPU path; hide GPUs before torch is imported
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+
+from bench.report import compare  # noqa: E402
+from bench.report import format_deltas  # noqa: E402
+from bench.report import load_report  # noqa: E402
+from bench.report import write_report  # noqa: E402
+from src.logging_config import setup_logging  # noqa: E402
+
+logger = logging.getLogger('ai_worker.bench')
+
+
+def _overrides(pairs: list[str]) -> dict[str, str]:
+    out = {}
+    for pair in pairs:
+        key, sep, value = pair.partition('=')
+        if not sep:
+            raise SystemExit(f"--set expects KEY=VALUE, got {pair!r}")
+        out[key] = value
+    return out
+
+
+def cmd_run(args: argparse.Namespace) -> int:
+    from bench.suite import run_suite
+    from bench.suite import SCENARIOS
+    from bench.tiny_model import build_tiny_model
+    from src.settings import get_settings
+
+    base = args.base_model or get_settings().MODEL_ID
+    model_dir = args.model_dir or build_tiny_model(base, seed=args.seed)
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"unknown scenarios: {sorted(unknown)}")
+
+    report = run_suite(
+        model_dir=model_dir,
+        base_model_id=base,
+        scenarios=args.scenarios,
+        requests=args.requests,
+        concurrency=args.concurrency,
+        warmup=args.warmup,
+        seed=args.seed,
+        overrides=_overrides(args.set),
+    )
+    write_report(report, args.out)
+    logger.info('bench: report written | path=%s', args.out)
+
+    if args.baseline:
+        return _compare(load_report(args.baseline), report, args.threshold)
+    return 0
+
+
+def _compare(base: dict, new: dict, threshold: float) -> int:
+    deltas = compare(base, new, threshold=threshold)
+    print(
+        f"base {base.get('git_commit')} -> new {new.get('git_commit')} "
+        f"(threshold {threshold:.0%})",
+    )
+    print(format_deltas(deltas))
+    regressions = [d for d in deltas if d.regressed]
+    if regressions:
+        print(f"{len(regressions)} regression(s)")
+        return 1
+    return 0
+
+
+def cmd_compare(args: argparse.Namespace) -> int:
+    return _compare(
+        load_report(args.base), load_report(args.new), args.threshold,
+    )
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m bench')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', help='run the suite and write a report')
+    run.add_argument('--out', default='bench-report.json')
+    run.add_argument(
+        '--base-model',
+        help='model whose architecture and tokenizer are used '
+        '(default: MODEL_ID)',
+    )
+    run.add_argument(
+        '--model-dir', help='use this model instead of building one',
+    )
+    run.add_argument(
+        '--scenarios', nargs='+',
+        default=[
+            'service_reply', 'service_feedback',
+            'task_reply', 'task_feedback', 'task_turn',
+        ],
+    )
+    run.add_argument('--requests', type=int, default=32)
+    run.add_argument('--concurrency', type=int, default=4)
+    run.add_argument('--warmup', type=int, default=2)
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument(
+        '--set', action='append', default=[], metavar='KEY=VALUE',
+        help='worker setting override, e.g. --set BATCH_MAX_SIZE=1',
+    )
+    run.add_argument('--baseline', help='report to compare against')
+    run.add_argument('--threshold', type=float, default=0.10)
+    run.set_defaults(func=cmd_run)
+
+    cmp_ = sub.add_parser('compare', help='compare two reports')
+    cmp_.add_argument('base')
+    cmp_.add_argument('new')
+    cmp_.add_argument('--threshold', type=float, default=0.10)
+    cmp_.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args(argv)
+    setup_logging(os.environ.get('LOG_LEVEL', 'WARNING'))
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+
+# (path inside a scenario, True when a larger value is worse)
+COMPARED = (
+    (('latency_ms', 'p50'), True),
+    (('latency_ms', 'p95'), True),
+    (('latency_ms', 'p99'), True),
+    (('tokens_per_s',), False),
+    (('peak_rss_mb',), True),
+)
+
+
+@dataclass
+class Delta:
+    scenario: str
+    metric: str
+    base: float
+    new: float
+    change: float
+    regressed: bool
+
+
+def load_report(path: str) -> dict:
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_report(report: dict, path: str) -> None:
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+
+
+def _get(row: dict, path: tuple[str, ...]) -> float | None:
+    for part in path:
+        if not isinstance(row, dict) or part not in row:
+            return None
+        row = row[part]
+    return float(row)
+
+
+def compare(base: dict, new: dict, *, threshold: float) -> list[Delta]:
+    """
+    Metric by metric deltas of the scenarios both reports ran. A change
+    in the bad direction by more than `threshold` (0.1 = 10%) is a
+    regression.
+    """
+    deltas = []
+    for name, new_row in new.get('scenarios', {}).items():
+        base_row = base.get('scenarios', {}).get(name)
+        if base_row is None:
+            continue
+        for path, higher_is_worse in COMPARED:
+            b, n = _get(base_row, path), _get(new_row, path)
+            if b is None or n is None:
+                continue
+            change = (n - b) / b if b else 0.0
+            worse = change if higher_is_worse else -change
+            deltas.append(
+                Delta(
+                    scenario=name,
+                    metric='.'.join(path),
+                    base=b,
+                    new=n,
+                    change=change,
+                    regressed=worse > threshold,
+                ),
+            )
+    return deltas
+
+
+def format_deltas(deltas: list[Delta]) -> str:
+    lines = [
+        f"{'scenario':<18} {'metric':<16} {'base':>10} {'new':>10} "
+        f"{'change':>8}",
+    ]
+    for d in deltas:
+        flag = '  REGRESSION' if d.regressed else ''
+        lines.append(
+            f"{d.scenario:<18} {d.metric:<16} {d.base:>10.1f} "
+            f"{d.new:>10.1f} {d.change:>+8.1%}{flag}",
+        )
+    return '\n'.join(lines)
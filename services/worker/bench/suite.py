@@ -0,0 +1,262 @@
+from __future__ import annotations
+
+import logging
+import os
+import platform
+import resource
+import subprocess
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timezone
+
+import torch
+from bench.workload import BenchCase
+from bench.workload import make_workload
+from src import tasks
+from src.schemas import ChatMessage
+from src.schemas import FeedbackRequest
+from src.schemas import Meta
+from src.schemas import ReplyRequest
+from src.settings import get_settings
+from src.settings import Settings
+from src.token_budget import get_token_counter
+
+logger = logging.getLogger('ai_worker.bench')
+
+# applied unless overridden with --set; short outputs keep a CPU run quick
+BENCH_ENV = {
+    'ENGINE': 'hf',
+    'LOAD_IN_4BIT': 'false',
+    'MAX_NEW_TOKENS_REPLY': '48',
+    'MAX_NEW_TOKENS_FEEDBACK': '96',
+    'DRAFT_MODEL_ID': '',
+    'MODEL_ROUTES': '{}',
+}
+
+REPORTED_SETTINGS = (
+    'ENGINE', 'MODEL_ID', 'BATCH_MAX_SIZE', 'MAX_NEW_TOKENS_REPLY',
+    'MAX_NEW_TOKENS_FEEDBACK', 'PREFIX_CACHE_MAX_MB',
+    'SESSION_CACHE_MAX_TOKENS', 'FEEDBACK_CONSTRAINED', 'DRAFT_MODEL_ID',
+)
+
+
+def configure(model_dir: str, overrides: dict[str, str]) -> Settings:
+    """Point the worker's settings at the bench model and reset caches."""
+    os.environ.update({**BENCH_ENV, 'MODEL_ID': model_dir, **overrides})
+    get_settings.cache_clear()
+    tasks.get_service.cache_clear()
+    get_token_counter.cache_clear()
+    return get_settings()
+
+
+def _meta(level: str) -> Meta:
+    return Meta(level=level, platform='telegram')
+
+
+def _service_reply(case: BenchCase, i: int) -> dict:
+    resp = tasks.get_service().make_reply(
+        ReplyRequest(
+            user_id='bench',
+            session_id=f"s{i}",
+            message=case.message,
+            history=[ChatMessage(**m) for m in case.history_dicts()],
+            meta=_meta(case.level),
+        ),
+    )
+    return resp.meta or {}
+
+
+def _service_feedback(case: BenchCase, i: int) -> dict:
+    resp = tasks.get_service().make_feedback(
+        FeedbackRequest(
+            user_id='bench',
+            session_id=f"s{i}",
+            message=case.message,
+            meta=_meta(case.level),
+        ),
+    )
+    return resp.meta or {}
+
+
+def _task_result(result: dict) -> dict:
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    return result.get('meta') or {}
+
+
+def _task_reply(case: BenchCase, i: int) -> dict:
+    return _task_result(
+        tasks.task_reply(
+            case.level, case.history_dicts(), case.message,
+            user_id='bench', session_id=f"s{i}",
+        ),
+    )
+
+
+def _task_feedback(case: BenchCase, i: int) -> dict:
+    return _task_result(tasks.task_feedback(case.level, case.message))
+
+
+def _task_turn(case: BenchCase, i: int) -> dict:
+    meta = _task_result(
+        tasks.task_turn(
+            case.level, case.history_dicts(), case.message,
+            user_id='bench', session_id=f"s{i}",
+        ),
+    )
+    reply, feedback = meta.get('reply') or {}, meta.get('feedback') or {}
+    return {
+        'new_tokens': (
+            reply.get('new_tokens', 0) + feedback.get('new_tokens', 0)
+        ),
+        'tokens_per_s': reply.get('tokens_per_s'),
+    }
+
+
+SCENARIOS: dict[str, Callable[[BenchCase, int], dict]] = {
+    'service_reply': _service_reply,
+    'service_feedback': _service_feedback,
+    'task_reply': _task_reply,
+    'task_feedback': _task_feedback,
+    'task_turn': _task_turn,
+}
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Linear-interpolated percentile, `q` in [0, 100]."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def run_scenario(
+        name: str,
+        cases: list[BenchCase],
+        *,
+        concurrency: int,
+        warmup: int,
+) -> dict:
+    fn = SCENARIOS[name]
+    for i, case in enumerate(cases[:warmup]):
+        fn(case, -1 - i)
+
+    latencies: list[float] = []
+    rates: list[float] = []
+    new_tokens = 0
+    errors = 0
+    lock = threading.Lock()
+
+    def one(args: tuple[int, BenchCase]) -> None:
+        nonlocal new_tokens, errors
+        i, case = args
+        t0 = time.perf_counter()
+        try:
+            meta = fn(case, i)
+        except Exception as e:
+            logger.warning('bench: call failed | scenario=%s err=%s', name, e)
+            with lock:
+                errors += 1
+            return
+        with lock:
+            latencies.append((time.perf_counter() - t0) * 1000)
+            new_tokens += int(meta.get('new_tokens') or 0)
+            if meta.get('tokens_per_s'):
+                rates.append(float(meta['tokens_per_s']))
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        list(pool.map(one, enumerate(cases)))
+    wall_s = time.perf_counter() - t0
+
+    result = {
+        'requests': len(cases),
+        'concurrency': concurrency,
+        'errors': errors,
+        'wall_s': round(wall_s, 3),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 1),
+            'p95': round(percentile(latencies, 95), 1),
+            'p99': round(percentile(latencies, 99), 1),
+            'mean': round(sum(latencies) / max(1, len(latencies)), 1),
+        },
+        'new_tokens': new_tokens,
+        'tokens_per_s': round(new_tokens / wall_s, 1) if wall_s else 0.0,
+        'decode_tokens_per_s_p50': round(percentile(rates, 50), 1),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    logger.info(
+        'bench: scenario done | name=%s p50_ms=%s p95_ms=%s '
+        'tokens_per_s=%s errors=%s',
+        name,
+        result['latency_ms']['p50'],
+        result['latency_ms']['p95'],
+        result['tokens_per_s'],
+        errors,
+    )
+    return result
+
+
+def _git_commit() -> str | None:
+    try:
+        out = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, timeout=5, check=True,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def run_suite(
+        *,
+        model_dir: str,
+        base_model_id: str,
+        scenarios: list[str],
+        requests: int,
+        concurrency: int,
+        warmup: int,
+        seed: int,
+        overrides: dict[str, str],
+) -> dict:
+    settings = configure(model_dir, overrides)
+    torch.manual_seed(seed)
+
+    t0 = time.perf_counter()
+    tasks.get_service()
+    load_s = time.perf_counter() - t0
+
+    cases = make_workload(requests, seed=seed)
+    results = {
+        name: run_scenario(
+            name, cases, concurrency=concurrency, warmup=warmup,
+        )
+        for name in scenarios
+    }
+
+    return {
+        'version': 1,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'git_commit': _git_commit(),
+        'base_model': base_model_id,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'cpu_count': os.cpu_count(),
+        'torch_threads': torch.get_num_threads(),
+        'settings': {k: getattr(settings, k) for k in REPORTED_SETTINGS},
+        'seed': seed,
+        'load_s': round(load_s, 2),
+        'scenarios': results,
+        'peak_rss_mb': peak_rss_mb(),
+    }
@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import tempfile
+
+import torch
+from transformers import AutoConfig
+from transformers import AutoModelForCausalLM
+from transformers import AutoTokenizer
+
+logger = logging.getLogger('ai_worker.bench')
+
+TINY_SHAPE = {
+    'hidden_size': 64,
+    'intermediate_size': 128,
+    'num_hidden_layers': 2,
+    'num_attention_heads': 4,
+    'num_key_value_heads': 2,
+}
+
+
+def build_tiny_model(
+        base_model_id: str,
+        *,
+        out_dir: str | None = None,
+        seed: int = 0,
+) -> str:
+    """
+    Save a randomly initialized model with the architecture and tokenizer
+    of `base_model_id`, shrunk to `TINY_SHAPE`, and return its directory.
+    Only the config and tokenizer of the base model are downloaded.
+    """
+    if out_dir is None:
+        slug = hashlib.sha1(
+            f"{base_model_id}:{sorted(TINY_SHAPE.items())}:{seed}".encode(),
+        ).hexdigest()[:12]
+        out_dir = os.path.join(
+            tempfile.gettempdir(), 'engelina-bench', slug,
+        )
+    if os.path.exists(os.path.join(out_dir, 'config.json')):
+        logger.info('bench: tiny model cached | dir=%s', out_dir)
+        return out_dir
+
+    logger.info('bench: building tiny model | base=%s', base_model_id)
+    config = AutoConfig.from_pretrained(base_model_id)
+    for name, value in TINY_SHAPE.items():
+        setattr(config, name, value)
+    if getattr(config, 'head_dim', None):
+        config.head_dim = (
+            TINY_SHAPE['hidden_size'] // TINY_SHAPE['num_attention_heads']
+        )
+
+    torch.manual_seed(seed)
+    model = AutoModelForCausalLM.from_config(config, torch_dtype=torch.float32)
+    tokenizer = AutoTokenizer.from_pretrained(base_model_id)
+
+    os.makedirs(out_dir, exist_ok=True)
+    model.save_pretrained(out_dir)
+    tokenizer.save_pretrained(out_dir)
+    logger.info(
+        'bench: tiny model saved | dir=%s params=%s',
+        out_dir,
+        sum(p.numel() for p in model.parameters()),
+    )
+    return out_dir
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import random
+from dataclasses import dataclass
+
+LEVELS = ('A1', 'A2', 'A2', 'B1', 'B1', 'B2', 'C1')
+
+# learner sentences with the kind of mistakes the bot sees every day
+LEARNER_MESSAGES = (
+    'hello how are you',
+    'i goes to school every day',
+    'yesterday I have been to the cinema with my friends',
+    'My sister like to play piano but she dont practise',
+    'I am agree with you',
+    'what do you doing at the weekend?',
+    'I want learn english because it is important for my work',
+    'We was in London last summer and it were very rainy',
+    'Can you explain me the difference between make and do',
+    'i think that the films in english is more interesting than in russian '
+    'because the actors voices sounds more natural',
+    'My favourite food is pizza.',
+    'I have 25 years and I work like a programmer in a big company',
+    'When I was child I lived in small village near the river and every '
+    'summer we was swimming and fishing with my grandfather',
+    'ok',
+    'Do you know some good books for beginners?',
+)
+
+ASSISTANT_MESSAGES = (
+    'That sounds great! What did you like most about it?',
+    'Nice! Tell me more about your job. What do you do every day?',
+    'I see. Many people find English films easier with subtitles at '
+    'first. Do you watch them with subtitles?',
+    'Good question! We usually "make" things and "do" activities or '
+    'tasks. For example, make a cake, do homework. Can you try a sentence?',
+    'Interesting! How long have you been learning English?',
+)
+
+
+@dataclass(frozen=True)
+class BenchCase:
+    level: str
+    message: str
+    history: tuple[tuple[str, str], ...]
+
+    def history_dicts(self) -> list[dict[str, str]]:
+        return [{'role': r, 'content': c} for r, c in self.history]
+
+
+def make_workload(n: int, *, seed: int = 0) -> list[BenchCase]:
+    """
+    `n` deterministic cases: short and long learner messages over
+    conversations from fresh (no history) to long (16 messages), with
+    most of them a few turns in.
+    """
+    rng = random.Random(seed)
+    cases = []
+    for _ in range(n):
+        turns = min(8, int(rng.expovariate(1 / 3)))
+        history: list[tuple[str, str]] = []
+        for _ in range(turns):
+            history.append(('user', rng.choice(LEARNER_MESSAGES)))
+            history.append(('assistant', rng.choice(ASSISTANT_MESSAGES)))
+        cases.append(
+            BenchCase(
+                level=rng.choice(LEVELS),
+                message=rng.choice(LEARNER_MESSAGES),
+                history=tuple(history),
+            ),
+        )
+    return cases
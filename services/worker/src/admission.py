@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import logging
+import math
+from dataclasses import dataclass
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from rq import Queue
+from src.queue import PRIORITIES
+from src.queue import priority_deadline_s
+from src.queue import queue_name
+from src.settings import Settings
+
+logger = logging.getLogger('ai_worker.admission')
+
+SERVICE_TIME_PREFIX = 'ai_worker:service_s:'
+RQ_WORKERS_KEY = 'rq:workers'
+
+
+def service_time_key(priority: str) -> str:
+    return f"{SERVICE_TIME_PREFIX}{priority}"
+
+
+def record_service_time(
+        redis: Redis,
+        priority: str,
+        seconds: float,
+        *,
+        window: int,
+) -> None:
+    """Keep the run times of the last `window` jobs of a priority."""
+    key = service_time_key(priority)
+    pipe = redis.pipeline(transaction=False)
+    pipe.lpush(key, round(seconds, 3))
+    pipe.ltrim(key, 0, max(1, window) - 1)
+    pipe.execute()
+
+
+def estimate_load(rows: list, n_workers: int, settings: Settings) -> dict:
+    """
+    Per-priority depth, mean run time and estimated wait from the
+    (queue length, run times) pairs of `PRIORITIES`, flattened.
+
+    Runners drain the priority queues strictly in order, so a job waits
+    for everything queued at its own and all higher priorities. That
+    backlog is spread over the live runner threads at the rolling mean
+    run time of the jobs in front.
+    """
+    workers = max(1, int(n_workers))
+    queues: dict[str, dict] = {}
+    backlog_s = 0.0
+    for i, p in enumerate(PRIORITIES):
+        depth = int(rows[2 * i])
+        samples = [float(x) for x in rows[2 * i + 1]]
+        service_s = (
+            sum(samples) / len(samples) if samples
+            else settings.ADMISSION_DEFAULT_SERVICE_S
+        )
+        backlog_s += depth * service_s
+        queues[p] = {
+            'depth': depth,
+            'service_s': round(service_s, 2),
+            'est_wait_s': round(backlog_s / workers, 2),
+        }
+    return {'workers': int(n_workers), 'queues': queues}
+
+
+def load_snapshot(redis: Redis, settings: Settings) -> dict:
+    """`AdmissionController.snapshot` for the synchronous runner side."""
+    pipe = redis.pipeline(transaction=False)
+    for p in PRIORITIES:
+        pipe.llen(Queue(queue_name(settings, p), connection=redis).key)
+        pipe.lrange(service_time_key(p), 0, -1)
+    pipe.scard(RQ_WORKERS_KEY)
+    *rows, n_workers = pipe.execute()
+    return estimate_load(rows, n_workers, settings)
+
+
+@dataclass
+class Decision:
+    admitted: bool
+    status_code: int = 200
+    retry_after_s: int = 0
+    detail: str = ''
+
+
+class AdmissionController:
+    """
+    Estimates how long a new job would wait (see `estimate_load`) and
+    turns work away early.
+    """
+
+    def __init__(
+            self,
+            redis: AsyncRedis,
+            queues: dict[str, Queue],
+            settings: Settings,
+    ):
+        self.redis = redis
+        self.queues = queues
+        self.settings = settings
+
+    async def snapshot(self) -> dict:
+        pipe = self.redis.pipeline(transaction=False)
+        for p in PRIORITIES:
+            pipe.llen(self.queues[p].key)
+            pipe.lrange(service_time_key(p), 0, -1)
+        pipe.scard(RQ_WORKERS_KEY)
+        *rows, n_workers = await pipe.execute()
+        return estimate_load(rows, n_workers, self.settings)
+
+    async def check(
+            self,
+            priority: str,
+            budget_s: float | None = None,
+    ) -> tuple[Decision, dict]:
+        """
+        Admit unless the queue is over its hard depth limit (429) or the
+        estimated wait plus one run time overshoots the caller's budget
+        (503). The budget defaults to the priority's deadline.
+        """
+        try:
+            snap = await self.snapshot()
+        except Exception as e:
+            logger.warning('admission: snapshot failed, admit | err=%s', e)
+            return Decision(admitted=True), {}
+
+        row = snap['queues'][priority]
+        if budget_s is None:
+            budget_s = priority_deadline_s(self.settings, priority)
+        est_total_s = row['est_wait_s'] + row['service_s']
+
+        max_depth = self.settings.ADMISSION_MAX_QUEUE_DEPTH
+        if max_depth and row['depth'] >= max_depth:
+            decision = Decision(
+                admitted=False,
+                status_code=429,
+                retry_after_s=max(1, math.ceil(row['est_wait_s'])),
+                detail=f"{priority} queue is full ({row['depth']} jobs)",
+            )
+        elif est_total_s > budget_s:
+            decision = Decision(
+                admitted=False,
+                status_code=503,
+                retry_after_s=max(1, math.ceil(est_total_s - budget_s)),
+                detail=(
+                    f"estimated time to answer {est_total_s:.0f}s exceeds "
+                    f"the budget of {budget_s:.0f}s"
+                ),
+            )
+        else:
+            decision = Decision(admitted=True)
+
+        if not decision.admitted:
+            logger.warning(
+                'admission: rejected | priority=%s status=%s depth=%s '
+                'est_wait_s=%s budget_s=%s',
+                priority,
+                decision.status_code,
+                row['depth'],
+                row['est_wait_s'],
+                budget_s,
+            )
+        return decision, row
@@ -1,17 +1,61 @@
 from __future__ import annotations
 
+import asyncio
+import json
 import logging
 import uuid
+from functools import partial
 
+import anyio
 from fastapi import FastAPI
 from fastapi import HTTPException
 from fastapi import Request
+from fastapi.responses import PlainTextResponse
+from fastapi.responses import StreamingResponse
+from src.admission import AdmissionController
+from src.budget import budget_stats
+from src.cancel import cancel_stats
+from src.cancel import request_cancel
+from src.cancel import request_cancel_many
+from src.coalesce import coalesce_stats
+from src.coalesce import Coalescer
+from src.coalesce import fingerprint
+from src.coalesce import inflight_key
+from src.coalesce import leave_job
+from src.feedback_cache import FEEDBACK_CACHE_STATS
+from src.feedback_cache import FeedbackCache
 from src.logging_config import setup_logging
-from src.queue import get_queue
+from src.jobs import JOB_ENDED
+from src.jobs import job_statuses
+from src.jobs import wait_any
+from src.metrics import render_counters
+from src.metrics import render_histograms
+from src.notify import JobNotifier
+from src.notify import publish_done
+from src.precheck import precheck_meta
+from src.precheck import precheck_stats
+from src.precheck import record_precheck_async
+from src.precheck import run_precheck
+from src.queue import enqueue_job
+from src.queue import get_async_redis
+from src.queue import get_queues
 from src.queue import get_redis
+from src.queue import priority_deadline_s
+from src.readiness import ReadinessGate
+from src.registry import route_model_id
+from src.schemas import FeedbackBatchRequest
 from src.schemas import FeedbackRequest
+from src.schemas import HistoryBudgetRequest
+from src.schemas import HistoryBudgetResponse
+from src.schemas import JobStatusRequest
+from src.schemas import JobSubmitRequest
 from src.schemas import ReplyRequest
 from src.settings import get_settings
+from src.token_budget import fit_history
+from src.token_budget import get_token_counter
+from src.utils import ClientDisconnected
+from src.utils import iter_job_stream
+from src.utils import wait_job_or_cancel
 from src.utils import wait_job_result
 
 logger = logging.getLogger('ai_worker.api')
@@ -49,31 +93,247 @@ def create_app() -> FastAPI:
         return response
 
     @app.on_event('startup')
-    def startup() -> None:
+    async def startup() -> None:
         settings = get_settings()
         setup_logging(settings.LOG_LEVEL)
 
         app.state.settings = settings
         app.state.redis = get_redis(settings)
-        app.state.queue = get_queue(settings)
+        app.state.aredis = get_async_redis(settings)
+        app.state.queues = get_queues(settings)
+        app.state.admission = AdmissionController(
+            app.state.aredis, app.state.queues, settings,
+        )
+        app.state.notifier = JobNotifier(app.state.aredis)
+        app.state.coalescer = Coalescer(
+            app.state.aredis,
+            enabled=settings.COALESCE_ENABLED,
+            ttl_s=settings.COALESCE_TTL_S,
+        )
+        app.state.readiness = ReadinessGate(
+            app.state.aredis, required=settings.READINESS_REQUIRED,
+        )
+        await app.state.notifier.start()
+        app.state.feedback_cache = FeedbackCache(
+            app.state.aredis,
+            model_id_for=partial(route_model_id, settings, 'feedback'),
+            ttl_s=settings.FEEDBACK_CACHE_TTL_S,
+            max_entries=settings.FEEDBACK_CACHE_MAX_ENTRIES,
+        )
 
         logger.info(
-            'startup: ok | redis_url=%s queue=%s '
+            'startup: ok | redis_url=%s queues=%s '
             'result_ttl_s=%s job_timeout_s=%s',
             settings.REDIS_URL,
-            settings.RQ_QUEUE_NAME,
+            ','.join(q.name for q in app.state.queues.values()),
             settings.RQ_RESULT_TTL_S,
             getattr(settings, 'JOB_TIMEOUT_S', 120),
         )
 
+    @app.on_event('shutdown')
+    async def shutdown() -> None:
+        await app.state.notifier.stop()
+        await app.state.aredis.aclose()
+
+    async def admit(request: Request, priority: str) -> None:
+        """
+        Turn the request away right now if no runner is ready to take it
+        or its job would not finish within the caller's `x-wait-budget-s`
+        (default: the queue's deadline).
+        """
+        if not await app.state.readiness.ready():
+            logger.warning(
+                'admission: rejected, no runner ready | priority=%s',
+                priority,
+            )
+            raise HTTPException(
+                status_code=503,
+                detail='no runner is ready yet',
+                headers={
+                    'Retry-After': str(app.state.settings.RUNNER_HEARTBEAT_S),
+                },
+            )
+        try:
+            budget_s = float(request.headers['x-wait-budget-s'])
+        except (KeyError, ValueError):
+            budget_s = None
+        decision, _ = await app.state.admission.check(priority, budget_s)
+        if not decision.admitted:
+            raise HTTPException(
+                status_code=decision.status_code,
+                detail=decision.detail,
+                headers={'Retry-After': str(decision.retry_after_s)},
+            )
+
+    async def submit(
+            request: Request,
+            priority: str,
+            func: str,
+            *,
+            kind: str,
+            **job_kwargs,
+    ) -> tuple[str, bool]:
+        """
+        Enqueue `func` on a priority queue after admission control, or
+        attach to an identical job already in flight. Returns the job id
+        and whether the request was attached.
+        """
+        settings = app.state.settings
+        coalescer: Coalescer = app.state.coalescer
+        fp = fingerprint(
+            kind,
+            job_kwargs.get('level'),
+            job_kwargs['message'],
+            job_kwargs.get('history'),
+        )
+        job_id = uuid.uuid4().hex
+        attached_to = await coalescer.claim(kind, fp, job_id)
+        if attached_to is not None:
+            return attached_to, True
+
+        try:
+            await admit(request, priority)
+            await asyncio.to_thread(
+                enqueue_job,
+                app.state.queues[priority],
+                func,
+                job_id=job_id,
+                meta={'inflight_key': inflight_key(fp)},
+                result_ttl=settings.RQ_RESULT_TTL_S,
+                deadline_s=priority_deadline_s(settings, priority),
+                **job_kwargs,
+            )
+        except BaseException:
+            await coalescer.release(fp, job_id)
+            raise
+        return job_id, False
+
     @app.get('/health')
-    def health():
-        return {'status': 'ok'}
+    async def health():
+        try:
+            load = await app.state.admission.snapshot()
+        except Exception as e:
+            logger.warning('health: queue snapshot failed | err=%s', e)
+            load = None
+        try:
+            runners = await app.state.readiness.runners()
+        except Exception as e:
+            logger.warning('health: readiness check failed | err=%s', e)
+            runners = None
+        return {'status': 'ok', 'load': load, 'ready_runners': runners}
+
+    @app.get('/api/v1/worker/stats')
+    async def stats():
+        # tokens_saved: generation budget left unused by cancelled jobs
+        return {
+            'cancel': await cancel_stats(app.state.aredis),
+            'precheck': await precheck_stats(app.state.aredis),
+            'budget': await budget_stats(app.state.aredis),
+            'coalesced': await coalesce_stats(app.state.aredis),
+        }
+
+    @app.get('/metrics', response_class=PlainTextResponse)
+    async def metrics():
+        aredis = app.state.aredis
+        lines = await render_histograms(aredis)
+
+        raw = await aredis.hgetall(FEEDBACK_CACHE_STATS)
+        lines += render_counters(
+            'ai_worker_feedback_cache_total',
+            'Feedback cache lookups by result.',
+            {k.decode(): int(v) for k, v in raw.items()},
+            label='result',
+        )
+        lines += render_counters(
+            'ai_worker_cancelled_total',
+            'Cancelled generations and their tokens (generated, saved).',
+            await cancel_stats(aredis),
+            label='what',
+        )
+        lines += render_counters(
+            'ai_worker_precheck_total',
+            'Feedback requests by pre-check outcome (model = not skipped).',
+            await precheck_stats(aredis),
+            label='reason',
+        )
+        lines += render_counters(
+            'ai_worker_coalesced_total',
+            'Requests attached to an identical in-flight job.',
+            await coalesce_stats(aredis),
+            label='kind',
+        )
+        budget = await budget_stats(aredis)
+        lines += render_counters(
+            'ai_worker_max_new_tokens',
+            'Current load-adjusted generation budget per kind:level.',
+            budget['max_new_tokens'],
+            label='target',
+            kind='gauge',
+        )
+        lines += render_counters(
+            'ai_worker_budget_adjustments_total',
+            'Changes of the generation budget per kind:level.',
+            budget['adjustments'],
+            label='target',
+        )
+
+        lines += render_counters(
+            'ai_worker_runners_ready',
+            'Runners that finished loading and warmup and take jobs.',
+            {r: 1 for r in await app.state.readiness.runners()},
+            label='runner',
+            kind='gauge',
+        )
+
+        load = await app.state.admission.snapshot()
+        for gauge, field, help_text in (
+            ('ai_worker_queue_depth', 'depth', 'Jobs waiting per queue.'),
+            (
+                'ai_worker_queue_est_wait_seconds', 'est_wait_s',
+                'Estimated wait of a job enqueued now.',
+            ),
+        ):
+            lines += render_counters(
+                gauge,
+                help_text,
+                {q: row[field] for q, row in load['queues'].items()},
+                label='queue',
+                kind='gauge',
+            )
+        return PlainTextResponse(
+            '\n'.join(lines) + '\n',
+            media_type='text/plain; version=0.0.4',
+        )
+
+    @app.post('/api/v1/worker/history/budget')
+    async def history_budget(req: HistoryBudgetRequest, request: Request):
+        settings = app.state.settings
+        rid = request.state.request_id
+
+        def measure() -> HistoryBudgetResponse:
+            counter = get_token_counter()
+            counts = counter.counts(req.history)
+            kept = fit_history(req.history, settings, counter)
+            return HistoryBudgetResponse(
+                counts=counts,
+                keep=len(kept),
+                used_tokens=sum(counts[len(counts) - len(kept):]),
+                max_tokens=settings.MAX_HISTORY_TOKENS,
+            )
+
+        result = await asyncio.to_thread(measure)
+        logger.info(
+            'history budget: ok | rid=%s messages=%s keep=%s tokens=%s',
+            rid,
+            len(req.history),
+            result.keep,
+            result.used_tokens,
+        )
+        return {'request_id': rid, 'result': result.model_dump()}
 
     @app.post('/api/v1/worker/reply')
     async def reply_wait(req: ReplyRequest, request: Request):
         settings = app.state.settings
-        q = app.state.queue
         rid = request.state.request_id
 
         level = req.meta.level if req.meta else None
@@ -89,44 +349,278 @@ def create_app() -> FastAPI:
             len(hist),
         )
 
-        job = q.enqueue(
+        job_id, attached = await submit(
+            request,
+            'reply',
             'src.tasks.task_reply',
+            kind='reply',
             level=level,
             history=hist,
             message=req.message,
-            result_ttl=settings.RQ_RESULT_TTL_S,
+            user_id=req.user_id,
+            session_id=req.session_id,
         )
 
-        logger.info('reply: job created | rid=%s job_id=%s', rid, job.id)
+        logger.info(
+            'reply: job created | rid=%s job_id=%s attached=%s',
+            rid, job_id, attached,
+        )
 
         try:
-            result = await wait_job_result(
-                job,
+            result = await wait_job_or_cancel(
+                app.state.notifier,
+                job_id,
+                is_disconnected=request.is_disconnected,
                 timeout_s=getattr(settings, 'JOB_TIMEOUT_S', 120),
+                cancel_ttl_s=settings.RQ_RESULT_TTL_S,
             )
         except TimeoutError as e:
             logger.warning(
                 'reply: timeout | rid=%s job_id=%s timeout_s=%s',
                 rid,
-                job.id,
+                job_id,
+                getattr(settings, 'JOB_TIMEOUT_S', 120),
+            )
+            raise HTTPException(status_code=504, detail=str(e))
+        except ClientDisconnected as e:
+            raise HTTPException(status_code=499, detail=str(e))
+        except Exception as e:
+            logger.exception('reply: failed | rid=%s job_id=%s', rid, job_id)
+            raise HTTPException(status_code=500, detail=f"job failed: {e}")
+
+        logger.info('reply: done | rid=%s job_id=%s', rid, job_id)
+        return {'request_id': rid, 'result': result}
+
+    @app.post('/api/v1/worker/reply/stream')
+    async def reply_stream(req: ReplyRequest, request: Request):
+        settings = app.state.settings
+        rid = request.state.request_id
+
+        level = req.meta.level if req.meta else None
+        hist = [{'role': m.role, 'content': m.content} for m in req.history]
+
+        logger.info(
+            'reply stream: enqueue | rid=%s user_id=%s '
+            'session_id=%s level=%s hist_turns=%s',
+            rid,
+            req.user_id,
+            req.session_id,
+            level,
+            len(hist),
+        )
+
+        job_id, attached = await submit(
+            request,
+            'reply',
+            'src.tasks.task_reply',
+            kind='reply_stream',
+            level=level,
+            history=hist,
+            message=req.message,
+            user_id=req.user_id,
+            session_id=req.session_id,
+            stream=True,
+        )
+
+        logger.info(
+            'reply stream: job created | rid=%s job_id=%s attached=%s',
+            rid, job_id, attached,
+        )
+
+        return StreamingResponse(
+            iter_job_stream(
+                app.state.aredis,
+                job_id,
+                timeout_s=getattr(settings, 'JOB_TIMEOUT_S', 120),
+                cancel_ttl_s=settings.RQ_RESULT_TTL_S,
+            ),
+            media_type='text/event-stream',
+            headers={'cache-control': 'no-cache', 'x-job-id': job_id},
+        )
+
+    @app.post('/api/v1/worker/turn')
+    async def turn_wait(req: ReplyRequest, request: Request):
+        settings = app.state.settings
+        rid = request.state.request_id
+
+        level = req.meta.level if req.meta else None
+        hist = [{'role': m.role, 'content': m.content} for m in req.history]
+
+        cache: FeedbackCache = app.state.feedback_cache
+        cache_key = cache.key(level, req.message)
+        cached, cache_meta = None, {}
+        if cache.enabled:
+            cached, cache_meta = await cache.get(cache_key)
+
+        logger.info(
+            'turn: enqueue | rid=%s user_id=%s '
+            'session_id=%s level=%s hist_turns=%s feedback_cache=%s',
+            rid,
+            req.user_id,
+            req.session_id,
+            level,
+            len(hist),
+            cache_meta.get('cache'),
+        )
+
+        # with cached feedback only the reply is left to generate
+        job_id, attached = await submit(
+            request,
+            'reply',
+            'src.tasks.task_reply' if cached else 'src.tasks.task_turn',
+            kind='turn_reply_only' if cached else 'turn',
+            level=level,
+            history=hist,
+            message=req.message,
+            user_id=req.user_id,
+            session_id=req.session_id,
+        )
+
+        logger.info(
+            'turn: job created | rid=%s job_id=%s attached=%s',
+            rid, job_id, attached,
+        )
+
+        try:
+            result = await wait_job_or_cancel(
+                app.state.notifier,
+                job_id,
+                is_disconnected=request.is_disconnected,
+                timeout_s=getattr(settings, 'JOB_TIMEOUT_S', 120),
+                cancel_ttl_s=settings.RQ_RESULT_TTL_S,
+            )
+        except TimeoutError as e:
+            logger.warning(
+                'turn: timeout | rid=%s job_id=%s timeout_s=%s',
+                rid,
+                job_id,
                 getattr(settings, 'JOB_TIMEOUT_S', 120),
             )
             raise HTTPException(status_code=504, detail=str(e))
+        except ClientDisconnected as e:
+            raise HTTPException(status_code=499, detail=str(e))
         except Exception as e:
-            logger.exception('reply: failed | rid=%s job_id=%s', rid, job.id)
+            logger.exception('turn: failed | rid=%s job_id=%s', rid, job_id)
             raise HTTPException(status_code=500, detail=f"job failed: {e}")
 
-        logger.info('reply: done | rid=%s job_id=%s', rid, job.id)
+        if 'error' not in result:
+            if cached:
+                result['language_feedback'] = cached
+            elif cache.enabled and not result['meta'].get('fallback'):
+                await cache.put(cache_key, result['language_feedback'])
+            result['meta'] = {**(result.get('meta') or {}), **cache_meta}
+
+        logger.info('turn: done | rid=%s job_id=%s', rid, job_id)
         return {'request_id': rid, 'result': result}
 
+    @app.post('/api/v1/worker/turn/stream')
+    async def turn_stream(req: ReplyRequest, request: Request):
+        settings = app.state.settings
+        rid = request.state.request_id
+
+        level = req.meta.level if req.meta else None
+        hist = [{'role': m.role, 'content': m.content} for m in req.history]
+
+        cache: FeedbackCache = app.state.feedback_cache
+        cache_key = cache.key(level, req.message)
+        cached, cache_meta = None, {}
+        if cache.enabled:
+            cached, cache_meta = await cache.get(cache_key)
+
+        logger.info(
+            'turn stream: enqueue | rid=%s user_id=%s '
+            'session_id=%s level=%s hist_turns=%s feedback_cache=%s',
+            rid,
+            req.user_id,
+            req.session_id,
+            level,
+            len(hist),
+            cache_meta.get('cache'),
+        )
+
+        job_id, attached = await submit(
+            request,
+            'reply',
+            'src.tasks.task_reply' if cached else 'src.tasks.task_turn',
+            kind='turn_stream_reply_only' if cached else 'turn_stream',
+            level=level,
+            history=hist,
+            message=req.message,
+            user_id=req.user_id,
+            session_id=req.session_id,
+            stream=True,
+        )
+
+        logger.info(
+            'turn stream: job created | rid=%s job_id=%s attached=%s',
+            rid, job_id, attached,
+        )
+
+        async def remember(done: dict) -> None:
+            meta = done.get('meta') or {}
+            if (
+                    not cached and cache.enabled
+                    and 'language_feedback' in done
+                    and not meta.get('fallback')
+            ):
+                await cache.put(cache_key, done['language_feedback'])
+            done['meta'] = {**meta, **cache_meta}
+
+        return StreamingResponse(
+            iter_job_stream(
+                app.state.aredis,
+                job_id,
+                timeout_s=getattr(settings, 'JOB_TIMEOUT_S', 120),
+                cancel_ttl_s=settings.RQ_RESULT_TTL_S,
+                done_extra={'language_feedback': cached} if cached else None,
+                on_done=remember,
+            ),
+            media_type='text/event-stream',
+            headers={'cache-control': 'no-cache', 'x-job-id': job_id},
+        )
+
     @app.post('/api/v1/worker/feedback')
     async def feedback_wait(req: FeedbackRequest, request: Request):
         settings = app.state.settings
-        q = app.state.queue
         rid = request.state.request_id
 
         level = req.meta.level if req.meta else None
 
+        prechecked = run_precheck(req.message, settings)
+        if prechecked is not None:
+            await record_precheck_async(app.state.aredis, prechecked.reason)
+            logger.info(
+                'feedback: precheck hit | rid=%s user_id=%s reason=%s',
+                rid,
+                req.user_id,
+                prechecked.reason,
+            )
+            return {
+                'request_id': rid,
+                'result': {
+                    'language_feedback': prechecked.feedback.model_dump(),
+                    'meta': precheck_meta(prechecked),
+                },
+            }
+
+        cache: FeedbackCache = app.state.feedback_cache
+        cache_key = cache.key(level, req.message)
+        cached, cache_meta = None, {}
+        if cache.enabled:
+            cached, cache_meta = await cache.get(cache_key)
+
+        if cached is not None:
+            logger.info(
+                'feedback: cache hit | rid=%s user_id=%s level=%s',
+                rid,
+                req.user_id,
+                level,
+            )
+            return {
+                'request_id': rid,
+                'result': {'language_feedback': cached, 'meta': cache_meta},
+            }
+
         logger.info(
             'feedback: enqueue | rid=%s user_id=%s session_id=%s level=%s',
             rid,
@@ -135,37 +629,364 @@ def create_app() -> FastAPI:
             level,
         )
 
-        job = q.enqueue(
+        job_id, attached = await submit(
+            request,
+            'feedback',
             'src.tasks.task_feedback',
+            kind='feedback',
             level=level,
             message=req.message,
-            result_ttl=settings.RQ_RESULT_TTL_S,
         )
 
-        logger.info('feedback: job created | rid=%s job_id=%s', rid, job.id)
+        logger.info(
+            'feedback: job created | rid=%s job_id=%s attached=%s',
+            rid, job_id, attached,
+        )
 
         try:
-            result = await wait_job_result(
-                job,
+            result = await wait_job_or_cancel(
+                app.state.notifier,
+                job_id,
+                is_disconnected=request.is_disconnected,
                 timeout_s=getattr(settings, 'JOB_TIMEOUT_S', 120),
+                cancel_ttl_s=settings.RQ_RESULT_TTL_S,
             )
         except TimeoutError as e:
             logger.warning(
                 'feedback: timeout | rid=%s job_id=%s timeout_s=%s',
                 rid,
-                job.id,
+                job_id,
                 getattr(settings, 'JOB_TIMEOUT_S', 120),
             )
             raise HTTPException(status_code=504, detail=str(e))
+        except ClientDisconnected as e:
+            raise HTTPException(status_code=499, detail=str(e))
         except Exception as e:
             logger.exception(
-                'feedback: failed | rid=%s job_id=%s', rid, job.id,
+                'feedback: failed | rid=%s job_id=%s', rid, job_id,
             )
             raise HTTPException(status_code=500, detail=f"job failed: {e}")
 
-        logger.info('feedback: done | rid=%s job_id=%s', rid, job.id)
+        if 'error' not in result:
+            meta = result.get('meta') or {}
+            if cache.enabled and not meta.get('fallback'):
+                await cache.put(cache_key, result['language_feedback'])
+            result['meta'] = {**meta, **cache_meta}
+
+        logger.info('feedback: done | rid=%s job_id=%s', rid, job_id)
         return {'request_id': rid, 'result': result}
 
+    @app.post('/api/v1/worker/feedback:batch')
+    async def feedback_batch(req: FeedbackBatchRequest, request: Request):
+        """
+        Feedback for many messages, streamed back as NDJSON lines
+        ({'index', 'user_id', 'session_id', 'result'}) as they complete.
+
+        Items with the same level and message are generated once. Precheck
+        and cache hits come first; the rest go to the batch queue in jobs
+        of FEEDBACK_BATCH_JOB_SIZE messages, which the runner decodes
+        together.
+        """
+        settings = app.state.settings
+        rid = request.state.request_id
+        if len(req.items) > settings.FEEDBACK_BATCH_MAX_ITEMS:
+            raise HTTPException(
+                status_code=413,
+                detail=(
+                    f"at most {settings.FEEDBACK_BATCH_MAX_ITEMS} items "
+                    'per batch'
+                ),
+            )
+
+        cache: FeedbackCache = app.state.feedback_cache
+        # cache key -> indexes of the items asking for it
+        groups: dict[str, list[int]] = {}
+        for i, item in enumerate(req.items):
+            level = item.meta.level if item.meta else None
+            groups.setdefault(cache.key(level, item.message), []).append(i)
+
+        ready: list[tuple[str, dict]] = []
+        todo: list[tuple[str, str | None, str]] = []
+        for key, indexes in groups.items():
+            item = req.items[indexes[0]]
+            level = item.meta.level if item.meta else None
+            prechecked = run_precheck(item.message, settings)
+            if prechecked is not None:
+                await record_precheck_async(
+                    app.state.aredis, prechecked.reason,
+                )
+                ready.append((key, {
+                    'language_feedback': prechecked.feedback.model_dump(),
+                    'meta': precheck_meta(prechecked),
+                }))
+                continue
+            if cache.enabled:
+                cached, cache_meta = await cache.get(key)
+                if cached is not None:
+                    ready.append((key, {
+                        'language_feedback': cached, 'meta': cache_meta,
+                    }))
+                    continue
+            todo.append((key, level, item.message))
+
+        # job id -> the (cache key, level, message) it generates
+        jobs: dict[str, list[tuple[str, str | None, str]]] = {}
+        if todo:
+            await admit(request, 'batch')
+            size = max(1, settings.FEEDBACK_BATCH_JOB_SIZE)
+            for start in range(0, len(todo), size):
+                chunk = todo[start:start + size]
+                job = await asyncio.to_thread(
+                    enqueue_job,
+                    app.state.queues['batch'],
+                    'src.tasks.task_feedback_batch',
+                    items=[
+                        {'level': level, 'message': message}
+                        for _, level, message in chunk
+                    ],
+                    result_ttl=settings.RQ_RESULT_TTL_S,
+                    deadline_s=priority_deadline_s(settings, 'batch'),
+                )
+                jobs[job.id] = chunk
+
+        logger.info(
+            'feedback batch: enqueue | rid=%s items=%s unique=%s ready=%s '
+            'jobs=%s',
+            rid, len(req.items), len(groups), len(ready), len(jobs),
+        )
+
+        def lines(key: str, result: dict):
+            for i in groups[key]:
+                item = req.items[i]
+                yield json.dumps(
+                    {
+                        'index': i,
+                        'user_id': item.user_id,
+                        'session_id': item.session_id,
+                        'result': result,
+                    },
+                    ensure_ascii=False,
+                ) + '\n'
+
+        async def results():
+            for key, result in ready:
+                for line in lines(key, result):
+                    yield line
+
+            waiters = {
+                asyncio.ensure_future(wait_job_result(
+                    app.state.notifier,
+                    job_id,
+                    timeout_s=settings.FEEDBACK_BATCH_TIMEOUT_S,
+                )): job_id
+                for job_id in jobs
+            }
+            try:
+                while waiters:
+                    done, _ = await asyncio.wait(
+                        waiters, return_when=asyncio.FIRST_COMPLETED,
+                    )
+                    for waiter in done:
+                        job_id = waiters.pop(waiter)
+                        chunk = jobs.pop(job_id)
+                        try:
+                            out = waiter.result() or {}
+                        except Exception as e:
+                            out = {'error': str(e)}
+                        items = out.get('results') or [
+                            {'error': out.get('error', 'job failed')}
+                        ] * len(chunk)
+                        for (key, _, _), result in zip(chunk, items):
+                            meta = result.get('meta') or {}
+                            if (
+                                    'error' not in result
+                                    and cache.enabled
+                                    and not meta.get('fallback')
+                            ):
+                                await cache.put(
+                                    key, result['language_feedback'],
+                                )
+                            for line in lines(key, result):
+                                yield line
+            finally:
+                for waiter in waiters:
+                    waiter.cancel()
+                # the client is gone: nobody reads the jobs left. The
+                # disconnect cancelled this scope, so shield the cleanup.
+                with anyio.CancelScope(shield=True):
+                    await request_cancel_many(
+                        app.state.aredis,
+                        list(jobs),
+                        reason='batch abandoned',
+                        ttl_s=settings.RQ_RESULT_TTL_S,
+                    )
+                logger.info(
+                    'feedback batch: done | rid=%s abandoned_jobs=%s',
+                    rid, len(jobs),
+                )
+
+        return StreamingResponse(
+            results(),
+            media_type='application/x-ndjson',
+            headers={'x-batch-jobs': str(len(jobs))},
+        )
+
+    @app.post('/api/v1/worker/jobs', status_code=202)
+    async def job_submit(req: JobSubmitRequest, request: Request):
+        """
+        Start a reply, turn or feedback job and return its id right away;
+        the answer is fetched with GET /jobs/{id} or POST /jobs/status.
+        """
+        settings = app.state.settings
+        rid = request.state.request_id
+
+        level = req.meta.level if req.meta else None
+        hist = [{'role': m.role, 'content': m.content} for m in req.history]
+
+        if req.kind == 'feedback':
+            # answers without a model run become already finished jobs
+            language_feedback, meta = None, {}
+            prechecked = run_precheck(req.message, settings)
+            if prechecked is not None:
+                await record_precheck_async(
+                    app.state.aredis, prechecked.reason,
+                )
+                language_feedback = prechecked.feedback.model_dump()
+                meta = precheck_meta(prechecked)
+            elif app.state.feedback_cache.enabled:
+                cache: FeedbackCache = app.state.feedback_cache
+                language_feedback, meta = await cache.get(
+                    cache.key(level, req.message),
+                )
+            if language_feedback is not None:
+                job_id = uuid.uuid4().hex
+                await publish_done(
+                    app.state.aredis,
+                    {
+                        'job_id': job_id,
+                        'status': 'finished',
+                        'result': {
+                            'language_feedback': language_feedback,
+                            'meta': meta,
+                        },
+                    },
+                )
+                logger.info(
+                    'jobs: answered on submit | rid=%s job_id=%s kind=%s',
+                    rid, job_id, req.kind,
+                )
+                return {
+                    'request_id': rid,
+                    'job_id': job_id,
+                    'status': 'finished',
+                    'attached': False,
+                }
+            job_id, attached = await submit(
+                request,
+                'feedback',
+                'src.tasks.task_feedback',
+                kind='feedback',
+                level=level,
+                message=req.message,
+            )
+        else:
+            job_id, attached = await submit(
+                request,
+                'reply',
+                f"src.tasks.task_{req.kind}",
+                kind=req.kind,
+                level=level,
+                history=hist,
+                message=req.message,
+                user_id=req.user_id,
+                session_id=req.session_id,
+                stream=True,
+            )
+
+        logger.info(
+            'jobs: submitted | rid=%s job_id=%s kind=%s attached=%s',
+            rid, job_id, req.kind, attached,
+        )
+        return {
+            'request_id': rid,
+            'job_id': job_id,
+            'status': 'queued',
+            'attached': attached,
+        }
+
+    def poll_wait_s(wait_s: float) -> float:
+        return max(0.0, min(wait_s, app.state.settings.JOBS_MAX_WAIT_S))
+
+    @app.get('/api/v1/worker/jobs/{job_id}')
+    async def job_status(
+            job_id: str,
+            wait_s: float = 0,
+            progress: bool = True,
+    ):
+        """
+        Status of one job; with `wait_s` the request is held until the job
+        ends or the wait runs out (long polling).
+        """
+        aredis = app.state.aredis
+        status = (await job_statuses(aredis, [job_id]))[job_id]
+        if status['status'] == 'unknown':
+            raise HTTPException(status_code=404, detail='unknown job id')
+        if status['status'] not in JOB_ENDED:
+            await wait_any(
+                app.state.notifier, [job_id], timeout_s=poll_wait_s(wait_s),
+            )
+        status = (await job_statuses(aredis, [job_id], progress=progress))
+        return {'job_id': job_id, **status[job_id]}
+
+    @app.post('/api/v1/worker/jobs/status')
+    async def jobs_status(req: JobStatusRequest):
+        """
+        Status of many jobs at once. With `wait_s` and none of them ended
+        yet, the request is held until the first one ends. Unknown ids
+        are final: they are not waited for and do not end the wait.
+        """
+        settings = app.state.settings
+        if len(req.ids) > settings.JOBS_MAX_BATCH_IDS:
+            raise HTTPException(
+                status_code=422,
+                detail=f"at most {settings.JOBS_MAX_BATCH_IDS} ids",
+            )
+        ids = list(dict.fromkeys(req.ids))
+        aredis = app.state.aredis
+
+        statuses = await job_statuses(aredis, ids)
+        running = [
+            job_id for job_id, status in statuses.items()
+            if status['status'] not in JOB_ENDED
+            and status['status'] != 'unknown'
+        ]
+        ended = any(
+            status['status'] in JOB_ENDED for status in statuses.values()
+        )
+        if running and not ended:
+            await wait_any(
+                app.state.notifier, running,
+                timeout_s=poll_wait_s(req.wait_s),
+            )
+        if running:
+            statuses.update(
+                await job_statuses(aredis, running, progress=req.progress),
+            )
+        return {'jobs': statuses}
+
+    @app.delete('/api/v1/worker/jobs/{job_id}')
+    async def job_cancel(job_id: str):
+        """Stop waiting for a job; it is cancelled if nobody else waits."""
+        settings = app.state.settings
+        if await leave_job(app.state.aredis, job_id) <= 0:
+            await request_cancel(
+                app.state.aredis,
+                job_id,
+                reason='cancelled by caller',
+                ttl_s=settings.RQ_RESULT_TTL_S,
+            )
+        return {'job_id': job_id, 'status': 'cancel_requested'}
+
     return app
 
 
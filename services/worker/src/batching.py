@@ -0,0 +1,485 @@
+from __future__ import annotations
+
+import logging
+import os
+import queue
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+from dataclasses import field
+
+import torch
+from src.cancel import CancelToken
+from src.constrained import JsonConstraint
+from transformers import DynamicCache
+
+logger = logging.getLogger('ai_worker.batching')
+
+
+@dataclass(eq=False)
+class GenerationRequest:
+    input_ids: list[int]
+    max_new_tokens: int
+    temperature: float
+    top_p: float
+    prefix_cache: DynamicCache | None = None
+    prefix_len: int = 0
+    keep_cache: bool = False
+    final_cache: DynamicCache | None = None
+    stream: queue.Queue[int | None] | None = None
+    constraint: JsonConstraint | None = None
+    cancel: CancelToken | None = None
+    # from this many tokens on, stop after any of `stop_ids`
+    soft_max_new_tokens: int | None = None
+    stop_ids: frozenset[int] = frozenset()
+    output_ids: list[int] = field(default_factory=list)
+    error: BaseException | None = None
+    cancelled: bool = False
+    # perf_counter() when the first token was sampled
+    first_token_at: float | None = None
+    done: threading.Event = field(default_factory=threading.Event)
+
+    def finish(self, error: BaseException | None = None) -> None:
+        self.error = error
+        self.done.set()
+        if self.stream is not None:
+            self.stream.put(None)
+
+
+def _pad_cache_left(cache: DynamicCache, n: int) -> DynamicCache:
+    if n <= 0:
+        return cache
+    layers = []
+    for k, v in cache.to_legacy_cache():
+        pad_shape = (k.shape[0], k.shape[1], n, k.shape[3])
+        layers.append((
+            torch.cat([k.new_zeros(pad_shape), k], dim=2),
+            torch.cat([v.new_zeros(pad_shape), v], dim=2),
+        ))
+    return DynamicCache.from_legacy_cache(tuple(layers))
+
+
+def _expand_cache(cache: DynamicCache, n: int) -> DynamicCache:
+    layers = [
+        (k.expand(n, -1, -1, -1), v.expand(n, -1, -1, -1))
+        for k, v in cache.to_legacy_cache()
+    ]
+    return DynamicCache.from_legacy_cache(tuple(layers))
+
+
+def _concat_caches(a: DynamicCache, b: DynamicCache) -> DynamicCache:
+    layers = []
+    for (ka, va), (kb, vb) in zip(a.to_legacy_cache(), b.to_legacy_cache()):
+        layers.append((torch.cat([ka, kb]), torch.cat([va, vb])))
+    return DynamicCache.from_legacy_cache(tuple(layers))
+
+
+def _slice_cache(
+        cache: DynamicCache,
+        rows: torch.Tensor | None = None,
+        start: int = 0,
+) -> DynamicCache:
+    layers = []
+    for k, v in cache.to_legacy_cache():
+        if rows is not None:
+            k, v = k.index_select(0, rows), v.index_select(0, rows)
+        layers.append((k[:, :, start:], v[:, :, start:]))
+    return DynamicCache.from_legacy_cache(tuple(layers))
+
+
+class BatchScheduler:
+    """
+    Continuous batching engine shared by all generation calls of a process.
+
+    Requests are left-padded into one running batch with a shared KV cache.
+    Finished rows leave the batch after every decode step and queued
+    requests are prefilled and merged in at the next token boundary.
+    """
+
+    def __init__(
+            self,
+            model,
+            *,
+            pad_token_id: int,
+            eos_token_ids: set[int],
+            max_batch_size: int,
+            wait_ms: int,
+    ):
+        self.model = model
+        self.pad_token_id = pad_token_id
+        self.eos_token_ids = eos_token_ids
+        self.max_batch_size = max(1, max_batch_size)
+        self.wait_s = max(0, wait_ms) / 1000
+
+        gen_cfg = getattr(model, 'generation_config', None)
+        self.do_sample = bool(getattr(gen_cfg, 'do_sample', True))
+        self.top_k = int(getattr(gen_cfg, 'top_k', 0) or 0)
+
+        self._pending: queue.Queue[GenerationRequest | None] = queue.Queue()
+        self._active: list[GenerationRequest] = []
+        self._cache: DynamicCache | None = None
+        self._attention_mask: torch.Tensor | None = None
+        self._next_tokens: torch.Tensor | None = None
+
+        self._thread: threading.Thread | None = None
+        self._thread_pid: int | None = None
+        self._start_lock = threading.Lock()
+        # set by `close`; the decode thread drains what it has, then exits
+        self._closed = False
+        self._closing = False
+
+        logger.info(
+            'batching: ready | max_batch_size=%s wait_ms=%s '
+            'do_sample=%s top_k=%s',
+            self.max_batch_size,
+            wait_ms,
+            self.do_sample,
+            self.top_k,
+        )
+
+    def _ensure_started(self) -> None:
+        # Started lazily and per pid: the supervisor builds the model once
+        # and forks, and threads do not survive fork().
+        pid = os.getpid()
+        if self._thread_pid == pid:
+            return
+        with self._start_lock:
+            if self._thread_pid == pid:
+                return
+            if self._thread is not None:
+                # forked child: state inherited from the parent is stale
+                self._pending = queue.Queue()
+                self._reset()
+            self._thread = threading.Thread(
+                target=self._run, name='batch-scheduler', daemon=True,
+            )
+            self._thread.start()
+            self._thread_pid = pid
+        logger.info('batching: started | pid=%s', pid)
+
+    def close(self, timeout_s: float = 300.0) -> None:
+        """
+        Stop taking requests, let the ones already submitted finish and
+        end the decode thread, which drops its hold on the model.
+        """
+        self._closed = True
+        self._pending.put(None)
+        if self._thread is not None and self._thread_pid == os.getpid():
+            self._thread.join(timeout=timeout_s)
+            if self._thread.is_alive():
+                logger.warning(
+                    'batching: close timed out | active=%s', len(self._active),
+                )
+                return
+        self._reset()
+        logger.info('batching: closed | pid=%s', os.getpid())
+
+    @property
+    def idle(self) -> bool:
+        return not self._active and self._pending.empty()
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.device
+
+    def submit(
+            self,
+            req: GenerationRequest,
+            on_token: Callable[[int], None] | None = None,
+    ) -> list[int]:
+        if self._closed:
+            raise RuntimeError('batch scheduler is closed')
+        self._ensure_started()
+        if on_token is not None:
+            req.stream = queue.Queue()
+        self._pending.put(req)
+        try:
+            # Short waits keep the caller interruptible (RQ job timeouts
+            # are delivered as asynchronous exceptions on this thread).
+            # Streamed tokens are handed back here so that slow consumers
+            # never stall the shared decode loop. The cancel flag is polled
+            # here too, off the decode thread; the scheduler drops the row
+            # at the next token boundary.
+            while True:
+                if req.cancel is not None and not req.cancelled:
+                    req.cancelled = req.cancel.check(len(req.output_ids))
+                if req.stream is None:
+                    if req.done.wait(0.5):
+                        break
+                    continue
+                try:
+                    tok = req.stream.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if tok is None:
+                    break
+                on_token(tok)
+        finally:
+            if not req.done.is_set():
+                req.cancelled = True
+
+        if req.error is not None:
+            raise req.error
+        return req.output_ids
+
+    def _run(self) -> None:
+        while True:
+            admitted: list[GenerationRequest] = []
+            try:
+                admitted = self._collect()
+                if admitted:
+                    self._admit(admitted)
+                if self._active:
+                    self._step()
+                elif self._closing and self._pending.empty():
+                    return
+            except Exception as e:
+                logger.exception('batching: step failed | err=%s', e)
+                for req in admitted:
+                    if not req.done.is_set():
+                        req.finish(e)
+                self._fail_all(e)
+
+    def _collect(self) -> list[GenerationRequest]:
+        free = self.max_batch_size - len(self._active)
+        if free <= 0:
+            return []
+
+        batch: list[GenerationRequest | None] = []
+        if not self._active:
+            # idle: block for the first request, then keep the wait window
+            # open so requests arriving together share one prefill
+            batch.append(self._pending.get())
+            deadline = time.monotonic() + self.wait_s
+            while len(batch) < free:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+        while len(batch) < free:
+            try:
+                batch.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+
+        if None in batch:
+            # the `close` sentinel
+            self._closing = True
+            batch = [r for r in batch if r is not None]
+        for r in batch:
+            if r.cancelled:
+                r.finish()
+        return [r for r in batch if not r.cancelled]
+
+    @torch.no_grad()
+    def _admit(self, reqs: list[GenerationRequest]) -> None:
+        groups: dict[int, list[GenerationRequest]] = {}
+        for r in reqs:
+            groups.setdefault(id(r.prefix_cache), []).append(r)
+        for group in groups.values():
+            self._prefill(group)
+
+    def _prefill(self, reqs: list[GenerationRequest]) -> None:
+        """Prefill requests sharing one cached prefix (or none)."""
+        prefix = reqs[0].prefix_cache
+        prefix_len = reqs[0].prefix_len if prefix is not None else 0
+
+        suffixes = [r.input_ids[prefix_len:] for r in reqs]
+        max_len = max(len(s) for s in suffixes)
+        ids = torch.full(
+            (len(reqs), max_len), self.pad_token_id, dtype=torch.long,
+        )
+        mask = torch.zeros((len(reqs), prefix_len + max_len), dtype=torch.long)
+        mask[:, :prefix_len] = 1
+        for i, s in enumerate(suffixes):
+            ids[i, max_len - len(s):] = torch.tensor(s, dtype=torch.long)
+            mask[i, prefix_len + max_len - len(s):] = 1
+        ids, mask = ids.to(self.device), mask.to(self.device)
+
+        if prefix is None:
+            cache = DynamicCache()
+        else:
+            cache = _expand_cache(prefix, len(reqs))
+
+        position_ids = (mask.cumsum(-1) - 1).clamp(min=0)[:, prefix_len:]
+        out = self.model(
+            input_ids=ids,
+            attention_mask=mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True,
+            num_logits_to_keep=1,
+        )
+        next_tokens = self._sample(out.logits[:, -1, :], reqs)
+        self._merge(out.past_key_values, mask, next_tokens, reqs)
+
+        logger.debug(
+            'batching: admitted | n=%s prefix_len=%s suffix_len=%s '
+            'active=%s',
+            len(reqs), prefix_len, max_len, len(self._active),
+        )
+
+    def _merge(
+            self,
+            cache: DynamicCache,
+            mask: torch.Tensor,
+            next_tokens: torch.Tensor,
+            reqs: list[GenerationRequest],
+    ) -> None:
+        if self._cache is None:
+            self._cache = cache
+            self._attention_mask = mask
+            self._next_tokens = next_tokens
+            self._active = list(reqs)
+        else:
+            cur_len = self._attention_mask.shape[1]
+            new_len = mask.shape[1]
+            width = max(cur_len, new_len)
+            old_cache = _pad_cache_left(self._cache, width - cur_len)
+            new_cache = _pad_cache_left(cache, width - new_len)
+            self._cache = _concat_caches(old_cache, new_cache)
+            self._attention_mask = torch.cat([
+                self._pad_mask_left(self._attention_mask, width - cur_len),
+                self._pad_mask_left(mask, width - new_len),
+            ])
+            self._next_tokens = torch.cat([self._next_tokens, next_tokens])
+            self._active.extend(reqs)
+
+        offset = len(self._active) - len(reqs)
+        self._retire(next_tokens.tolist(), offset=offset)
+
+    @torch.no_grad()
+    def _step(self) -> None:
+        ones = self._attention_mask.new_ones((len(self._active), 1))
+        self._attention_mask = torch.cat([self._attention_mask, ones], dim=1)
+        position_ids = self._attention_mask.sum(-1, keepdim=True) - 1
+
+        out = self.model(
+            input_ids=self._next_tokens[:, None],
+            attention_mask=self._attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._cache,
+            use_cache=True,
+        )
+        self._cache = out.past_key_values
+        self._next_tokens = self._sample(out.logits[:, -1, :], self._active)
+        self._retire(self._next_tokens.tolist())
+
+    def _retire(self, tokens: list[int], offset: int = 0) -> None:
+        """Record sampled tokens and drop finished rows from the batch."""
+        keep: list[int] = []
+        for i, req in enumerate(self._active):
+            if i < offset:
+                keep.append(i)
+                continue
+            tok = tokens[i - offset]
+            if req.first_token_at is None:
+                req.first_token_at = time.perf_counter()
+            finished = req.cancelled
+            if not finished:
+                if tok in self.eos_token_ids:
+                    finished = True
+                else:
+                    req.output_ids.append(tok)
+                    if req.stream is not None:
+                        req.stream.put(tok)
+                    if req.constraint is not None:
+                        req.constraint.advance(tok)
+                    n = len(req.output_ids)
+                    finished = (
+                        n >= req.max_new_tokens
+                        or (req.constraint is not None and req.constraint.done)
+                        or (
+                            req.soft_max_new_tokens is not None
+                            and n >= req.soft_max_new_tokens
+                            and tok in req.stop_ids
+                        )
+                    )
+            if finished:
+                if req.keep_cache and not req.cancelled:
+                    req.final_cache = self._row_cache(i)
+                req.finish()
+            else:
+                keep.append(i)
+
+        if len(keep) == len(self._active):
+            return
+        if not keep:
+            self._reset()
+            return
+
+        rows = torch.tensor(keep, device=self.device)
+        mask = self._attention_mask.index_select(0, rows)
+        # drop leading columns that are padding for every remaining row
+        start = int((mask.sum(0) > 0).nonzero()[0])
+        self._cache = _slice_cache(self._cache, rows=rows, start=start)
+        self._attention_mask = mask[:, start:]
+        self._next_tokens = self._next_tokens.index_select(0, rows)
+        self._active = [self._active[i] for i in keep]
+
+    def _row_cache(self, row: int) -> DynamicCache:
+        """Padding-free copy of one row's cache (prompt + fed tokens)."""
+        cols = self._attention_mask[row].nonzero().squeeze(-1)
+        return DynamicCache.from_legacy_cache(
+            tuple(
+                (
+                    k[row:row + 1].index_select(2, cols),
+                    v[row:row + 1].index_select(2, cols),
+                )
+                for k, v in self._cache.to_legacy_cache()
+            ),
+        )
+
+    def _reset(self) -> None:
+        self._active = []
+        self._cache = None
+        self._attention_mask = None
+        self._next_tokens = None
+
+    def _fail_all(self, error: BaseException) -> None:
+        for req in self._active:
+            req.finish(error)
+        self._reset()
+
+    @staticmethod
+    def _pad_mask_left(mask: torch.Tensor, n: int) -> torch.Tensor:
+        if n <= 0:
+            return mask
+        return torch.cat([mask.new_zeros((mask.shape[0], n)), mask], dim=1)
+
+    def _sample(
+            self,
+            logits: torch.Tensor,
+            reqs: list[GenerationRequest],
+    ) -> torch.Tensor:
+        logits = logits.float()
+        for i, r in enumerate(reqs):
+            if r.constraint is not None:
+                logits[i] = r.constraint.mask(logits[i])
+        greedy = logits.argmax(-1)
+        if not self.do_sample:
+            return greedy
+
+        temps = torch.tensor(
+            [r.temperature for r in reqs], device=logits.device,
+        )
+        top_ps = torch.tensor([r.top_p for r in reqs], device=logits.device)
+
+        if 0 < self.top_k < logits.shape[-1]:
+            kth = logits.topk(self.top_k, dim=-1).values[:, -1:]
+            logits = logits.masked_fill(logits < kth, float('-inf'))
+
+        probs = torch.softmax(logits / temps.clamp(min=1e-5)[:, None], dim=-1)
+        sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+        cum = sorted_probs.cumsum(-1)
+        sorted_probs = sorted_probs.masked_fill(
+            cum - sorted_probs > top_ps[:, None], 0.0,
+        )
+        choice = torch.multinomial(sorted_probs, 1)
+        sampled = sorted_idx.gather(-1, choice).squeeze(-1)
+        return torch.where(temps > 0, sampled, greedy)
@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import get_args
+
+import torch
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from src.admission import load_snapshot
+from src.prompts import Level
+from src.prompts import normalize_level
+from src.prompts import PromptKind
+from src.settings import Settings
+from transformers import StoppingCriteria
+
+logger = logging.getLogger('ai_worker.budget')
+
+BUDGET_KEY = 'ai_worker:budget'
+BUDGET_STATS = 'ai_worker:budget_stats'
+DECODE_RATE_KEY = 'ai_worker:decode_tps'
+
+# budgets move in steps of this many tokens, so they do not flap
+BUDGET_STEP_TOKENS = 16
+# fewer decode rate samples than this leave the budgets at their caps
+MIN_RATE_SAMPLES = 5
+# an estimated queue wait below this counts as no queue: budgets at cap
+IDLE_WAIT_S = 0.5
+
+
+def record_decode_rate(
+        redis: Redis,
+        tokens_per_s: float,
+        *,
+        window: int,
+) -> None:
+    """Keep the decode rates of the last `window` generations."""
+    pipe = redis.pipeline(transaction=False)
+    pipe.lpush(DECODE_RATE_KEY, round(tokens_per_s, 1))
+    pipe.ltrim(DECODE_RATE_KEY, 0, max(1, window) - 1)
+    pipe.execute()
+
+
+def sentence_end_ids(texts: list[str | None]) -> frozenset[int]:
+    """Token ids whose text ends a sentence (., !, ? or a line break)."""
+    ids = set()
+    for i, text in enumerate(texts):
+        if text is None:
+            continue
+        tail = text.rstrip(' "\')»')
+        if '\n' in text or (tail and tail[-1] in '.!?'):
+            ids.add(i)
+    return frozenset(ids)
+
+
+def soft_limit(max_new_tokens: int, grace_tokens: int) -> int:
+    """Token count from which a reply stops at the next sentence end."""
+    return max(1, max_new_tokens - min(grace_tokens, max_new_tokens // 4))
+
+
+class SentenceStopCriteria(StoppingCriteria):
+    """
+    Stops `model.generate` right after a sentence-ending token once at
+    least `soft_max_new_tokens` were generated.
+    """
+
+    def __init__(
+            self,
+            stop_ids: frozenset[int],
+            prompt_len: int,
+            soft_max_new_tokens: int,
+    ):
+        self.stop_ids = stop_ids
+        self.prompt_len = prompt_len
+        self.soft_max_new_tokens = soft_max_new_tokens
+
+    def __call__(
+            self,
+            input_ids: torch.LongTensor,
+            scores: torch.FloatTensor,
+            **kwargs,
+    ) -> torch.BoolTensor:
+        generated = input_ids.shape[1] - self.prompt_len
+        stop = [
+            generated >= self.soft_max_new_tokens
+            and int(row[-1]) in self.stop_ids
+            for row in input_ids
+        ]
+        return torch.tensor(stop, dtype=torch.bool, device=input_ids.device)
+
+
+class BudgetController:
+    """
+    Per (kind, level) `max_new_tokens`, lowered under load.
+
+    A new job waits about the estimated queue wait of its priority and
+    then decodes at the recent slow-end (5th percentile) decode rate, so
+    the tokens that still fit in the target time are
+
+        (target - est_wait_s) * rate
+
+    clamped between the kind's floor and its configured cap, with the
+    target `BUDGET_TARGET_P95_S`. Without a queue (estimated wait under
+    `IDLE_WAIT_S`) budgets are back at the cap, even where a full-cap
+    answer takes longer than the target. Budgets are recomputed at most
+    every `BUDGET_REFRESH_S` seconds.
+    """
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self._budgets: dict[str, int] = {}
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+
+    def cap(self, kind: PromptKind, level: Level) -> int:
+        default = (
+            self.settings.MAX_NEW_TOKENS_REPLY if kind == 'reply'
+            else self.settings.MAX_NEW_TOKENS_FEEDBACK
+        )
+        caps = self.settings.BUDGET_LEVEL_MAX_NEW_TOKENS
+        return min(default, caps.get(f"{kind}:{level}", default))
+
+    def floor(self, kind: PromptKind) -> int:
+        if kind == 'reply':
+            return self.settings.BUDGET_MIN_TOKENS_REPLY
+        return self.settings.BUDGET_MIN_TOKENS_FEEDBACK
+
+    def max_new_tokens(
+            self,
+            redis: Redis,
+            kind: PromptKind,
+            level: str | None,
+    ) -> int:
+        lvl = normalize_level(level)
+        if not self.settings.BUDGET_ENABLED:
+            return self.cap(kind, lvl)
+        with self._lock:
+            now = time.monotonic()
+            if now - self._refreshed_at >= self.settings.BUDGET_REFRESH_S:
+                self._refreshed_at = now
+                self._refresh(redis)
+            return self._budgets.get(f"{kind}:{lvl}", self.cap(kind, lvl))
+
+    def _decode_rate(self, redis: Redis) -> float | None:
+        samples = sorted(
+            float(x) for x in redis.lrange(DECODE_RATE_KEY, 0, -1)
+        )
+        if len(samples) < MIN_RATE_SAMPLES:
+            return None
+        return samples[int(0.05 * (len(samples) - 1))]
+
+    def _refresh(self, redis: Redis) -> None:
+        try:
+            rate = self._decode_rate(redis)
+            load = load_snapshot(redis, self.settings)['queues']
+        except Exception as e:
+            logger.warning('budget: refresh failed | err=%s', e)
+            return
+
+        changed: list[str] = []
+        for kind in get_args(PromptKind):
+            est_wait_s = load[kind]['est_wait_s']
+            for level in get_args(Level):
+                key = f"{kind}:{level}"
+                cap = self.cap(kind, level)
+                budget = cap
+                if rate is not None and est_wait_s >= IDLE_WAIT_S:
+                    target_s = self.settings.BUDGET_TARGET_P95_S
+                    fit = int(max(0.0, target_s - est_wait_s) * rate)
+                    fit -= fit % BUDGET_STEP_TOKENS
+                    budget = max(min(self.floor(kind), cap), min(fit, cap))
+                old = self._budgets.get(key, cap)
+                if budget != old:
+                    logger.info(
+                        'budget: adjusted | target=%s from=%s to=%s '
+                        'est_wait_s=%s decode_tps=%s',
+                        key, old, budget, est_wait_s, rate,
+                    )
+                    changed.append(key)
+                self._budgets[key] = budget
+
+        if not changed:
+            return
+        try:
+            pipe = redis.pipeline(transaction=False)
+            pipe.hset(BUDGET_KEY, mapping=dict(self._budgets))
+            for key in changed:
+                pipe.hincrby(BUDGET_STATS, key, 1)
+            pipe.execute()
+        except Exception as e:
+            logger.warning('budget: export failed | err=%s', e)
+
+
+async def budget_stats(redis: AsyncRedis) -> dict[str, dict[str, int]]:
+    budgets = await redis.hgetall(BUDGET_KEY)
+    adjustments = await redis.hgetall(BUDGET_STATS)
+    return {
+        'max_new_tokens': {k.decode(): int(v) for k, v in budgets.items()},
+        'adjustments': {k.decode(): int(v) for k, v in adjustments.items()},
+    }
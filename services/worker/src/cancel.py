@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import logging
+
+import torch
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from transformers import StoppingCriteria
+
+logger = logging.getLogger('ai_worker.cancel')
+
+CANCEL_KEY_PREFIX = 'ai_worker:cancel:'
+CANCEL_STATS = 'ai_worker:cancel_stats'
+
+
+def cancel_key(job_id: str) -> str:
+    return f"{CANCEL_KEY_PREFIX}{job_id}"
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+async def request_cancel(
+        redis: AsyncRedis,
+        job_id: str,
+        *,
+        reason: str,
+        ttl_s: int,
+) -> None:
+    """Ask the runner to stop a job; best effort, never raises."""
+    try:
+        await redis.set(cancel_key(job_id), reason, ex=ttl_s)
+        logger.info('cancel: requested | job_id=%s reason=%s', job_id, reason)
+    except Exception as e:
+        logger.warning('cancel: request failed | job_id=%s err=%s', job_id, e)
+
+
+async def request_cancel_many(
+        redis: AsyncRedis,
+        job_ids: list[str],
+        *,
+        reason: str,
+        ttl_s: int,
+) -> None:
+    """`request_cancel` for many jobs in one round trip."""
+    if not job_ids:
+        return
+    try:
+        pipe = redis.pipeline(transaction=False)
+        for job_id in job_ids:
+            pipe.set(cancel_key(job_id), reason, ex=ttl_s)
+        await pipe.execute()
+        logger.info(
+            'cancel: requested | jobs=%s reason=%s', len(job_ids), reason,
+        )
+    except Exception as e:
+        logger.warning(
+            'cancel: request failed | jobs=%s err=%s', len(job_ids), e,
+        )
+
+
+def is_cancel_requested(redis: Redis, job_id: str) -> bool:
+    return bool(redis.exists(cancel_key(job_id)))
+
+
+async def cancel_stats(redis: AsyncRedis) -> dict[str, int]:
+    raw = await redis.hgetall(CANCEL_STATS)
+    return {k.decode(): int(v) for k, v in raw.items()}
+
+
+class CancelToken:
+    """
+    Cancel flag of one job as seen by a running generation.
+
+    `check` is called with the number of tokens generated so far and only
+    goes to Redis once every `check_every` tokens; once the flag was seen
+    it stays set.
+    """
+
+    def __init__(self, redis: Redis, job_id: str, *, check_every: int):
+        self.redis = redis
+        self.job_id = job_id
+        self.check_every = max(1, check_every)
+        self.is_set = False
+        self._checked_at = 0
+
+    def check(self, generated: int) -> bool:
+        if self.is_set or generated - self._checked_at < self.check_every:
+            return self.is_set
+        self._checked_at = generated
+        try:
+            self.is_set = is_cancel_requested(self.redis, self.job_id)
+        except Exception as e:
+            logger.warning(
+                'cancel: check failed | job_id=%s err=%s', self.job_id, e,
+            )
+        return self.is_set
+
+    def raise_if_set(self, *, generated: int, max_new_tokens: int) -> None:
+        """Count the aborted generation and raise if the job was cancelled."""
+        if not self.is_set:
+            return
+        saved = max(0, max_new_tokens - generated)
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hincrby(CANCEL_STATS, 'generations', 1)
+            pipe.hincrby(CANCEL_STATS, 'tokens_generated', generated)
+            pipe.hincrby(CANCEL_STATS, 'tokens_saved', saved)
+            pipe.execute()
+        except Exception as e:
+            logger.warning('cancel: stats failed | err=%s', e)
+        logger.info(
+            'cancel: generation aborted | job_id=%s generated=%s saved=%s',
+            self.job_id, generated, saved,
+        )
+        raise GenerationCancelled(f"job {self.job_id} was cancelled")
+
+
+class CancelStoppingCriteria(StoppingCriteria):
+    """Stops `model.generate` once the job's cancel flag is seen."""
+
+    def __init__(self, token: CancelToken, prompt_len: int):
+        self.token = token
+        self.prompt_len = prompt_len
+
+    def __call__(
+            self,
+            input_ids: torch.LongTensor,
+            scores: torch.FloatTensor,
+            **kwargs,
+    ) -> torch.BoolTensor:
+        stop = self.token.check(input_ids.shape[1] - self.prompt_len)
+        return torch.full(
+            (input_ids.shape[0],),
+            stop,
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
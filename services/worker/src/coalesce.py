@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from redis.exceptions import WatchError
+
+logger = logging.getLogger('ai_worker.coalesce')
+
+INFLIGHT_PREFIX = 'ai_worker:inflight:'
+INFLIGHT_JOB_PREFIX = 'ai_worker:inflight_job:'
+COALESCE_STATS = 'ai_worker:coalesce_stats'
+
+
+def fingerprint(
+        kind: str,
+        level: str | None,
+        message: str,
+        history: list[dict] | None = None,
+) -> str:
+    history_hash = hashlib.sha256(
+        json.dumps(history or [], ensure_ascii=False).encode('utf-8'),
+    ).hexdigest()
+    raw = json.dumps([kind, level, message, history_hash], ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def inflight_key(fp: str) -> str:
+    return f"{INFLIGHT_PREFIX}{fp}"
+
+
+def inflight_job_key(job_id: str) -> str:
+    return f"{INFLIGHT_JOB_PREFIX}{job_id}"
+
+
+class Coalescer:
+    """
+    Single-flight for identical jobs.
+
+    The first request for a fingerprint claims it with SET NX and
+    enqueues the job; requests with the same fingerprint that arrive
+    while it is queued or running wait for that job instead. Each job
+    counts its waiters, so one of them leaving does not cancel the
+    generation the others still wait for. The claim is dropped when the
+    job ends, when its last waiter leaves, or after `ttl_s`.
+    """
+
+    def __init__(self, redis: AsyncRedis, *, enabled: bool, ttl_s: int):
+        self.redis = redis
+        self.enabled = enabled
+        self.ttl_s = ttl_s
+
+    async def _join(self, job_id: str, key: str) -> None:
+        pipe = self.redis.pipeline(transaction=False)
+        job_key = inflight_job_key(job_id)
+        pipe.hincrby(job_key, 'waiters', 1)
+        pipe.hset(job_key, 'key', key)
+        pipe.expire(job_key, self.ttl_s)
+        await pipe.execute()
+
+    async def _attach(self, key: str) -> str | None:
+        """
+        Join the job `key` points at and return its id, or None when
+        there is no live job to join. WATCH makes the join atomic with
+        `leave_job`: once the last waiter left, nobody attaches again.
+        """
+        async with self.redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                existing = await pipe.get(key)
+                if existing is None:
+                    return None
+                job_id = existing.decode()
+                job_key = inflight_job_key(job_id)
+                await pipe.watch(job_key)
+                waiters = await pipe.hget(job_key, 'waiters')
+                if waiters is None or int(waiters) <= 0:
+                    return None
+                pipe.multi()
+                pipe.hincrby(job_key, 'waiters', 1)
+                pipe.expire(job_key, self.ttl_s)
+                await pipe.execute()
+            except WatchError:
+                return None
+        return job_id
+
+    async def claim(self, kind: str, fp: str, job_id: str) -> str | None:
+        """
+        None when this request should enqueue `job_id` (owning `fp` if
+        the claim went through), else the id of the in-flight job it was
+        attached to.
+        """
+        if not self.enabled:
+            return None
+        key = inflight_key(fp)
+        try:
+            # later rounds cover a claim that ended in between
+            for _ in range(3):
+                if await self.redis.set(key, job_id, nx=True, ex=self.ttl_s):
+                    await self._join(job_id, key)
+                    return None
+                existing_id = await self._attach(key)
+                if existing_id is not None:
+                    await self.redis.hincrby(COALESCE_STATS, kind, 1)
+                    logger.info(
+                        'coalesce: attached | kind=%s job_id=%s',
+                        kind,
+                        existing_id,
+                    )
+                    return existing_id
+            logger.info('coalesce: not attached, own job | kind=%s', kind)
+        except Exception as e:
+            logger.warning('coalesce: claim failed | kind=%s err=%s', kind, e)
+        return None
+
+    async def release(self, fp: str, job_id: str) -> None:
+        """Give up a claim whose job was never enqueued."""
+        if not self.enabled:
+            return
+        try:
+            await self.redis.delete(
+                inflight_key(fp), inflight_job_key(job_id),
+            )
+        except Exception as e:
+            logger.warning('coalesce: release failed | err=%s', e)
+
+
+async def leave_job(redis: AsyncRedis, job_id: str) -> int:
+    """
+    Drop one waiter of a job and return how many are left; 0 or less
+    (also for jobs that were never coalesced) means nobody waits any more
+    and no new request may attach to it.
+    """
+    job_key = inflight_job_key(job_id)
+    try:
+        pipe = redis.pipeline(transaction=False)
+        pipe.hincrby(job_key, 'waiters', -1)
+        pipe.hget(job_key, 'key')
+        left, key = await pipe.execute()
+        if left <= 0:
+            await redis.delete(job_key)
+            if key and await redis.get(key) == job_id.encode():
+                await redis.delete(key)
+        return left
+    except Exception as e:
+        logger.warning('coalesce: leave failed | job_id=%s err=%s', job_id, e)
+        return 0
+
+
+def release_inflight(job, connection: Redis) -> None:
+    """Runner side: the job ended, new requests must not attach to it."""
+    key = job.meta.get('inflight_key')
+    if not key:
+        return
+    try:
+        # after `ttl_s` the fingerprint may belong to a newer job
+        if connection.get(key) == job.id.encode():
+            connection.delete(key)
+        connection.delete(inflight_job_key(job.id))
+    except Exception as e:
+        logger.warning(
+            'coalesce: release failed | job_id=%s err=%s', job.id, e,
+        )
+
+
+async def coalesce_stats(redis: AsyncRedis) -> dict[str, int]:
+    raw = await redis.hgetall(COALESCE_STATS)
+    return {k.decode(): int(v) for k, v in raw.items()}
@@ -0,0 +1,577 @@
+from __future__ import annotations
+
+import logging
+import re
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any
+
+import torch
+from transformers import LogitsProcessor
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+from transformers import StoppingCriteria
+
+logger = logging.getLogger('ai_worker.constrained')
+
+WS = ' \t\n\r'
+HEX = '0123456789abcdefABCDEF'
+ESCAPES = '"\\/bfnrt'
+CLOSING = '"[]{},:' + WS
+
+# whitespace steps between two structural tokens; a run of whitespace
+# inside one token is one step
+MAX_WS_RUN = 1
+MAX_STRING_CHARS = 600
+# candidates checked in logit order before falling back to the full vocab
+CANDIDATE_SCAN = 256
+MAX_CANDIDATES = 32
+
+
+@dataclass(frozen=True)
+class SchemaNode:
+    kind: str
+    # object: ((name, node), ...); array: (item,); union: options
+    children: tuple = ()
+    enum: tuple[str, ...] | None = None
+
+
+def compile_schema(schema: dict[str, Any]) -> SchemaNode:
+    """
+    Compile the subset of JSON schema pydantic emits for our models:
+    objects, arrays, strings (incl. enums), null, booleans and anyOf.
+
+    Object properties are emitted in declared order, all of them.
+    """
+    defs = schema.get('$defs', {})
+
+    def build(s: dict[str, Any]) -> SchemaNode:
+        if '$ref' in s:
+            return build(defs[s['$ref'].rsplit('/', 1)[-1]])
+        if 'anyOf' in s:
+            return _union(tuple(build(o) for o in s['anyOf']))
+        if 'enum' in s or 'const' in s:
+            values = s.get('enum') or [s['const']]
+            if not all(isinstance(v, str) for v in values):
+                raise ValueError(f"only string enums are supported: {s}")
+            return SchemaNode('string', enum=tuple(values))
+
+        typ = s.get('type')
+        if typ == 'object':
+            props = s.get('properties', {})
+            return SchemaNode(
+                'object',
+                children=tuple((k, build(v)) for k, v in props.items()),
+            )
+        if typ == 'array':
+            return SchemaNode('array', children=(build(s['items']),))
+        if typ in ('string', 'null', 'boolean'):
+            return SchemaNode(typ)
+        raise ValueError(f"unsupported schema: {s}")
+
+    return build(schema)
+
+
+def _first_chars(node: SchemaNode) -> str:
+    if node.kind == 'union':
+        return ''.join(_first_chars(o) for o in node.children)
+    return {
+        'object': '{',
+        'array': '[',
+        'string': '"',
+        'null': 'n',
+        'boolean': 'tf',
+    }[node.kind]
+
+
+def _union(options: tuple[SchemaNode, ...]) -> SchemaNode:
+    seen = ''
+    for o in options:
+        first = _first_chars(o)
+        if any(c in seen for c in first):
+            raise ValueError('anyOf options must start with distinct chars')
+        seen += first
+    return SchemaNode('union', children=options)
+
+
+@lru_cache(maxsize=64)
+def _object_parts(node: SchemaNode) -> tuple:
+    parts: list[tuple] = [('lit', '{')]
+    for i, (name, child) in enumerate(node.children):
+        if i:
+            parts.append(('lit', ','))
+        parts.append(('lit', f'"{name}"'))
+        parts.append(('lit', ':'))
+        parts.append(('val', child))
+    parts.append(('lit', '}'))
+    return tuple(parts)
+
+
+@lru_cache(maxsize=256)
+def _min_len(node: SchemaNode) -> int:
+    """Characters of the shortest document `node` accepts."""
+    kind = node.kind
+    if kind == 'object':
+        return _parts_len(_object_parts(node), 0)
+    if kind == 'array':
+        return 2
+    if kind == 'string':
+        return 2 + (min(map(len, node.enum)) if node.enum else 0)
+    if kind in ('null', 'boolean'):
+        return 4
+    return min(_min_len(o) for o in node.children)
+
+
+def _parts_len(parts: tuple, i: int) -> int:
+    return sum(
+        len(arg) if typ == 'lit' else _min_len(arg) for typ, arg in parts[i:]
+    )
+
+
+@lru_cache(maxsize=4096)
+def _frame_close(frame: tuple) -> int:
+    kind = frame[0]
+    if kind == 'lit':
+        return len(frame[1]) - frame[2]
+    if kind == 'val':
+        return _min_len(frame[1])
+    if kind == 'seq':
+        return _parts_len(frame[1], frame[2])
+    if kind == 'arr':
+        return 1
+    _, enum, _, esc, text, pend = frame
+    # what is left of an escape: the char after a backslash, or the
+    # hex digits of a unicode escape; of a UTF-8 char, its last bytes
+    left = 0 if esc == 0 else 1 if esc == 1 else esc - 1
+    if pend:
+        left += _utf8_len(pend[0]) - len(pend)
+    if enum is not None:
+        left += min(len(e) - len(text) for e in enum if e.startswith(text))
+    return left + 1
+
+
+def close_len(frames: tuple) -> int:
+    """
+    Characters needed to finish the document from `frames`. Every ASCII
+    char is a token of its own, so it also bounds the tokens needed.
+    """
+    return sum(_frame_close(f) for f in frames)
+
+
+# Parser state is (frames, ws_run): an immutable stack of frames, so
+# trying a token never disturbs the state it started from.
+#   ('val', node)                       a value of `node`
+#   ('seq', parts, i)                   object parts from index i
+#   ('lit', text, pos)                  inside a fixed literal
+#   ('arr', item, phase)                phase: first | after | next
+#   ('str', enum, n, esc, text, pend)   inside a string; `pend` holds the
+#                                       bytes of an unfinished UTF-8 char
+State = tuple[tuple, int]
+
+
+def _start_lit(frames: tuple, text: str, ch: str) -> State | None:
+    if ch != text[0]:
+        return None
+    if len(text) == 1:
+        return frames, 0
+    return frames + (('lit', text, 1),), 0
+
+
+def _start(frames: tuple, node: SchemaNode, ch: str) -> State | None:
+    kind = node.kind
+    if kind == 'object':
+        return _step(frames + (('seq', _object_parts(node), 0),), 0, ch)
+    if kind == 'array':
+        if ch != '[':
+            return None
+        return frames + (('arr', node.children[0], 'first'),), 0
+    if kind == 'string':
+        if ch != '"':
+            return None
+        return frames + (('str', node.enum, 0, 0, '', b''),), 0
+    if kind == 'null':
+        return _start_lit(frames, 'null', ch)
+    if kind == 'boolean':
+        return _start_lit(frames, 'true' if ch == 't' else 'false', ch)
+    for option in node.children:
+        if ch in _first_chars(option):
+            return _start(frames, option, ch)
+    return None
+
+
+def _step_str(top: tuple, rest: tuple, ch: str) -> State | None:
+    _, enum, n, esc, text, _ = top
+    if esc == 0:
+        if ch == '"':
+            if enum is not None and text not in enum:
+                return None
+            return rest, 0
+        if ch == '\\':
+            if enum is not None:
+                return None
+            return rest + (('str', enum, n, 1, text, b''),), 0
+        if ord(ch) < 0x20:
+            return None
+        if enum is not None:
+            text += ch
+            if not any(e.startswith(text) for e in enum):
+                return None
+            return rest + (('str', enum, n + 1, 0, text, b''),), 0
+        if n >= MAX_STRING_CHARS:
+            return None
+        return rest + (('str', None, n + 1, 0, '', b''),), 0
+
+    if esc == 1:
+        if ch == 'u':
+            return rest + (('str', enum, n, 5, text, b''),), 0
+        if ch in ESCAPES:
+            return rest + (('str', enum, n + 1, 0, text, b''),), 0
+        return None
+
+    # \uXXXX: esc counts down 5, 4, 3, 2 over the hex digits
+    if ch not in HEX:
+        return None
+    return rest + (
+        ('str', enum, n, esc - 1 if esc > 2 else 0, text, b''),
+    ), 0
+
+
+def _step(frames: tuple, ws: int, ch: str) -> State | None:
+    is_ws = ch in WS
+    if not frames:
+        # the document is complete, only trailing whitespace may follow
+        return (frames, ws + 1) if is_ws and ws < MAX_WS_RUN else None
+
+    top, rest = frames[-1], frames[:-1]
+    kind = top[0]
+
+    if kind == 'lit':
+        _, text, pos = top
+        if ch != text[pos]:
+            return None
+        if pos + 1 == len(text):
+            return rest, 0
+        return rest + (('lit', text, pos + 1),), 0
+    if kind == 'str':
+        return _step_str(top, rest, ch)
+
+    # structural position; the top level of the document (before the
+    # root value and between its own parts) takes no whitespace at all
+    if is_ws:
+        if len(frames) <= 1 or ws >= MAX_WS_RUN:
+            return None
+        return frames, ws + 1
+
+    if kind == 'val':
+        return _start(rest, top[1], ch)
+    if kind == 'seq':
+        _, parts, i = top
+        # the frame is dropped as soon as its last part starts
+        nxt = rest + (('seq', parts, i + 1),) if i + 1 < len(parts) else rest
+        typ, arg = parts[i]
+        if typ == 'lit':
+            return _start_lit(nxt, arg, ch)
+        return _start(nxt, arg, ch)
+
+    _, item, phase = top
+    if ch == ']' and phase in ('first', 'after'):
+        return rest, 0
+    if phase == 'after':
+        return (rest + (('arr', item, 'next'),), 0) if ch == ',' else None
+    return _start(rest + (('arr', item, 'after'),), item, ch)
+
+
+def _utf8_len(lead: int) -> int:
+    """Length of the UTF-8 char `lead` starts, 0 if it starts none."""
+    if 0xC2 <= lead <= 0xDF:
+        return 2
+    if 0xE0 <= lead <= 0xEF:
+        return 3
+    if 0xF0 <= lead <= 0xF4:
+        return 4
+    return 0
+
+
+def _pending(frames: tuple) -> bool:
+    return bool(frames) and frames[-1][0] == 'str' and bool(frames[-1][5])
+
+
+def _step_byte(frames: tuple, ws: int, b: int) -> State | None:
+    """
+    Step over one byte of a token that is not valid UTF-8 on its own:
+    the bytes of a multi-byte char collect in the string frame until the
+    char is complete, and only then go through `_step`.
+    """
+    top = frames[-1] if frames else None
+    if top is not None and top[0] == 'str' and top[5]:
+        if b & 0xC0 != 0x80:
+            return None
+        pend = top[5] + bytes((b,))
+        if len(pend) < _utf8_len(pend[0]):
+            return frames[:-1] + (top[:5] + (pend,),), 0
+        try:
+            ch = pend.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+        return _step(frames[:-1] + (top[:5] + (b'',),), ws, ch)
+    if b < 0x80:
+        return _step(frames, ws, chr(b))
+    # a multi-byte char only ever starts inside a free string with room
+    # for one more char
+    if (
+            not _utf8_len(b) or top is None or top[0] != 'str'
+            or top[1] is not None or top[3] != 0
+            or top[2] >= MAX_STRING_CHARS
+    ):
+        return None
+    return frames[:-1] + (top[:5] + (bytes((b,)),),), 0
+
+
+def _token_bytes(tokenizer, token_id: int) -> bytes | None:
+    """Raw bytes of a byte-level or byte-fallback token, if it has them."""
+    token = tokenizer.convert_ids_to_tokens(token_id)
+    match = re.fullmatch(r'<0x([0-9A-Fa-f]{2})>', token)
+    if match:
+        return bytes((int(match.group(1), 16),))
+    decoder = getattr(
+        getattr(tokenizer, 'backend_tokenizer', None), 'decoder', None,
+    )
+    if type(decoder).__name__ != 'ByteLevel':
+        return None
+    byte_of = _byte_decoder()
+    if not all(c in byte_of for c in token):
+        return None
+    return bytes(byte_of[c] for c in token)
+
+
+@lru_cache(maxsize=1)
+def _byte_decoder() -> dict[str, int]:
+    return {c: b for b, c in bytes_to_unicode().items()}
+
+
+class TokenVocabulary:
+    """
+    Decoded text of every token id, `None` for special tokens. Tokens
+    that are only part of a UTF-8 char have no text; their raw bytes are
+    in `partial`.
+
+    `closing_ids` indexes the single-char tokens and the tokens made of
+    structural chars only. Every closing path of a document can be
+    spelled with them, so a step never has to search beyond them.
+    """
+
+    def __init__(
+            self,
+            texts: list[str | None],
+            partial: dict[int, bytes] | None = None,
+    ):
+        self.texts = texts
+        self.partial = partial or {}
+        self.closing_ids = torch.tensor([
+            i for i, t in enumerate(texts)
+            if t is not None and (len(t) == 1 or all(c in CLOSING for c in t))
+        ] + [i for i, raw in self.partial.items() if len(raw) == 1],
+            dtype=torch.long,
+        )
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer) -> TokenVocabulary:
+        t0 = time.monotonic()
+        # decode after an anchor so leading spaces of pieces survive
+        anchor = tokenizer.encode('0', add_special_tokens=False)
+        anchor_text = tokenizer.decode(anchor)
+        special = set(tokenizer.all_special_ids)
+        special.update(
+            i for i, t in tokenizer.added_tokens_decoder.items() if t.special
+        )
+
+        ids = list(range(len(tokenizer)))
+        decoded = tokenizer.batch_decode(
+            [anchor + [i] for i in ids],
+            skip_special_tokens=False,
+            clean_up_tokenization_spaces=False,
+        )
+        texts: list[str | None] = []
+        partial: dict[int, bytes] = {}
+        for i, text in zip(ids, decoded):
+            piece = text[len(anchor_text):]
+            if i in special or not piece:
+                texts.append(None)
+            elif '�' in piece:
+                texts.append(None)
+                raw = _token_bytes(tokenizer, i)
+                if raw:
+                    partial[i] = raw
+            else:
+                texts.append(piece)
+        vocab = cls(texts, partial)
+
+        logger.info(
+            'constrained: vocabulary ready | size=%s usable=%s partial=%s '
+            'closing=%s took_s=%.1f',
+            len(texts),
+            sum(t is not None for t in texts),
+            len(partial),
+            len(vocab.closing_ids),
+            time.monotonic() - t0,
+        )
+        return vocab
+
+    def text(self, token_id: int) -> str | None:
+        if 0 <= token_id < len(self.texts):
+            return self.texts[token_id]
+        return None
+
+
+class JsonConstraint:
+    """
+    Per-request decoding constraint: only tokens that keep the output a
+    valid prefix of a schema document survive, and `done` turns true the
+    moment the top-level value closes.
+
+    With `max_new_tokens` a token must also leave enough of the budget to
+    close every open string, array and object, so the output runs into
+    its closing path instead of being cut off mid-document.
+    """
+
+    def __init__(
+            self,
+            root: SchemaNode,
+            vocab: TokenVocabulary,
+            *,
+            eos_token_ids: set[int],
+            max_new_tokens: int | None = None,
+    ):
+        self.vocab = vocab
+        self.eos_token_ids = sorted(eos_token_ids)
+        self.max_new_tokens = max_new_tokens
+        self._state: State = ((('val', root),), 0)
+        self._fed = 0
+
+    @property
+    def done(self) -> bool:
+        return not self._state[0]
+
+    def _feed(self, state: State, token_id: int) -> State | None:
+        frames, ws = state
+        text = self.vocab.text(token_id)
+        if text is None:
+            raw = self.vocab.partial.get(token_id)
+            if raw is None:
+                return None
+            for b in raw:
+                nxt = _step_byte(frames, ws, b)
+                if nxt is None:
+                    return None
+                frames, ws = nxt
+            return frames, ws
+        if _pending(frames):
+            # a whole char cannot follow half of one
+            return None
+        prev_ws = False
+        for ch in text:
+            is_ws = ch in WS
+            # `ws` is only non-zero after structural whitespace, so this
+            # never skips whitespace inside a string
+            if is_ws and prev_ws and ws:
+                continue
+            nxt = _step(frames, ws, ch)
+            if nxt is None:
+                return None
+            frames, ws = nxt
+            prev_ws = is_ws
+        return frames, ws
+
+    def advance(self, token_id: int) -> None:
+        self._fed += 1
+        state = self._feed(self._state, token_id)
+        if state is None:
+            logger.debug('constrained: off-schema token | id=%s', token_id)
+            return
+        self._state = state
+
+    def sync(self, generated: list[int]) -> None:
+        """Advance over the tokens appended since the last call."""
+        for tok in generated[self._fed:]:
+            self.advance(tok)
+
+    def _fits(self, state: State) -> bool:
+        if self.max_new_tokens is None:
+            return True
+        # the tokens left once this one is emitted
+        left = self.max_new_tokens - self._fed - 1
+        return close_len(state[0]) <= left
+
+    def _candidates(self, logits: torch.Tensor) -> list[int]:
+        k = min(CANDIDATE_SCAN, logits.shape[-1])
+        order = logits.topk(k).indices.tolist()
+        found = []
+        # schema-valid but over budget: used only when nothing fits, so a
+        # budget too small for any document still decodes like before
+        loose = []
+        for scan in (order, None):
+            if scan is None:
+                # nothing fitting near the top, which is the rule once
+                # only the closing path fits the budget
+                ids = self.vocab.closing_ids.to(logits.device)
+                scan = ids[logits[ids].argsort(descending=True)].tolist()
+            for tok in scan:
+                state = self._feed(self._state, tok)
+                if state is None:
+                    continue
+                if self._fits(state):
+                    found.append(tok)
+                    if len(found) >= MAX_CANDIDATES:
+                        return found
+                elif len(loose) < MAX_CANDIDATES:
+                    loose.append(tok)
+            if found:
+                return found
+        return loose
+
+    def mask(self, logits: torch.Tensor) -> torch.Tensor:
+        """Mask one row of logits down to the schema-valid tokens."""
+        allowed = [] if self.done else self._candidates(logits)
+        if not allowed:
+            allowed = self.eos_token_ids
+        idx = torch.tensor(allowed, device=logits.device)
+        out = torch.full_like(logits, float('-inf'))
+        out[idx] = logits[idx]
+        return out
+
+
+class JsonLogitsProcessor(LogitsProcessor):
+    """`model.generate` adapter of `JsonConstraint` (batch size 1)."""
+
+    def __init__(self, constraint: JsonConstraint, prompt_len: int):
+        self.constraint = constraint
+        self.prompt_len = prompt_len
+
+    def __call__(
+            self,
+            input_ids: torch.LongTensor,
+            scores: torch.FloatTensor,
+    ) -> torch.FloatTensor:
+        self.constraint.sync(input_ids[0, self.prompt_len:].tolist())
+        scores[0] = self.constraint.mask(scores[0])
+        return scores
+
+
+class JsonStoppingCriteria(StoppingCriteria):
+    def __init__(self, constraint: JsonConstraint, prompt_len: int):
+        self.constraint = constraint
+        self.prompt_len = prompt_len
+
+    def __call__(
+            self,
+            input_ids: torch.LongTensor,
+            scores: torch.FloatTensor,
+            **kwargs,
+    ) -> torch.BoolTensor:
+        self.constraint.sync(input_ids[0, self.prompt_len:].tolist())
+        return torch.full(
+            (input_ids.shape[0],),
+            self.constraint.done,
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
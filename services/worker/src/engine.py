@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import random
+import time
+from abc import ABC
+from abc import abstractmethod
+from collections.abc import Callable
+
+from src.cancel import CancelToken
+from src.metrics import record_decode
+from src.settings import Settings
+from src.token_budget import TokenCounter
+from src.token_budget import WordCounter
+
+logger = logging.getLogger('ai_worker.engine')
+
+
+class InferenceEngine(ABC):
+    """
+    What the tasks and the service need from a generation backend.
+
+    `token_counter` measures history messages for the token budget and
+    `concurrent` tells whether calls from several threads are served
+    together (so a turn can submit reply and feedback at once). A set
+    `cancel` token makes generation raise `GenerationCancelled`; without
+    `max_new_tokens` the MAX_NEW_TOKENS_* settings apply.
+    """
+
+    settings: Settings
+    token_counter: TokenCounter | WordCounter
+    concurrent: bool = False
+
+    @abstractmethod
+    def generate_reply(
+            self,
+            *,
+            system_prompt: str,
+            history: list[dict],
+            user_message: str,
+            session_key: str | None = None,
+            on_text: Callable[[str], None] | None = None,
+            cancel: CancelToken | None = None,
+            stats: dict | None = None,
+            max_new_tokens: int | None = None,
+    ) -> str:
+        ...
+
+    @abstractmethod
+    def generate_feedback_raw(
+            self,
+            *,
+            system_prompt: str,
+            user_message: str,
+            cancel: CancelToken | None = None,
+            stats: dict | None = None,
+            max_new_tokens: int | None = None,
+    ) -> str:
+        ...
+
+    def forget_session(self, session_key: str | None) -> None:
+        pass
+
+    def warm_caches(self) -> None:
+        """Build the caches a first request would otherwise pay for."""
+
+    def share_memory(self) -> None:
+        """Move weights to shared memory before the supervisor forks."""
+
+    def close(self) -> None:
+        """
+        Release threads and caches once the registry evicted the engine;
+        calls already running are allowed to finish.
+        """
+
+
+STUB_WORDS = (
+    'that sounds great tell me more about your day what did you do '
+    'after work i like hearing about new places and people do you '
+    'enjoy reading books or watching films in english'
+).split()
+
+
+class StubEngine(InferenceEngine):
+    """
+    Deterministic engine without a model, for load tests of everything
+    around generation. The same input always gives the same output and
+    each emitted word costs `STUB_TOKEN_LATENCY_MS`.
+    """
+
+    concurrent = True
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self.token_counter = WordCounter()
+        self.latency_s = max(0, settings.STUB_TOKEN_LATENCY_MS) / 1000
+        logger.info(
+            'stub engine: ready | token_latency_ms=%s reply_words=%s',
+            settings.STUB_TOKEN_LATENCY_MS,
+            settings.STUB_REPLY_WORDS,
+        )
+
+    @staticmethod
+    def _seed(*parts: str) -> int:
+        digest = hashlib.sha256('\0'.join(parts).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big')
+
+    def _pause(self, n_words: int) -> None:
+        if self.latency_s:
+            time.sleep(self.latency_s * n_words)
+
+    def generate_reply(
+            self,
+            *,
+            system_prompt: str,
+            history: list[dict],
+            user_message: str,
+            session_key: str | None = None,
+            on_text: Callable[[str], None] | None = None,
+            cancel: CancelToken | None = None,
+            stats: dict | None = None,
+            max_new_tokens: int | None = None,
+    ) -> str:
+        seed = self._seed(
+            system_prompt,
+            json.dumps(history, ensure_ascii=False),
+            user_message,
+        )
+        n_words = min(
+            self.settings.STUB_REPLY_WORDS,
+            max_new_tokens or self.settings.MAX_NEW_TOKENS_REPLY,
+        )
+
+        rng = random.Random(seed)
+        words = [rng.choice(STUB_WORDS) for _ in range(max(1, n_words))]
+        words[0] = words[0].capitalize()
+        words[-1] += '.'
+
+        started = time.perf_counter()
+        first_word_at = None
+        for i, word in enumerate(words):
+            if cancel is not None and cancel.check(i):
+                cancel.raise_if_set(generated=i, max_new_tokens=len(words))
+            self._pause(1)
+            first_word_at = first_word_at or time.perf_counter()
+            if on_text is not None:
+                on_text(word if i == 0 else ' ' + word)
+        record_decode(
+            stats,
+            started=started,
+            first_token_at=first_word_at,
+            new_tokens=len(words),
+        )
+        return ' '.join(words)
+
+    def generate_feedback_raw(
+            self,
+            *,
+            system_prompt: str,
+            user_message: str,
+            cancel: CancelToken | None = None,
+            stats: dict | None = None,
+            max_new_tokens: int | None = None,
+    ) -> str:
+        text = user_message.strip()
+        items = []
+        if text[:1].islower():
+            items.append({
+                'user_text': text.split()[0],
+                'error_type': 'style',
+                'explanation': 'Start the sentence with a capital letter.',
+                'text_corrected': text.split()[0].capitalize(),
+            })
+
+        started = time.perf_counter()
+        self._pause(8 + 24 * len(items))
+        record_decode(
+            stats,
+            started=started,
+            first_token_at=started,
+            new_tokens=8 + 24 * len(items),
+        )
+        return json.dumps(
+            {
+                'language_feedback': {
+                    'items': items,
+                    'overall_comment': (
+                        'Nice! Just fix these small points.'
+                        if items else 'No mistakes — great job!'
+                    ),
+                },
+            },
+            ensure_ascii=False,
+        )
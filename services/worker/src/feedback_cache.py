@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import time
+from collections.abc import Callable
+from typing import Any
+
+from redis.asyncio import Redis as AsyncRedis
+from src.prompts import get_prompt
+
+logger = logging.getLogger('ai_worker.feedback_cache')
+
+FEEDBACK_CACHE_PREFIX = 'ai_worker:feedback:'
+FEEDBACK_CACHE_INDEX = 'ai_worker:feedback_index'
+FEEDBACK_CACHE_STATS = 'ai_worker:feedback_stats'
+
+
+def normalize_message(text: str) -> str:
+    # Only whitespace is folded: case and punctuation are exactly what the
+    # feedback is about, so "i am fine" and "I am fine." are different.
+    return ' '.join((text or '').split())
+
+
+class FeedbackCache:
+    """
+    Content-addressed cache of `language_feedback` results.
+
+    The key is a hash of the normalized message, the level, the feedback
+    prompt and the id of the model the level is routed to, so editing a
+    prompt or swapping a model never serves stale feedback. Entries
+    expire after `ttl_s`; a sorted set by insertion time keeps at most
+    `max_entries` of them.
+    """
+
+    def __init__(
+            self,
+            redis: AsyncRedis,
+            *,
+            model_id_for: Callable[[str | None], str],
+            ttl_s: int,
+            max_entries: int,
+    ):
+        self.redis = redis
+        self.model_id_for = model_id_for
+        self.ttl_s = ttl_s
+        self.max_entries = max(0, max_entries)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl_s > 0
+
+    def key(self, level: str | None, message: str) -> str:
+        prompt = get_prompt(level, kind='feedback')
+        prompt_version = hashlib.sha1(prompt.encode('utf-8')).hexdigest()
+        raw = json.dumps(
+            [
+                self.model_id_for(level),
+                prompt_version,
+                level,
+                normalize_message(message),
+            ],
+            ensure_ascii=False,
+        )
+        digest = hashlib.sha256(raw.encode('utf-8')).hexdigest()
+        return f"{FEEDBACK_CACHE_PREFIX}{digest}"
+
+    async def _count(self, field: str) -> dict[str, int]:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hincrby(FEEDBACK_CACHE_STATS, field, 1)
+        pipe.hgetall(FEEDBACK_CACHE_STATS)
+        _, stats = await pipe.execute()
+        return {
+            'cache_hits': int(stats.get(b'hits', 0)),
+            'cache_misses': int(stats.get(b'misses', 0)),
+        }
+
+    async def get(self, key: str) -> tuple[dict[str, Any] | None, dict]:
+        """Return (cached language_feedback or None, meta with counters)."""
+        try:
+            stored = await self.redis.get(key)
+            counters = await self._count('hits' if stored else 'misses')
+        except Exception as e:
+            logger.warning('feedback cache: get failed | err=%s', e)
+            return None, {'cache': 'error'}
+
+        meta = {'cache': 'hit' if stored else 'miss', **counters}
+        if stored is None:
+            return None, meta
+        return json.loads(stored), meta
+
+    async def put(self, key: str, language_feedback: dict[str, Any]) -> None:
+        now = time.time()
+        data = json.dumps(language_feedback, ensure_ascii=False)
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.set(key, data, ex=self.ttl_s)
+            pipe.zadd(FEEDBACK_CACHE_INDEX, {key: now})
+            # entries that already expired on their own
+            pipe.zremrangebyscore(FEEDBACK_CACHE_INDEX, 0, now - self.ttl_s)
+            pipe.zcard(FEEDBACK_CACHE_INDEX)
+            *_, size = await pipe.execute()
+
+            excess = size - self.max_entries
+            if excess > 0:
+                oldest = await self.redis.zpopmin(FEEDBACK_CACHE_INDEX, excess)
+                if oldest:
+                    await self.redis.delete(*(k for k, _ in oldest))
+                logger.info('feedback cache: evicted | count=%s', len(oldest))
+        except Exception as e:
+            logger.warning('feedback cache: put failed | err=%s', e)
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from typing import Any
+
+from redis.asyncio import Redis as AsyncRedis
+from rq import Queue
+from rq.job import Job
+from src.notify import done_key
+from src.notify import JobNotifier
+from src.utils import stream_key
+
+logger = logging.getLogger('ai_worker.jobs')
+
+# statuses of jobs that will not change any more
+JOB_ENDED = ('finished', 'failed', 'expired', 'canceled', 'stopped')
+
+
+def _done_status(payload: dict[str, Any]) -> dict[str, Any]:
+    status: dict[str, Any] = {'status': payload.get('status')}
+    if 'result' in payload:
+        status['result'] = payload['result']
+    if payload.get('error'):
+        status['error'] = payload['error']
+    return status
+
+
+async def job_statuses(
+        redis: AsyncRedis,
+        job_ids: list[str],
+        *,
+        progress: bool = False,
+) -> dict[str, dict[str, Any]]:
+    """
+    Status of many jobs in two round trips.
+
+    Ended jobs carry their result (or error) from the completion record
+    the runner leaves for waiters. Queued jobs get their position in the
+    queue and, with `progress`, running ones the reply text streamed so
+    far. Ids Redis knows nothing about are 'unknown'.
+    """
+    pipe = redis.pipeline(transaction=False)
+    for job_id in job_ids:
+        pipe.get(done_key(job_id))
+        pipe.hmget(Job.key_for(job_id), 'status', 'origin')
+    rows = await pipe.execute()
+
+    statuses: dict[str, dict[str, Any]] = {}
+    pending: list[tuple[str, str, str]] = []
+    for i, job_id in enumerate(job_ids):
+        stored, (status, origin) = rows[2 * i], rows[2 * i + 1]
+        if stored is not None:
+            statuses[job_id] = _done_status(json.loads(stored))
+        elif status is None:
+            statuses[job_id] = {'status': 'unknown'}
+        else:
+            statuses[job_id] = {'status': status.decode()}
+            pending.append((job_id, status.decode(), (origin or b'').decode()))
+
+    if not pending:
+        return statuses
+
+    pipe = redis.pipeline(transaction=False)
+    for job_id, status, origin in pending:
+        if status == 'queued':
+            pipe.lpos(Queue.redis_queue_namespace_prefix + origin, job_id)
+        elif progress:
+            pipe.xrange(stream_key(job_id))
+    results = iter(await pipe.execute())
+    for job_id, status, _ in pending:
+        if status == 'queued':
+            position = next(results)
+            if position is not None:
+                statuses[job_id]['queue_position'] = position
+        elif progress:
+            text = ''.join(
+                fields.get(b'text', b'').decode()
+                for _, fields in next(results)
+                if fields.get(b'type') == b'chunk'
+            )
+            statuses[job_id]['progress'] = {'text': text}
+    return statuses
+
+
+async def wait_any(
+        notifier: JobNotifier,
+        job_ids: list[str],
+        *,
+        timeout_s: float,
+) -> None:
+    """Return once any of the jobs ends or after `timeout_s`."""
+    if not job_ids or timeout_s <= 0:
+        return
+    waiters = [
+        asyncio.ensure_future(notifier.wait(job_id, timeout_s=timeout_s))
+        for job_id in job_ids
+    ]
+    try:
+        await asyncio.wait(
+            waiters, timeout=timeout_s, return_when=asyncio.FIRST_COMPLETED,
+        )
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+        # collect the cancellations and timeouts nobody awaited
+        await asyncio.gather(*waiters, return_exceptions=True)
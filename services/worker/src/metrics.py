@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import logging
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+import torch
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from transformers import StoppingCriteria
+
+logger = logging.getLogger('ai_worker.metrics')
+
+HIST_KEY_PREFIX = 'ai_worker:hist:'
+
+SECONDS_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+)
+RATE_BUCKETS = (1.0, 2.0, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0, 320.0)
+STARTUP_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0)
+
+# name -> (help, buckets)
+HISTOGRAMS: dict[str, tuple[str, tuple[float, ...]]] = {
+    'ai_worker_queue_wait_seconds': (
+        'Time a job spent queued before a runner started it.',
+        SECONDS_BUCKETS,
+    ),
+    'ai_worker_stage_seconds': (
+        'Time spent in each stage of a generation.',
+        SECONDS_BUCKETS,
+    ),
+    'ai_worker_ttft_seconds': (
+        'Enqueue to first generated token.',
+        SECONDS_BUCKETS,
+    ),
+    'ai_worker_decode_tokens_per_second': (
+        'Decode throughput of a single generation.',
+        RATE_BUCKETS,
+    ),
+    'ai_worker_startup_seconds': (
+        'Time a runner spent on each startup phase (load, prefix, warmup).',
+        STARTUP_BUCKETS,
+    ),
+}
+
+
+@contextmanager
+def stage(stats: dict | None, name: str) -> Iterator[None]:
+    """Time a block into `stats['stages_ms'][name]`; no-op without stats."""
+    if stats is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages = stats.setdefault('stages_ms', {})
+        stages[name] = round((time.perf_counter() - t0) * 1000, 1)
+
+
+def record_decode(
+        stats: dict | None,
+        *,
+        started: float,
+        first_token_at: float | None,
+        new_tokens: int,
+) -> None:
+    """
+    Split a generation that started at `started` (perf_counter) into
+    prefill (up to the first token) and decode, plus tokens/sec.
+    """
+    if stats is None:
+        return
+    end = time.perf_counter()
+    first = first_token_at if first_token_at is not None else end
+    stages = stats.setdefault('stages_ms', {})
+    stages['prefill'] = round((first - started) * 1000, 1)
+    stages['decode'] = round((end - first) * 1000, 1)
+    stats['new_tokens'] = new_tokens
+    decode_s = end - first
+    if new_tokens > 1 and decode_s > 0:
+        stats['tokens_per_s'] = round((new_tokens - 1) / decode_s, 1)
+
+
+class FirstTokenTimer(StoppingCriteria):
+    """Never stops generation; notes when the first token was produced."""
+
+    def __init__(self):
+        self.first_token_at: float | None = None
+
+    def __call__(
+            self,
+            input_ids: torch.LongTensor,
+            scores: torch.FloatTensor,
+            **kwargs,
+    ) -> torch.BoolTensor:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        return torch.zeros(
+            (input_ids.shape[0],), dtype=torch.bool, device=input_ids.device,
+        )
+
+
+def _labels(**labels: str) -> str:
+    return ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+
+
+def _fmt(le: float) -> str:
+    return repr(float(le))
+
+
+def observe(
+        redis: Redis,
+        samples: list[tuple[str, dict[str, str], float]],
+) -> None:
+    """Add (histogram, labels, value) samples in one round trip."""
+    pipe = redis.pipeline(transaction=False)
+    for name, labels, value in samples:
+        key = f"{HIST_KEY_PREFIX}{name}"
+        lbl = _labels(**labels)
+        for le in HISTOGRAMS[name][1]:
+            if value <= le:
+                pipe.hincrby(key, f"{lbl}|{_fmt(le)}", 1)
+        pipe.hincrby(key, f"{lbl}|count", 1)
+        pipe.hincrbyfloat(key, f"{lbl}|sum", value)
+    pipe.execute()
+
+
+def generation_samples(
+        kind: str,
+        stats: dict,
+) -> list[tuple[str, dict[str, str], float]]:
+    samples = []
+    for name, ms in (stats.get('stages_ms') or {}).items():
+        samples.append((
+            'ai_worker_stage_seconds',
+            {'kind': kind, 'stage': name},
+            ms / 1000,
+        ))
+    if 'ttft_ms' in stats:
+        samples.append((
+            'ai_worker_ttft_seconds',
+            {'kind': kind},
+            stats['ttft_ms'] / 1000,
+        ))
+    if 'tokens_per_s' in stats:
+        samples.append((
+            'ai_worker_decode_tokens_per_second',
+            {'kind': kind},
+            stats['tokens_per_s'],
+        ))
+    return samples
+
+
+async def render_histograms(redis: AsyncRedis) -> list[str]:
+    """Prometheus text exposition of every histogram stored in Redis."""
+    lines: list[str] = []
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        raw = await redis.hgetall(f"{HIST_KEY_PREFIX}{name}")
+        series: dict[str, dict[str, str]] = {}
+        for field, value in raw.items():
+            lbl, _, part = field.decode().rpartition('|')
+            series.setdefault(lbl, {})[part] = value.decode()
+
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for lbl, parts in sorted(series.items()):
+            sep = ',' if lbl else ''
+            for le in buckets:
+                count = parts.get(_fmt(le), '0')
+                lines.append(
+                    f'{name}_bucket{{{lbl}{sep}le="{_fmt(le)}"}} {count}',
+                )
+            count = parts.get('count', '0')
+            lines.append(f'{name}_bucket{{{lbl}{sep}le="+Inf"}} {count}')
+            lines.append(f"{name}_sum{{{lbl}}} {parts.get('sum', '0')}")
+            lines.append(f"{name}_count{{{lbl}}} {count}")
+    return lines
+
+
+def render_counters(
+        name: str,
+        help_text: str,
+        values: dict[str, int | float],
+        *,
+        label: str,
+        kind: str = 'counter',
+) -> list[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for key, value in sorted(values.items()):
+        lines.append(f'{name}{{{label}="{key}"}} {value}')
+    return lines
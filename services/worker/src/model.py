@@ -1,19 +1,57 @@
 from __future__ import annotations
 
 import logging
+import threading
+import time
+from collections.abc import Callable
 
 import torch
+from src.batching import BatchScheduler
+from src.batching import GenerationRequest
+from src.budget import SentenceStopCriteria
+from src.budget import sentence_end_ids
+from src.budget import soft_limit
+from src.cancel import CancelStoppingCriteria
+from src.cancel import CancelToken
+from src.constrained import compile_schema
+from src.constrained import JsonConstraint
+from src.constrained import JsonLogitsProcessor
+from src.constrained import JsonStoppingCriteria
+from src.constrained import SchemaNode
+from src.constrained import TokenVocabulary
+from src.engine import InferenceEngine
+from src.engine import StubEngine
+from src.metrics import FirstTokenTimer
+from src.metrics import record_decode
+from src.metrics import stage
+from src.prefix_cache import copy_cache
+from src.prefix_cache import PrefixCache
+from src.prefix_cache import PrefixEntry
+from src.prompts import all_prompts
+from src.schemas import FeedbackEnvelope
+from src.session_cache import SessionCache
+from src.speculative import acceptance_stats
+from src.speculative import DraftModel
+from src.speculative import load_draft_model
+from src.speculative import VerifyStepCounter
 from src.settings import Settings
+from src.streaming import TextChunker
+from src.streaming import TokenCallbackStreamer
+from src.token_budget import TokenCounter
 from transformers import AutoModelForCausalLM
 from transformers import AutoTokenizer
 from transformers import BitsAndBytesConfig
+from transformers import DynamicCache
+from transformers import LogitsProcessorList
+from transformers import StoppingCriteria
+from transformers import StoppingCriteriaList
 
 logger = logging.getLogger('ai_worker.model')
 
 
-class AIWorkerModel:
+class AIWorkerModel(InferenceEngine):
     """
-    Loads and holds the LLM + tokenizer once per process.
+    HF engine: loads and holds the LLM + tokenizer once per process.
     Provides two generation modes:
       - reply: natural conversation text
       - feedback_raw: expects JSON text
@@ -31,16 +69,68 @@ class AIWorkerModel:
 
         self.tokenizer = self._load_tokenizer()
         self.model = self._load_model()
+        self.model.eval()
 
         if self.tokenizer.pad_token_id is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
         if getattr(self.model.config, 'pad_token_id', None) is None:
             self.model.config.pad_token_id = self.tokenizer.pad_token_id
 
+        self.token_counter = TokenCounter(
+            self.tokenizer,
+            max_entries=self.settings.TOKEN_COUNT_CACHE_SIZE,
+        )
+
+        self.scheduler: BatchScheduler | None = None
+        if self.settings.BATCH_MAX_SIZE > 1:
+            self.scheduler = BatchScheduler(
+                self.model,
+                pad_token_id=self.tokenizer.pad_token_id,
+                eos_token_ids=self._eos_token_ids(),
+                max_batch_size=self.settings.BATCH_MAX_SIZE,
+                wait_ms=self.settings.BATCH_WAIT_MS,
+            )
+
+        self.prefix_cache: PrefixCache | None = None
+        if self.settings.PREFIX_CACHE_MAX_MB > 0:
+            self.prefix_cache = PrefixCache(
+                self.model,
+                self.tokenizer,
+                max_mb=self.settings.PREFIX_CACHE_MAX_MB,
+            )
+
+        self.session_cache: SessionCache | None = None
+        if self.settings.SESSION_CACHE_MAX_TOKENS > 0:
+            self.session_cache = SessionCache(
+                max_tokens=self.settings.SESSION_CACHE_MAX_TOKENS,
+            )
+
+        self.draft: DraftModel | None = load_draft_model(
+            self.settings, len(self.tokenizer),
+        )
+        # assisted generation is single-sequence: one at a time
+        self._draft_lock = threading.Lock()
+
+        self.vocab = TokenVocabulary.from_tokenizer(self.tokenizer)
+        self.sentence_end_ids = sentence_end_ids(self.vocab.texts)
+
+        self.feedback_schema: SchemaNode | None = None
+        if self.settings.FEEDBACK_CONSTRAINED:
+            self.feedback_schema = compile_schema(
+                FeedbackEnvelope.model_json_schema(),
+            )
+
         logger.info(
-            'model: ready | device=%s pad_token_id=%s',
+            'model: ready | device=%s pad_token_id=%s batching=%s '
+            'prefix_cache=%s session_cache=%s constrained_feedback=%s '
+            'draft_model=%s',
             getattr(self.model, 'device', None),
             self.tokenizer.pad_token_id,
+            self.scheduler is not None,
+            self.prefix_cache is not None,
+            self.session_cache is not None,
+            self.feedback_schema is not None,
+            self.draft.model_id if self.draft else None,
         )
 
     def _load_tokenizer(self):
@@ -98,6 +188,45 @@ class AIWorkerModel:
         logger.info('model: loaded (fp) | model_id=%s', model_id)
         return model
 
+    @property
+    def concurrent(self) -> bool:
+        return self.scheduler is not None
+
+    def warm_caches(self) -> None:
+        # not in __init__: the supervisor loads with one thread before
+        # fork, and a prefill of every system prompt belongs to the
+        # children, on their own threads
+        if self.prefix_cache is not None:
+            self.prefix_cache.warm(all_prompts())
+
+    def share_memory(self) -> None:
+        self.model.share_memory()
+
+    def close(self) -> None:
+        # a call that got this engine before the eviction still works, on
+        # the single-sequence path
+        scheduler, self.scheduler = self.scheduler, None
+        if scheduler is not None:
+            scheduler.close()
+        if self.prefix_cache is not None:
+            self.prefix_cache.clear()
+        if self.session_cache is not None:
+            self.session_cache.clear()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logger.info('model: closed | model_id=%s', self.settings.MODEL_ID)
+
+    def _eos_token_ids(self) -> set[int]:
+        ids = getattr(self.model.generation_config, 'eos_token_id', None)
+        if ids is None:
+            ids = []
+        elif isinstance(ids, int):
+            ids = [ids]
+        eos = set(ids)
+        if self.tokenizer.eos_token_id is not None:
+            eos.add(self.tokenizer.eos_token_id)
+        return eos
+
     def _build_chat_text(
             self, messages: list[dict[str, str]],
     ):
@@ -110,6 +239,123 @@ class AIWorkerModel:
         inputs = self.tokenizer(chat_text, return_tensors='pt')
         return {k: v.to(self.model.device) for k, v in inputs.items()}
 
+    def _match_prefix(
+            self,
+            system_prompt: str,
+            inputs: dict[str, torch.Tensor],
+            session_key: str | None = None,
+    ) -> PrefixEntry | None:
+        ids = inputs['input_ids'][0].tolist()
+
+        best: PrefixEntry | None = None
+        if self.prefix_cache is not None:
+            best = self.prefix_cache.match(system_prompt, ids)
+        if session_key and self.session_cache is not None:
+            hit = self.session_cache.lookup(session_key, ids)
+            if hit is not None and (
+                best is None or len(hit.ids) > len(best.ids)
+            ):
+                best = hit
+        return best
+
+    def forget_session(self, session_key: str | None) -> None:
+        if session_key and self.session_cache is not None:
+            self.session_cache.invalidate(session_key)
+
+    def _remember_session(
+            self,
+            session_key: str | None,
+            seq_ids: list[int],
+            cache: DynamicCache | None,
+    ) -> None:
+        if not session_key or self.session_cache is None or cache is None:
+            return
+        covered = cache.get_seq_length()
+        self.session_cache.store(session_key, seq_ids[:covered], cache)
+
+    @staticmethod
+    def _start_cache(
+            prefix: PrefixEntry | None,
+            keep_cache: bool,
+    ) -> DynamicCache | None:
+        """KV cache a single-sequence generate starts from."""
+        if prefix is not None:
+            return copy_cache(prefix.cache)
+        return DynamicCache() if keep_cache else None
+
+    def _try_speculative(
+            self,
+            inputs: dict[str, torch.Tensor],
+            *,
+            max_new_tokens: int,
+            temperature: float,
+            top_p: float,
+            on_token: Callable[[int], None] | None,
+            criteria: list[StoppingCriteria],
+            cache: DynamicCache | None,
+            stats: dict | None,
+    ) -> torch.Tensor | None:
+        """
+        Assisted generation with the draft model, or None when it is off
+        or busy. Under load the batching scheduler wins, so the draft is
+        only used while the batch is idle.
+        """
+        if self.draft is None:
+            return None
+        scheduler = self.scheduler
+        if scheduler is not None and not scheduler.idle:
+            return None
+        if not self._draft_lock.acquire(blocking=False):
+            return None
+
+        try:
+            # a failing call elsewhere may drop self.draft at any time
+            draft = self.draft
+            if draft is None:
+                return None
+            counter = VerifyStepCounter()
+            calls_before = draft.calls
+            extra = {}
+            if cache is not None:
+                extra['past_key_values'] = cache
+            if on_token is not None:
+                extra['streamer'] = TokenCallbackStreamer(on_token)
+
+            out_ids = self.model.generate(
+                **inputs,
+                **extra,
+                assistant_model=draft.model,
+                stopping_criteria=StoppingCriteriaList([counter, *criteria]),
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+        except Exception as e:
+            # a streamed reply may already be half sent: only disable the
+            # draft for the next requests and let this one fail normally
+            if on_token is not None:
+                raise
+            logger.warning(
+                'draft model: assisted generation failed, disabled | err=%s',
+                e,
+            )
+            self.draft = None
+            return None
+        finally:
+            self._draft_lock.release()
+
+        spec = acceptance_stats(
+            draft,
+            new_tokens=out_ids.shape[1] - inputs['input_ids'].shape[1],
+            verify_steps=counter.steps,
+            proposed=draft.calls - calls_before,
+        )
+        logger.debug('draft model: done | %s', spec)
+        if stats is not None:
+            stats['speculative'] = spec
+        return out_ids
+
     @torch.no_grad()
     def _generate(
         self,
@@ -118,14 +364,127 @@ class AIWorkerModel:
         max_new_tokens: int,
         temperature: float,
         top_p: float,
+        prefix: PrefixEntry | None = None,
+        session_key: str | None = None,
+        on_token: Callable[[int], None] | None = None,
+        constraint: JsonConstraint | None = None,
+        speculative: bool = False,
+        cancel: CancelToken | None = None,
+        soft_max_new_tokens: int | None = None,
+        stats: dict | None = None,
     ) -> torch.Tensor:
-        return self.model.generate(
+        prompt_len = inputs['input_ids'].shape[1]
+        started = time.perf_counter()
+        first_token = FirstTokenTimer()
+        criteria: list[StoppingCriteria] = [first_token]
+        if cancel is not None:
+            criteria.append(CancelStoppingCriteria(cancel, prompt_len))
+        if soft_max_new_tokens is not None:
+            criteria.append(SentenceStopCriteria(
+                self.sentence_end_ids, prompt_len, soft_max_new_tokens,
+            ))
+
+        keep_cache = bool(session_key) and self.session_cache is not None
+
+        if speculative:
+            spec_cache = self._start_cache(prefix, keep_cache)
+            out_ids = self._try_speculative(
+                inputs,
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                on_token=on_token,
+                criteria=criteria,
+                cache=spec_cache,
+                stats=stats,
+            )
+            if out_ids is not None:
+                if cancel is not None:
+                    cancel.raise_if_set(
+                        generated=out_ids.shape[1] - prompt_len,
+                        max_new_tokens=max_new_tokens,
+                    )
+                record_decode(
+                    stats,
+                    started=started,
+                    first_token_at=first_token.first_token_at,
+                    new_tokens=out_ids.shape[1] - prompt_len,
+                )
+                if keep_cache:
+                    self._remember_session(
+                        session_key, out_ids[0].tolist(), spec_cache,
+                    )
+                return out_ids
+
+        scheduler = self.scheduler
+        if scheduler is not None:
+            input_ids = inputs['input_ids']
+            req = GenerationRequest(
+                input_ids=input_ids[0].tolist(),
+                max_new_tokens=max_new_tokens,
+                temperature=temperature,
+                top_p=top_p,
+                prefix_cache=prefix.cache if prefix else None,
+                prefix_len=len(prefix.ids) if prefix else 0,
+                keep_cache=keep_cache,
+                constraint=constraint,
+                cancel=cancel,
+                soft_max_new_tokens=soft_max_new_tokens,
+                stop_ids=self.sentence_end_ids,
+            )
+            new_ids = scheduler.submit(req, on_token=on_token)
+            if cancel is not None:
+                cancel.raise_if_set(
+                    generated=len(new_ids), max_new_tokens=max_new_tokens,
+                )
+            record_decode(
+                stats,
+                started=started,
+                first_token_at=req.first_token_at,
+                new_tokens=len(new_ids),
+            )
+            self._remember_session(
+                session_key, req.input_ids + new_ids, req.final_cache,
+            )
+            tail = input_ids.new_tensor([new_ids])
+            return torch.cat([input_ids, tail], dim=1)
+
+        cache = self._start_cache(prefix, keep_cache)
+
+        extra = {}
+        if cache is not None:
+            extra['past_key_values'] = cache
+        if on_token is not None:
+            extra['streamer'] = TokenCallbackStreamer(on_token)
+        if constraint is not None:
+            extra['logits_processor'] = LogitsProcessorList(
+                [JsonLogitsProcessor(constraint, prompt_len)],
+            )
+            criteria.append(JsonStoppingCriteria(constraint, prompt_len))
+
+        out_ids = self.model.generate(
             **inputs,
+            **extra,
+            stopping_criteria=StoppingCriteriaList(criteria),
             max_new_tokens=max_new_tokens,
             temperature=temperature,
             top_p=top_p,
             pad_token_id=self.tokenizer.pad_token_id,
         )
+        if cancel is not None:
+            cancel.raise_if_set(
+                generated=out_ids.shape[1] - prompt_len,
+                max_new_tokens=max_new_tokens,
+            )
+        record_decode(
+            stats,
+            started=started,
+            first_token_at=first_token.first_token_at,
+            new_tokens=out_ids.shape[1] - prompt_len,
+        )
+        if keep_cache:
+            self._remember_session(session_key, out_ids[0].tolist(), cache)
+        return out_ids
 
     def _decode_new_tokens(
             self,
@@ -148,6 +507,11 @@ class AIWorkerModel:
             system_prompt: str,
             history: list[dict],
             user_message: str,
+            session_key: str | None = None,
+            on_text: Callable[[str], None] | None = None,
+            cancel: CancelToken | None = None,
+            stats: dict | None = None,
+            max_new_tokens: int | None = None,
     ) -> str:
         messages: list[dict[str, str]] = [
             {'role': 'system', 'content': system_prompt},
@@ -155,37 +519,109 @@ class AIWorkerModel:
         messages.extend(history)
         messages.append({'role': 'user', 'content': user_message})
 
-        chat_text = self._build_chat_text(messages)
-        inputs = self._encode(chat_text)
+        with stage(stats, 'chat_template'):
+            chat_text = self._build_chat_text(messages)
+        with stage(stats, 'tokenize'):
+            inputs = self._encode(chat_text)
+        chunker = TextChunker(self.tokenizer, on_text) if on_text else None
+
+        budget = max_new_tokens or self.settings.MAX_NEW_TOKENS_REPLY
+        soft = None
+        if self.settings.SENTENCE_STOP_GRACE_TOKENS > 0:
+            soft = soft_limit(budget, self.settings.SENTENCE_STOP_GRACE_TOKENS)
 
         input_len = inputs['input_ids'].shape[1]
         out_ids = self._generate(
             inputs,
-            max_new_tokens=self.settings.MAX_NEW_TOKENS_REPLY,
+            max_new_tokens=budget,
             temperature=self.settings.TEMPERATURE_REPLY,
             top_p=self.settings.TOP_P,
+            prefix=self._match_prefix(system_prompt, inputs, session_key),
+            session_key=session_key,
+            on_token=chunker.put if chunker else None,
+            speculative=True,
+            cancel=cancel,
+            soft_max_new_tokens=soft,
+            stats=stats,
         )
-        return self._decode_new_tokens(out_ids, input_len)
+        if chunker is not None:
+            chunker.end()
+        with stage(stats, 'detokenize'):
+            return self._decode_new_tokens(out_ids, input_len)
 
     def generate_feedback_raw(
             self,
             *,
             system_prompt: str,
             user_message: str,
+            cancel: CancelToken | None = None,
+            stats: dict | None = None,
+            max_new_tokens: int | None = None,
     ) -> str:
         messages: list[dict[str, str]] = [
             {'role': 'system', 'content': system_prompt},
             {'role': 'user', 'content': user_message},
         ]
 
-        chat_text = self._build_chat_text(messages)
-        inputs = self._encode(chat_text)
+        with stage(stats, 'chat_template'):
+            chat_text = self._build_chat_text(messages)
+        with stage(stats, 'tokenize'):
+            inputs = self._encode(chat_text)
+
+        max_new_tokens = (
+            max_new_tokens or self.settings.MAX_NEW_TOKENS_FEEDBACK
+        )
+        constraint = None
+        if self.feedback_schema is not None:
+            constraint = JsonConstraint(
+                self.feedback_schema,
+                self.vocab,
+                eos_token_ids=self._eos_token_ids(),
+                max_new_tokens=max_new_tokens,
+            )
 
         input_len = inputs['input_ids'].shape[1]
         out_ids = self._generate(
             inputs,
-            max_new_tokens=self.settings.MAX_NEW_TOKENS_FEEDBACK,
+            max_new_tokens=max_new_tokens,
             temperature=self.settings.TEMPERATURE_FEEDBACK,
             top_p=self.settings.TOP_P,
+            prefix=self._match_prefix(system_prompt, inputs),
+            constraint=constraint,
+            cancel=cancel,
+            stats=stats,
         )
-        return self._decode_new_tokens(out_ids, input_len)
+        with stage(stats, 'detokenize'):
+            return self._decode_new_tokens(out_ids, input_len)
+
+
+class Int8CPUModel(AIWorkerModel):
+    """
+    HF engine for CPU nodes: fp32 weights with every Linear layer
+    dynamically quantized to int8, so the matmuls of decoding run on the
+    int8 kernels and the weights take about a quarter of the memory.
+    """
+
+    def _load_model(self):
+        model_id = self.settings.MODEL_ID
+        logger.info('model: loading (int8 dynamic) | model_id=%s', model_id)
+        model = AutoModelForCausalLM.from_pretrained(
+            model_id, torch_dtype=torch.float32,
+        )
+        model.eval()
+        torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True,
+        )
+        logger.info('model: loaded (int8 dynamic) | model_id=%s', model_id)
+        return model
+
+
+ENGINES: dict[str, type[InferenceEngine]] = {
+    'hf': AIWorkerModel,
+    'int8': Int8CPUModel,
+    'stub': StubEngine,
+}
+
+
+def create_engine(settings: Settings) -> InferenceEngine:
+    return ENGINES[settings.ENGINE](settings)
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from typing import Any
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from src.coalesce import release_inflight
+from src.settings import get_settings
+
+logger = logging.getLogger('ai_worker.notify')
+
+DONE_CHANNEL = 'ai_worker:jobs:done'
+DONE_KEY_PREFIX = 'ai_worker:done:'
+
+
+def done_key(job_id: str) -> str:
+    return f"{DONE_KEY_PREFIX}{job_id}"
+
+
+def _publish_done(connection: Redis, payload: dict[str, Any]) -> None:
+    data = json.dumps(payload, ensure_ascii=False)
+    pipe = connection.pipeline(transaction=False)
+    # the key covers waiters that subscribe after the job already ended
+    pipe.set(
+        done_key(payload['job_id']), data,
+        ex=get_settings().RQ_RESULT_TTL_S,
+    )
+    pipe.publish(DONE_CHANNEL, data)
+    pipe.execute()
+
+
+async def publish_done(redis: AsyncRedis, payload: dict[str, Any]) -> None:
+    """Record a job answered without a runner, e.g. from a cache."""
+    data = json.dumps(payload, ensure_ascii=False)
+    pipe = redis.pipeline(transaction=False)
+    pipe.set(
+        done_key(payload['job_id']), data,
+        ex=get_settings().RQ_RESULT_TTL_S,
+    )
+    pipe.publish(DONE_CHANNEL, data)
+    await pipe.execute()
+
+
+def on_job_success(job, connection: Redis, result: Any, *args, **kwargs):
+    release_inflight(job, connection)
+    _publish_done(
+        connection,
+        {'job_id': job.id, 'status': 'finished', 'result': result},
+    )
+
+
+def on_job_failure(job, connection: Redis, typ, value, tb, *args, **kwargs):
+    release_inflight(job, connection)
+    _publish_done(
+        connection,
+        {
+            'job_id': job.id,
+            'status': 'failed',
+            'error': f"{getattr(typ, '__name__', typ)}: {value}",
+        },
+    )
+
+
+def on_job_expired(job, connection: Redis) -> None:
+    """Wake the waiters of a job the runner dropped past its deadline."""
+    release_inflight(job, connection)
+    _publish_done(
+        connection,
+        {'job_id': job.id, 'status': 'expired', 'error': 'deadline passed'},
+    )
+
+
+def on_job_cancelled(job, connection: Redis) -> None:
+    """Wake the waiters of a job the runner dropped on its cancel flag."""
+    release_inflight(job, connection)
+    _publish_done(
+        connection,
+        {
+            'job_id': job.id,
+            'status': 'canceled',
+            'error': 'cancelled before start',
+        },
+    )
+
+
+class JobNotifier:
+    """
+    One pub/sub subscription per API process that wakes every waiter of a
+    job as soon as the runner reports it finished or failed.
+    """
+
+    def __init__(self, redis: AsyncRedis):
+        self.redis = redis
+        self._waiters: dict[str, list[asyncio.Future]] = {}
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._listen())
+        logger.info('notifier: started | channel=%s', DONE_CHANNEL)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(DONE_CHANNEL)
+                # anything that ended while we were not subscribed
+                await self._recheck()
+                async for message in pubsub.listen():
+                    if message.get('type') != 'message':
+                        continue
+                    self._resolve(json.loads(message['data']))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception('notifier: listener error | err=%s', e)
+                await asyncio.sleep(1.0)
+            finally:
+                await pubsub.aclose()
+
+    async def _recheck(self) -> None:
+        for job_id in list(self._waiters):
+            stored = await self.redis.get(done_key(job_id))
+            if stored is not None:
+                self._resolve(json.loads(stored))
+
+    def _resolve(self, payload: dict[str, Any]) -> None:
+        for fut in self._waiters.pop(payload.get('job_id'), []):
+            if not fut.done():
+                fut.set_result(payload)
+
+    async def wait(self, job_id: str, *, timeout_s: float) -> dict[str, Any]:
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(job_id, []).append(fut)
+        try:
+            stored = await self.redis.get(done_key(job_id))
+            if stored is not None:
+                return json.loads(stored)
+            return await asyncio.wait_for(fut, timeout_s)
+        finally:
+            waiters = self._waiters.get(job_id)
+            if waiters and fut in waiters:
+                waiters.remove(fut)
+                if not waiters:
+                    del self._waiters[job_id]
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import logging
+import re
+import string
+import unicodedata
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from src.schemas import FeedbackItem
+from src.schemas import LanguageFeedback
+from src.settings import Settings
+
+logger = logging.getLogger('ai_worker.precheck')
+
+PRECHECK_STATS = 'ai_worker:precheck_stats'
+
+# what the feedback prompt answers for a message without mistakes
+NO_MISTAKES = 'No mistakes — great job!'
+NOT_ENGLISH = 'Write your message in English to get feedback.'
+
+# chat fillers that are correct as they stand, compared word by word
+TRIVIAL_MESSAGES = frozenset({
+    'ok', 'okay', 'k', 'kk', 'yes', 'yeah', 'yep', 'yup', 'no', 'nope',
+    'hi', 'hey', 'hello', 'bye', 'goodbye', 'thanks', 'thank you', 'thx',
+    'ty', 'please', 'sure', 'cool', 'nice', 'great', 'good', 'fine', 'lol',
+    'haha', 'hmm', 'oh', 'wow', 'oops', 'sorry', 'right', 'alright',
+    'ok thanks', 'thanks a lot', 'thank you so much', 'no thanks',
+    'good morning', 'good night', 'see you', 'you too', 'me too',
+})
+
+WORD_RE = re.compile(r"[A-Za-z]+(?:'[A-Za-z]+)?")
+
+
+@dataclass
+class Precheck:
+    # empty | symbols | numbers | not_english | trivial | dictionary |
+    # spelling
+    reason: str
+    confidence: float
+    feedback: LanguageFeedback
+
+
+def letter_scripts(text: str) -> dict[str, int]:
+    """Letters per Unicode script, e.g. {'LATIN': 5, 'CYRILLIC': 2}."""
+    scripts: dict[str, int] = {}
+    for ch in text:
+        if ch.isalpha():
+            script = unicodedata.name(ch, 'UNKNOWN').split(' ', 1)[0]
+            scripts[script] = scripts.get(script, 0) + 1
+    return scripts
+
+
+@lru_cache(maxsize=4)
+def load_lexicon(path: str | None) -> frozenset[str]:
+    """Lowercased words of a one-word-per-line file; empty if unusable."""
+    if not path:
+        return frozenset()
+    try:
+        lines = Path(path).read_text(encoding='utf-8').split()
+    except OSError as e:
+        logger.warning('precheck: no dictionary | path=%s err=%s', path, e)
+        return frozenset()
+    words = frozenset(w.lower() for w in lines if WORD_RE.fullmatch(w))
+    logger.info(
+        'precheck: dictionary loaded | path=%s words=%s', path, len(words),
+    )
+    return words
+
+
+def _edits1(word: str) -> set[str]:
+    splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+    letters = string.ascii_lowercase
+    return (
+        {a + b[1:] for a, b in splits if b}
+        | {a + b[1] + b[0] + b[2:] for a, b in splits if len(b) > 1}
+        | {a + c + b[1:] for a, b in splits if b for c in letters}
+        | {a + c + b for a, b in splits for c in letters}
+    )
+
+
+def suggestions(word: str, lexicon: frozenset[str]) -> list[str]:
+    """Dictionary words one edit away from `word`."""
+    return sorted(w for w in _edits1(word.lower()) if w in lexicon)
+
+
+def _feedback(
+        items: list[FeedbackItem] | None = None,
+        comment: str = NO_MISTAKES,
+) -> LanguageFeedback:
+    return LanguageFeedback(items=items or [], overall_comment=comment)
+
+
+def precheck_feedback(
+        message: str,
+        *,
+        lexicon: frozenset[str],
+        max_words: int,
+) -> Precheck | None:
+    """
+    Feedback for messages too trivial to need the model, or None.
+
+    Confidence is 1.0 for messages without letters and drops with every
+    word of a dictionary-checked message: a short message of known words
+    can still be ungrammatical, which only the model can tell.
+    """
+    text = (message or '').strip()
+    if not text:
+        return Precheck('empty', 1.0, _feedback())
+
+    scripts = letter_scripts(text)
+    if not scripts:
+        reason = 'numbers' if any(c.isdigit() for c in text) else 'symbols'
+        return Precheck(reason, 1.0, _feedback())
+    if not scripts.get('LATIN'):
+        return Precheck('not_english', 0.95, _feedback(comment=NOT_ENGLISH))
+
+    words = WORD_RE.findall(text)
+    if len(words) > max_words:
+        return None
+    if ' '.join(words).lower() in TRIVIAL_MESSAGES:
+        return Precheck('trivial', 0.95, _feedback())
+    if not lexicon:
+        return None
+
+    confidence = 0.95 - 0.2 * (len(words) - 1)
+    items: list[FeedbackItem] = []
+    for word in words:
+        low = word.lower()
+        if low in lexicon or low in TRIVIAL_MESSAGES:
+            continue
+        fixes = suggestions(low, lexicon)
+        if not fixes:
+            # a name, slang or a typo too far off: leave it to the model
+            return None
+        if len(fixes) > 1:
+            confidence -= 0.3
+        fix = fixes[0]
+        if word[0].isupper():
+            fix = fix.capitalize()
+        items.append(FeedbackItem(
+            user_text=word,
+            error_type='spelling',
+            explanation=f'Spelling: "{fix}".',
+            text_corrected=fix,
+        ))
+
+    if not items:
+        return Precheck('dictionary', confidence, _feedback())
+    return Precheck(
+        'spelling',
+        confidence,
+        _feedback(items, 'Check the spelling of these words.'),
+    )
+
+
+def run_precheck(message: str, settings: Settings) -> Precheck | None:
+    """`precheck_feedback` with the settings' dictionary and threshold."""
+    if not settings.PRECHECK_ENABLED:
+        return None
+    result = precheck_feedback(
+        message,
+        lexicon=load_lexicon(settings.PRECHECK_DICTIONARY_PATH),
+        max_words=settings.PRECHECK_MAX_WORDS,
+    )
+    if result is None or result.confidence < settings.PRECHECK_MIN_CONFIDENCE:
+        return None
+    return result
+
+
+def precheck_meta(result: Precheck) -> dict:
+    return {
+        'precheck': result.reason,
+        'precheck_confidence': round(result.confidence, 2),
+    }
+
+
+def record_precheck(redis: Redis, reason: str) -> None:
+    try:
+        redis.hincrby(PRECHECK_STATS, reason, 1)
+    except Exception as e:
+        logger.warning('precheck: stats failed | err=%s', e)
+
+
+async def record_precheck_async(redis: AsyncRedis, reason: str) -> None:
+    try:
+        await redis.hincrby(PRECHECK_STATS, reason, 1)
+    except Exception as e:
+        logger.warning('precheck: stats failed | err=%s', e)
+
+
+async def precheck_stats(redis: AsyncRedis) -> dict[str, int]:
+    raw = await redis.hgetall(PRECHECK_STATS)
+    return {k.decode(): int(v) for k, v in raw.items()}
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import torch
+from transformers import DynamicCache
+
+logger = logging.getLogger('ai_worker.prefix_cache')
+
+
+@dataclass
+class PrefixEntry:
+    ids: list[int]
+    cache: DynamicCache
+    nbytes: int
+
+
+def cache_nbytes(cache: DynamicCache) -> int:
+    return sum(
+        k.numel() * k.element_size() + v.numel() * v.element_size()
+        for k, v in cache.to_legacy_cache()
+    )
+
+
+def copy_cache(cache: DynamicCache) -> DynamicCache:
+    # DynamicCache.update() concatenates into new tensors, so a fresh
+    # container over the same tensors is enough to keep the original intact
+    return DynamicCache.from_legacy_cache(cache.to_legacy_cache())
+
+
+class PrefixCache:
+    """
+    Keeps `past_key_values` for the fixed system prompts.
+
+    Entries are keyed by the prompt text, bounded by `max_bytes` with LRU
+    eviction and rebuilt lazily on the next request that needs them.
+    """
+
+    def __init__(self, model, tokenizer, *, max_mb: int):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_bytes = max(0, max_mb) * 1024 * 1024
+
+        self._entries: OrderedDict[str, PrefixEntry] = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(system_prompt: str) -> str:
+        return hashlib.sha1(system_prompt.encode('utf-8')).hexdigest()
+
+    def _prefix_ids(self, system_prompt: str) -> list[int]:
+        text = self.tokenizer.apply_chat_template(
+            [{'role': 'system', 'content': system_prompt}],
+            tokenize=False,
+            add_generation_prompt=False,
+        )
+        return self.tokenizer(text, add_special_tokens=False)['input_ids']
+
+    @torch.no_grad()
+    def _build(self, system_prompt: str) -> PrefixEntry:
+        ids = self._prefix_ids(system_prompt)
+        input_ids = torch.tensor([ids], device=self.model.device)
+        out = self.model(
+            input_ids=input_ids,
+            past_key_values=DynamicCache(),
+            use_cache=True,
+            num_logits_to_keep=1,
+        )
+        cache = out.past_key_values
+        return PrefixEntry(ids=ids, cache=cache, nbytes=cache_nbytes(cache))
+
+    def _insert(self, key: str, entry: PrefixEntry) -> bool:
+        if entry.nbytes > self.max_bytes:
+            return False
+        while self._entries and self._total_bytes + entry.nbytes > (
+            self.max_bytes
+        ):
+            old_key, old = self._entries.popitem(last=False)
+            self._total_bytes -= old.nbytes
+            logger.info(
+                'prefix cache: evicted | key=%s bytes=%s',
+                old_key[:12], old.nbytes,
+            )
+        self._entries[key] = entry
+        self._total_bytes += entry.nbytes
+        return True
+
+    def get(self, system_prompt: str) -> PrefixEntry:
+        key = self._key(system_prompt)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+            entry = self._build(system_prompt)
+            stored = self._insert(key, entry)
+            logger.info(
+                'prefix cache: built | key=%s tokens=%s bytes=%s '
+                'stored=%s total_bytes=%s',
+                key[:12],
+                len(entry.ids),
+                entry.nbytes,
+                stored,
+                self._total_bytes,
+            )
+            return entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def warm(self, system_prompts: list[str]) -> None:
+        for p in system_prompts:
+            self.get(p)
+
+    def match(
+            self,
+            system_prompt: str,
+            input_ids: list[int],
+    ) -> PrefixEntry | None:
+        entry = self.get(system_prompt)
+        n = len(entry.ids)
+        # the prompt must extend the cached prefix by at least one token
+        if len(input_ids) <= n or input_ids[:n] != entry.ids:
+            logger.debug('prefix cache: token mismatch | prefix_len=%s', n)
+            return None
+        return entry
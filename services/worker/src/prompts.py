@@ -2,6 +2,7 @@
 from __future__ import annotations
 
 from typing import cast
+from typing import get_args
 from typing import Literal
 
 PromptKind = Literal['reply', 'feedback']
@@ -209,3 +210,12 @@ def get_prompt(level: str | None, kind: PromptKind) -> str:
         return FEEDBACK_BASE_PROMPT + '\n' + LEVEL_RULES_FEEDBACK[lvl]
 
     raise ValueError(f"Unknown kind: {kind}")
+
+
+def all_prompts() -> list[str]:
+    """Every distinct system prompt get_prompt() can return."""
+    return [
+        get_prompt(lvl, kind)
+        for kind in get_args(PromptKind)
+        for lvl in get_args(Level)
+    ]
@@ -1,13 +1,23 @@
 from __future__ import annotations
 
 import logging
+import time
 
 from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from rq import Callback
 from rq import Queue
+from rq.job import Job
+from src.notify import on_job_failure
+from src.notify import on_job_success
 from src.settings import Settings
 
 logger = logging.getLogger('ai_worker.queue')
 
+# highest priority first: runners always drain the earlier queues before
+# they look at the later ones
+PRIORITIES = ('reply', 'feedback', 'batch')
+
 
 def get_redis(settings: Settings) -> Redis:
     logger.info('redis: connect | url=%s', settings.REDIS_URL)
@@ -15,16 +25,66 @@ def get_redis(settings: Settings) -> Redis:
     return r
 
 
-def get_queue(settings: Settings) -> Queue:
+def get_async_redis(settings: Settings) -> AsyncRedis:
+    logger.info('redis (async): connect | url=%s', settings.REDIS_URL)
+    return AsyncRedis.from_url(settings.REDIS_URL)
+
+
+def queue_name(settings: Settings, priority: str) -> str:
+    if priority not in PRIORITIES:
+        raise ValueError(f"unknown queue priority: {priority}")
+    return f"{settings.RQ_QUEUE_NAME}:{priority}"
+
+
+def priority_deadline_s(settings: Settings, priority: str) -> int:
+    """How long a job of this priority stays worth running."""
+    return {
+        'reply': settings.REPLY_DEADLINE_S,
+        'feedback': settings.FEEDBACK_DEADLINE_S,
+        'batch': settings.BATCH_DEADLINE_S,
+    }[priority]
+
+
+def get_queue(settings: Settings, priority: str = 'reply') -> Queue:
     redis = get_redis(settings=settings)
     q = Queue(
-        name=settings.RQ_QUEUE_NAME,
+        name=queue_name(settings, priority),
         connection=redis,
         default_timeout=getattr(settings, 'JOB_TIMEOUT_S', 1800),
     )
     logger.info(
-        'rq queue: ready | name=%s default_timeout_s=%s',
-        settings.RQ_QUEUE_NAME,
+        'rq queue: ready | name=%s default_timeout_s=%s deadline_s=%s',
+        q.name,
         getattr(settings, 'JOB_TIMEOUT_S', 1800),
+        priority_deadline_s(settings, priority),
     )
     return q
+
+
+def get_queues(settings: Settings) -> dict[str, Queue]:
+    return {p: get_queue(settings, p) for p in PRIORITIES}
+
+
+def enqueue_job(
+        q: Queue,
+        func: str,
+        *,
+        deadline_s: float | None = None,
+        **kwargs,
+) -> Job:
+    """
+    Enqueue with the completion callbacks the API waits on.
+
+    With `deadline_s` the job carries an absolute `deadline_ts` in its
+    meta; runners drop it unstarted once that moment has passed.
+    """
+    meta = dict(kwargs.pop('meta', None) or {})
+    if deadline_s is not None:
+        meta['deadline_ts'] = time.time() + deadline_s
+    return q.enqueue(
+        func,
+        on_success=Callback(on_job_success),
+        on_failure=Callback(on_job_failure),
+        meta=meta,
+        **kwargs,
+    )
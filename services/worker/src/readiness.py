@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import get_args
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from src.metrics import observe
+from src.prompts import get_prompt
+from src.prompts import Level
+from src.prompts import PromptKind
+from src.service import AIWorkerService
+from src.settings import Settings
+
+logger = logging.getLogger('ai_worker.readiness')
+
+READY_PREFIX = 'ai_worker:ready:'
+
+# short, with a mistake, so feedback warms up its usual output as well
+WARMUP_MESSAGE = 'Hi! Yesterday I goed to the park with my friends.'
+
+
+def ready_key(runner_id: str) -> str:
+    return f"{READY_PREFIX}{runner_id}"
+
+
+def runner_id(index: int | None = None) -> str:
+    base = f"{socket.gethostname()}.{os.getpid()}"
+    return base if index is None else f"{base}.{index}"
+
+
+def warmup(svc: AIWorkerService, settings: Settings) -> int:
+    """
+    One short generation per (level, kind) prompt, so the first real job
+    after a start does not pay for kernel selection, allocator growth and
+    the other one-off work of a first forward pass. Returns how many of
+    them succeeded.
+    """
+    done = 0
+    for kind in get_args(PromptKind):
+        for level in get_args(Level):
+            model_id, engine = svc.engine_for(kind, level)
+            system_prompt = get_prompt(level, kind=kind)
+            t0 = time.monotonic()
+            try:
+                if kind == 'reply':
+                    engine.generate_reply(
+                        system_prompt=system_prompt,
+                        history=[],
+                        user_message=WARMUP_MESSAGE,
+                        max_new_tokens=settings.WARMUP_MAX_NEW_TOKENS,
+                    )
+                else:
+                    engine.generate_feedback_raw(
+                        system_prompt=system_prompt,
+                        user_message=WARMUP_MESSAGE,
+                        max_new_tokens=settings.WARMUP_MAX_NEW_TOKENS,
+                    )
+            except Exception as e:
+                logger.warning(
+                    'warmup: failed | kind=%s level=%s model_id=%s err=%s',
+                    kind, level, model_id, e,
+                )
+                continue
+            done += 1
+            logger.info(
+                'warmup: ok | kind=%s level=%s model_id=%s took_s=%.2f',
+                kind, level, model_id, time.monotonic() - t0,
+            )
+    return done
+
+
+def record_startup(redis: Redis, timings: dict[str, float]) -> None:
+    """Add the seconds of each startup phase to /metrics."""
+    try:
+        observe(
+            redis,
+            [
+                ('ai_worker_startup_seconds', {'phase': phase}, seconds)
+                for phase, seconds in timings.items()
+            ],
+        )
+    except Exception as e:
+        logger.warning('startup: metrics not recorded | err=%s', e)
+
+
+class ReadinessBeacon:
+    """
+    Keeps the runner's readiness key alive while it consumes the queues.
+
+    The key expires `3 * RUNNER_HEARTBEAT_S` after the last refresh, so a
+    runner that dies without `stop()` stops counting as ready on its own.
+    """
+
+    def __init__(self, redis: Redis, settings: Settings, runner: str):
+        self.redis = redis
+        self.key = ready_key(runner)
+        self.interval = max(1, settings.RUNNER_HEARTBEAT_S)
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self, info: dict) -> None:
+        value = json.dumps({**info, 'pid': os.getpid()})
+
+        def refresh() -> None:
+            while not self._stop.is_set():
+                try:
+                    self.redis.set(self.key, value, ex=self.interval * 3)
+                except Exception as e:
+                    logger.warning(
+                        'readiness: refresh failed | key=%s err=%s',
+                        self.key, e,
+                    )
+                self._stop.wait(self.interval)
+
+        self._thread = threading.Thread(
+            target=refresh, name='runner-ready', daemon=True,
+        )
+        self._thread.start()
+        logger.info('readiness: ready | key=%s', self.key)
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval)
+        try:
+            self.redis.delete(self.key)
+        except Exception as e:
+            logger.warning(
+                'readiness: clear failed | key=%s err=%s', self.key, e,
+            )
+
+
+class ReadinessGate:
+    """
+    API side: is any runner ready? The answer is cached for `cache_s` so
+    admission does not scan Redis on every request.
+    """
+
+    def __init__(
+            self,
+            redis: AsyncRedis,
+            *,
+            required: bool,
+            cache_s: float = 1.0,
+    ):
+        self.redis = redis
+        self.required = required
+        self.cache_s = cache_s
+        self._ready = False
+        self._checked_at = float('-inf')
+
+    async def runners(self) -> dict[str, dict]:
+        keys = [
+            key async for key in self.redis.scan_iter(
+                match=f"{READY_PREFIX}*", count=100,
+            )
+        ]
+        if not keys:
+            return {}
+        values = await self.redis.mget(keys)
+        return {
+            key.decode()[len(READY_PREFIX):]: json.loads(value)
+            for key, value in zip(keys, values)
+            if value is not None
+        }
+
+    async def ready(self) -> bool:
+        if not self.required:
+            return True
+        now = time.monotonic()
+        if now - self._checked_at < self.cache_s:
+            return self._ready
+        try:
+            self._ready = bool(await self.runners())
+        except Exception as e:
+            # do not turn all work away because the check itself failed
+            logger.warning('readiness: check failed, admit | err=%s', e)
+            self._ready = True
+        self._checked_at = now
+        return self._ready
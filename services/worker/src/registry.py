@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import logging
+import threading
+from collections import OrderedDict
+
+from src.engine import InferenceEngine
+from src.model import create_engine
+from src.prompts import normalize_level
+from src.prompts import PromptKind
+from src.settings import Settings
+
+logger = logging.getLogger('ai_worker.registry')
+
+
+def route_model_id(
+        settings: Settings,
+        kind: PromptKind,
+        level: str | None,
+) -> str:
+    """
+    Model id for a request: the most specific of `MODEL_ROUTES` keys
+    "<kind>:<level>", "<kind>:*" and "*:<level>", else `MODEL_ID`.
+    """
+    lvl = normalize_level(level)
+    routes = settings.MODEL_ROUTES
+    for key in (f"{kind}:{lvl}", f"{kind}:*", f"*:{lvl}"):
+        if routes.get(key):
+            return routes[key]
+    return settings.MODEL_ID
+
+
+class ModelRegistry:
+    """
+    Engines by model id, loaded on first use. At most `max_resident` stay
+    loaded; the least recently used one is dropped to make room and closed
+    in the background (callers still holding it finish their generation
+    first).
+    """
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self.max_resident = max(1, settings.MODEL_MAX_RESIDENT)
+        self._engines: OrderedDict[str, InferenceEngine] = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks: dict[str, threading.Lock] = {}
+
+    def model_ids(self) -> list[str]:
+        """Every model id the routes can pick, the default one first."""
+        ids = [self.settings.MODEL_ID]
+        for model_id in self.settings.MODEL_ROUTES.values():
+            if model_id and model_id not in ids:
+                ids.append(model_id)
+        return ids
+
+    def resident(self) -> list[InferenceEngine]:
+        with self._lock:
+            return list(self._engines.values())
+
+    def get(self, model_id: str) -> InferenceEngine:
+        with self._lock:
+            engine = self._engines.get(model_id)
+            if engine is not None:
+                self._engines.move_to_end(model_id)
+                return engine
+            load_lock = self._load_locks.setdefault(
+                model_id, threading.Lock(),
+            )
+
+        # one loader per model id; other models stay usable meanwhile
+        with load_lock:
+            with self._lock:
+                engine = self._engines.get(model_id)
+            if engine is not None:
+                return engine
+
+            logger.info('registry: loading | model_id=%s', model_id)
+            update: dict = {'MODEL_ID': model_id}
+            if model_id != self.settings.MODEL_ID:
+                # the draft model is sized for the default model
+                update['DRAFT_MODEL_ID'] = None
+            engine = create_engine(self.settings.model_copy(update=update))
+
+            evicted: list[tuple[str, InferenceEngine]] = []
+            with self._lock:
+                self._engines[model_id] = engine
+                while len(self._engines) > self.max_resident:
+                    evicted.append(self._engines.popitem(last=False))
+            # closing waits for generations in flight, not the caller
+            for evicted_id, old in evicted:
+                threading.Thread(
+                    target=self._close,
+                    args=(evicted_id, old),
+                    name='registry-evict',
+                    daemon=True,
+                ).start()
+            return engine
+
+    def _close(self, model_id: str, engine: InferenceEngine) -> None:
+        try:
+            engine.close()
+        except Exception as e:
+            logger.warning(
+                'registry: close failed | model_id=%s err=%s', model_id, e,
+            )
+            return
+        logger.info(
+            'registry: evicted | model_id=%s resident=%s',
+            model_id,
+            len(self._engines),
+        )
+
+    def default(self) -> InferenceEngine:
+        return self.get(self.settings.MODEL_ID)
+
+    def route(
+            self,
+            kind: PromptKind,
+            level: str | None,
+    ) -> tuple[str, InferenceEngine]:
+        model_id = route_model_id(self.settings, kind, level)
+        return model_id, self.get(model_id)
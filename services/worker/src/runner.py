@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+from rq import Queue
+from rq.timeouts import TimerDeathPenalty
+from rq.worker import SimpleWorker
+from src.admission import record_service_time
+from src.cancel import is_cancel_requested
+from src.logging_config import setup_logging
+from src.notify import on_job_cancelled
+from src.notify import on_job_expired
+from src.queue import get_redis
+from src.queue import PRIORITIES
+from src.queue import queue_name
+from src.readiness import ReadinessBeacon
+from src.readiness import record_startup
+from src.readiness import runner_id
+from src.readiness import warmup
+from src.settings import get_settings
+from src.settings import Settings
+from src.tasks import get_service
+
+logger = logging.getLogger('ai_worker.runner')
+
+
+class ThreadedWorker(SimpleWorker):
+    """
+    SimpleWorker that can live in a non-main thread.
+
+    Several of them share one process (and one loaded model), so jobs
+    they pick up concurrently end up in the same continuous batch.
+    """
+
+    death_penalty_class = TimerDeathPenalty
+
+    def __init__(self, *args, service_window: int = 50, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.service_window = service_window
+        self.expired_job_count = 0
+
+    def _install_signal_handlers(self):
+        if threading.current_thread() is threading.main_thread():
+            super()._install_signal_handlers()
+
+    def execute_job(self, job, queue):
+        deadline_ts = job.meta.get('deadline_ts')
+        if deadline_ts is not None and time.time() > deadline_ts:
+            # nobody is waiting for the answer any more
+            logger.warning(
+                'runner: job expired, skipped | job_id=%s queue=%s '
+                'late_s=%.1f',
+                job.id,
+                queue.name,
+                time.time() - deadline_ts,
+            )
+            self.expired_job_count += 1
+            job.cancel()
+            on_job_expired(job, self.connection)
+            return
+        if is_cancel_requested(self.connection, job.id):
+            logger.info(
+                'runner: job cancelled before start | job_id=%s', job.id,
+            )
+            job.cancel()
+            on_job_cancelled(job, self.connection)
+            return
+
+        t0 = time.monotonic()
+        super().execute_job(job, queue)
+        try:
+            record_service_time(
+                self.connection,
+                queue.name.rsplit(':', 1)[-1],
+                time.monotonic() - t0,
+                window=self.service_window,
+            )
+        except Exception as e:
+            logger.warning('runner: service time not recorded | err=%s', e)
+
+
+def build_workers(settings: Settings) -> list[ThreadedWorker]:
+    n_threads = settings.RUNNER_THREADS or settings.BATCH_MAX_SIZE
+
+    workers: list[ThreadedWorker] = []
+    for i in range(max(1, n_threads)):
+        redis = get_redis(settings)
+        # listed in priority order, which is the order rq polls them in
+        queues = [
+            Queue(queue_name(settings, p), connection=redis)
+            for p in PRIORITIES
+        ]
+        workers.append(
+            ThreadedWorker(
+                queues,
+                connection=redis,
+                name=f"{socket.gethostname()}.{os.getpid()}.{i}",
+                service_window=settings.ADMISSION_WINDOW,
+            ),
+        )
+    return workers
+
+
+def prepare(settings: Settings) -> dict[str, float]:
+    """
+    Load the model (once, before any thread can race into the lazy
+    service cache), build its prefix caches and warm it up. Returns the
+    seconds of each phase.
+    """
+    t0 = time.monotonic()
+    svc = get_service()
+    timings = {'load': round(time.monotonic() - t0, 2)}
+    t0 = time.monotonic()
+    for engine in svc.registry.resident():
+        engine.warm_caches()
+    timings['prefix'] = round(time.monotonic() - t0, 2)
+    if settings.WARMUP_ENABLED:
+        t0 = time.monotonic()
+        n = warmup(svc, settings)
+        timings['warmup'] = round(time.monotonic() - t0, 2)
+        logger.info(
+            'runner: warmed up | generations=%s warmup_s=%s',
+            n, timings['warmup'],
+        )
+    return timings
+
+
+def run_workers(
+        workers: list[ThreadedWorker],
+        settings: Settings,
+        *,
+        ready: ReadinessBeacon | None = None,
+        ready_info: dict | None = None,
+) -> None:
+    """
+    Run the workers in threads until SIGINT/SIGTERM, with the runner
+    marked ready in Redis while they do.
+    """
+
+    def request_stop(signum, frame):
+        logger.info('runner: stop requested | signal=%s', signum)
+        for w in workers:
+            w._stop_requested = True
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    threads = [
+        threading.Thread(
+            target=w.work,
+            kwargs={'logging_level': settings.LOG_LEVEL},
+            name=w.name,
+            daemon=True,
+        )
+        for w in workers
+    ]
+    for t in threads:
+        t.start()
+    if ready is not None:
+        ready.start(ready_info or {})
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    try:
+        for t in threads:
+            while t.is_alive():
+                t.join(timeout=1.0)
+    finally:
+        if ready is not None:
+            ready.stop()
+
+    logger.info('runner: stopped | pid=%s', os.getpid())
+
+
+def main() -> None:
+    settings = get_settings()
+    setup_logging(settings.LOG_LEVEL)
+
+    logger.info(
+        'runner: start | queues=%s threads=%s batch_max_size=%s',
+        ','.join(queue_name(settings, p) for p in PRIORITIES),
+        settings.RUNNER_THREADS or settings.BATCH_MAX_SIZE,
+        settings.BATCH_MAX_SIZE,
+    )
+
+    timings = prepare(settings)
+    redis = get_redis(settings)
+    record_startup(redis, timings)
+
+    run_workers(
+        build_workers(settings),
+        settings,
+        ready=ReadinessBeacon(redis, settings, runner_id()),
+        ready_info={
+            'models': get_service().registry.model_ids(),
+            **{f"{phase}_s": sec for phase, sec in timings.items()},
+        },
+    )
+
+
+if __name__ == '__main__':
+    main()
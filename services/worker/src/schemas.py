@@ -27,6 +27,34 @@ class ReplyRequest(BaseModel):
     meta: Meta | None = None
 
 
+class JobSubmitRequest(BaseModel):
+    kind: Literal['reply', 'turn', 'feedback']
+    user_id: str
+    session_id: str | None = None
+    message: str
+    history: list[ChatMessage] = Field(default_factory=list)
+    meta: Meta | None = None
+
+
+class JobStatusRequest(BaseModel):
+    ids: list[str]
+    # hold the request until one of the jobs ends, at most this long
+    wait_s: float = 0
+    progress: bool = False
+
+
+class HistoryBudgetRequest(BaseModel):
+    history: list[ChatMessage] = Field(default_factory=list)
+
+
+class HistoryBudgetResponse(BaseModel):
+    counts: list[int]
+    # how many of the newest messages the reply prompt will actually use
+    keep: int
+    used_tokens: int
+    max_tokens: int
+
+
 class ReplyResponse(BaseModel):
     # user_id: str
     reply: str
@@ -48,6 +76,11 @@ class LanguageFeedback(BaseModel):
     overall_comment: str
 
 
+class FeedbackEnvelope(BaseModel):
+    # the exact JSON document the feedback prompt asks the model for
+    language_feedback: LanguageFeedback
+
+
 class FeedbackRequest(BaseModel):
     user_id: str
     session_id: str
@@ -55,10 +88,20 @@ class FeedbackRequest(BaseModel):
     meta: Meta | None = None
 
 
+class FeedbackBatchRequest(BaseModel):
+    items: list[FeedbackRequest]
+
+
 class FeedbackResponse(BaseModel):
     language_feedback: LanguageFeedback
     meta: dict | None = None
 
+
+class TurnResponse(BaseModel):
+    reply: str
+    language_feedback: LanguageFeedback
+    meta: dict | None = None
+
 # Class for achivmetns and stats
 
 
@@ -3,8 +3,13 @@ from __future__ import annotations
 import logging
 import threading
 
-from src.model import AIWorkerModel
+from src.budget import BudgetController
+from src.engine import InferenceEngine
+from src.precheck import precheck_meta
+from src.precheck import run_precheck
 from src.prompts import get_prompt
+from src.prompts import PromptKind
+from src.registry import ModelRegistry
 from src.schemas import ChatMessage
 from src.schemas import FeedbackRequest
 from src.schemas import FeedbackResponse
@@ -12,9 +17,9 @@ from src.schemas import LanguageFeedback
 from src.schemas import ReplyRequest
 from src.schemas import ReplyResponse
 from src.settings import Settings
-from src.utils import clamp_history
-from src.utils import clamp_history_by_chars
+from src.token_budget import fit_history
 from src.utils import fallback_language_feedback
+from src.utils import make_session_key
 from src.utils import safe_parse_language_feedback
 from src.utils import Timer
 from src.utils import trim_text
@@ -23,13 +28,27 @@ logger = logging.getLogger('ai_worker.service')
 
 
 class AIWorkerService:
-    def __init__(self, model: AIWorkerModel, settings: Settings):
-        self.model = model
+    def __init__(self, registry: ModelRegistry, settings: Settings):
+        self.registry = registry
         self.settings = settings
+        self.budget = BudgetController(settings)
         self._gen_sema = threading.Semaphore(
             settings.MAX_CONCURRENT_GENERATIONS,
         )
 
+    @property
+    def model(self) -> InferenceEngine:
+        """The engine of the default `MODEL_ID`."""
+        return self.registry.default()
+
+    def engine_for(
+            self,
+            kind: PromptKind,
+            level: str | None,
+    ) -> tuple[str, InferenceEngine]:
+        """(model id, engine) that `MODEL_ROUTES` picks for a request."""
+        return self.registry.route(kind, level)
+
     @staticmethod
     def _history_to_dicts(history: list[ChatMessage]) -> list[dict[str, str]]:
         return [{'role': m.role, 'content': m.content} for m in history]
@@ -44,30 +63,34 @@ class AIWorkerService:
 
         user_msg = trim_text(req.message, self.settings.MAX_MESSAGE_CHARS)
 
-        hist = clamp_history(
-            req.history, max_turns=self.settings.MAX_HISTORY_TURNS,
-        )
-        hist = clamp_history_by_chars(
-            hist, max_total_chars=self.settings.MAX_HISTORY_CHARS,
-        )
+        session_key = make_session_key(req.user_id, req.session_id)
+        model_id, engine = self.engine_for('reply', level)
+
+        hist = fit_history(req.history, self.settings, engine.token_counter)
+        if len(hist) < len(req.history):
+            engine.forget_session(session_key)
         hist_dicts = self._history_to_dicts(hist)
 
         logger.info(
             'reply: start | rid=%s user_id=%s '
-            'session_id=%s level=%s hist_turns=%s',
+            'session_id=%s level=%s model_id=%s hist_turns=%s',
             request_id,
             req.user_id,
             req.session_id,
             level,
+            model_id,
             len(hist_dicts),
         )
 
+        stats: dict = {}
         t = Timer.start()
         with self._gen_sema:
-            reply_text = self.model.generate_reply(
+            reply_text = engine.generate_reply(
                 system_prompt=system_prompt,
                 history=hist_dicts,
                 user_message=user_msg,
+                session_key=session_key,
+                stats=stats,
             )
         latency = t.elapsed_ms()
 
@@ -86,7 +109,7 @@ class AIWorkerService:
             reply=reply_text,
             meta={
                 'latency_ms': latency, 'mode': 'reply',
-                'level': level or 'auto',
+                'level': level or 'auto', 'model': model_id, **stats,
             },
         )
 
@@ -99,19 +122,41 @@ class AIWorkerService:
         system_prompt = get_prompt(level, kind='feedback')
         user_msg = trim_text(req.message, self.settings.MAX_MESSAGE_CHARS)
 
+        prechecked = run_precheck(user_msg, self.settings)
+        if prechecked is not None:
+            logger.info(
+                'feedback: precheck hit | rid=%s user_id=%s reason=%s',
+                request_id,
+                req.user_id,
+                prechecked.reason,
+            )
+            return FeedbackResponse(
+                language_feedback=prechecked.feedback,
+                meta={
+                    'latency_ms': 0, 'mode': 'feedback',
+                    'level': level or 'auto', **precheck_meta(prechecked),
+                },
+            )
+
+        model_id, engine = self.engine_for('feedback', level)
+
         logger.info(
-            'feedback: start | rid=%s user_id=%s session_id=%s level=%s',
+            'feedback: start | rid=%s user_id=%s session_id=%s level=%s '
+            'model_id=%s',
             request_id,
             req.user_id,
             req.session_id,
             level,
+            model_id,
         )
 
+        stats: dict = {}
         t = Timer.start()
         with self._gen_sema:
-            raw = self.model.generate_feedback_raw(
+            raw = engine.generate_feedback_raw(
                 system_prompt=system_prompt,
                 user_message=user_msg,
+                stats=stats,
             )
         latency = t.elapsed_ms()
 
@@ -151,6 +196,6 @@ class AIWorkerService:
             language_feedback=parsed,
             meta={
                 'latency_ms': latency, 'mode': 'feedback',
-                'level': level or 'auto',
+                'level': level or 'auto', 'model': model_id, **stats,
             },
         )
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import logging
+import threading
+from collections import OrderedDict
+
+from src.prefix_cache import cache_nbytes
+from src.prefix_cache import PrefixEntry
+from transformers import DynamicCache
+
+logger = logging.getLogger('ai_worker.session_cache')
+
+
+def _common_prefix_len(a: list[int], b: list[int]) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _crop(cache: DynamicCache, length: int) -> DynamicCache:
+    return DynamicCache.from_legacy_cache(
+        tuple(
+            (k[:, :, :length], v[:, :, :length])
+            for k, v in cache.to_legacy_cache()
+        ),
+    )
+
+
+class SessionCache:
+    """
+    Per-session KV cache of the already encoded conversation.
+
+    After a reply the full sequence (prompt + generated tokens) is kept, so
+    the next turn of the same session only prefills what was appended.
+    Sessions are evicted LRU once the total cached tokens exceed
+    `max_tokens`.
+    """
+
+    def __init__(self, *, max_tokens: int):
+        self.max_tokens = max(0, max_tokens)
+
+        self._entries: OrderedDict[str, PrefixEntry] = OrderedDict()
+        self._total_tokens = 0
+        self._lock = threading.Lock()
+
+    def _drop(self, key: str) -> None:
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._total_tokens -= len(old.ids)
+
+    def lookup(self, key: str, input_ids: list[int]) -> PrefixEntry | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+
+        # keep at least one token for the prefill of the new turn
+        n = min(_common_prefix_len(entry.ids, input_ids), len(input_ids) - 1)
+        if n <= 0:
+            return None
+        if n == len(entry.ids):
+            return entry
+
+        cache = _crop(entry.cache, n)
+        return PrefixEntry(ids=entry.ids[:n], cache=cache, nbytes=0)
+
+    def store(self, key: str, ids: list[int], cache: DynamicCache) -> None:
+        if len(ids) > self.max_tokens:
+            self.invalidate(key)
+            return
+
+        entry = PrefixEntry(ids=ids, cache=cache, nbytes=cache_nbytes(cache))
+        with self._lock:
+            self._drop(key)
+            while self._entries and (
+                self._total_tokens + len(ids) > self.max_tokens
+            ):
+                old_key, old = self._entries.popitem(last=False)
+                self._total_tokens -= len(old.ids)
+                logger.debug(
+                    'session cache: evicted | key=%s tokens=%s',
+                    old_key, len(old.ids),
+                )
+            self._entries[key] = entry
+            self._total_tokens += len(ids)
+            total = self._total_tokens
+            sessions = len(self._entries)
+
+        logger.debug(
+            'session cache: stored | key=%s tokens=%s '
+            'total_tokens=%s sessions=%s',
+            key, len(ids), total, sessions,
+        )
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._drop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._total_tokens = 0
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 from functools import lru_cache
+from typing import Literal
 
 from pydantic_settings import BaseSettings
 from pydantic_settings import SettingsConfigDict
@@ -14,22 +15,98 @@ class Settings(BaseSettings):
     REDIS_URL: str = 'redis://redis:6379/0'
     RQ_QUEUE_NAME: str = 'ai_worker'
     RQ_RESULT_TTL_S: int = 3600
+    # how long a queued job stays worth running, per priority queue
+    REPLY_DEADLINE_S: int = 100
+    FEEDBACK_DEADLINE_S: int = 100
+    BATCH_DEADLINE_S: int = 86400
+    # admission control: hard queue limit, run-time window and the run
+    # time assumed before any job has finished
+    ADMISSION_MAX_QUEUE_DEPTH: int = 500
+    ADMISSION_WINDOW: int = 50
+    ADMISSION_DEFAULT_SERVICE_S: float = 10.0
 
     LOG_LEVEL: str = 'INFO'
 
+    ENGINE: Literal['hf', 'int8', 'stub'] = 'hf'
     MODEL_ID: str = 'Qwen/Qwen2.5-7B-Instruct'
     DEVICE: str | None = None
     LOAD_IN_4BIT: bool = True
+    # "<kind>:<level>" -> model id, "*" matches any kind or level, e.g.
+    # {"reply:A1": "Qwen/Qwen2.5-1.5B-Instruct", "*:C1": "..."}
+    MODEL_ROUTES: dict[str, str] = {}
+    MODEL_MAX_RESIDENT: int = 2
 
     MAX_HISTORY_TURNS: int = 16
     MAX_MESSAGE_CHARS: int = 1200
     MAX_HISTORY_CHARS: int = 8000
+    MAX_HISTORY_TOKENS: int = 3072
+    TOKEN_COUNT_CACHE_SIZE: int = 50000
     MAX_CONCURRENT_GENERATIONS: int = 1
     MAX_NEW_TOKENS_REPLY: int = 1024
     MAX_NEW_TOKENS_FEEDBACK: int = 256
     TEMPERATURE_REPLY: float = 0.6
     TEMPERATURE_FEEDBACK: float = 0.2
     TOP_P: float = 0.9
+    FEEDBACK_CONSTRAINED: bool = True
+    # adaptive max_new_tokens: the MAX_NEW_TOKENS_* values (or tighter
+    # "<kind>:<level>" caps) are lowered under load to keep the time to
+    # answer under the target, but never below the floors
+    BUDGET_ENABLED: bool = True
+    BUDGET_TARGET_P95_S: float = 30.0
+    BUDGET_MIN_TOKENS_REPLY: int = 96
+    BUDGET_MIN_TOKENS_FEEDBACK: int = 192
+    BUDGET_LEVEL_MAX_NEW_TOKENS: dict[str, int] = {}
+    BUDGET_REFRESH_S: float = 5.0
+    BUDGET_RATE_WINDOW: int = 50
+    # a reply this close to its budget stops at the next sentence end
+    SENTENCE_STOP_GRACE_TOKENS: int = 48
+
+    DRAFT_MODEL_ID: str | None = None
+    DRAFT_NUM_TOKENS: int = 5
+
+    STUB_TOKEN_LATENCY_MS: int = 0
+    STUB_REPLY_WORDS: int = 40
+
+    BATCH_MAX_SIZE: int = 8
+    BATCH_WAIT_MS: int = 20
+    RUNNER_THREADS: int | None = None
+    RUNNER_PROCESSES: int = 1
+    RUNNER_CORES_PER_PROCESS: int | None = None
+    RUNNER_HEARTBEAT_S: int = 5
+    # runners load and warm up the model before taking jobs; the API
+    # turns work away (503) while no runner is ready
+    WARMUP_ENABLED: bool = True
+    WARMUP_MAX_NEW_TOKENS: int = 8
+    READINESS_REQUIRED: bool = True
+
+    PREFIX_CACHE_MAX_MB: int = 1024
+    SESSION_CACHE_MAX_TOKENS: int = 32768
+
+    STREAM_TTL_S: int = 600
+    # identical requests share one in-flight job; the claim outlives a
+    # job that never reported back by at most this long
+    COALESCE_ENABLED: bool = True
+    COALESCE_TTL_S: int = 600
+    # async jobs API: longest long-poll and most ids per status lookup
+    JOBS_MAX_WAIT_S: float = 30.0
+    JOBS_MAX_BATCH_IDS: int = 1000
+    # feedback:batch: most items per call, messages per job on the batch
+    # queue and how long the call waits for the last of them
+    FEEDBACK_BATCH_MAX_ITEMS: int = 1000
+    FEEDBACK_BATCH_JOB_SIZE: int = 32
+    FEEDBACK_BATCH_TIMEOUT_S: int = 3600
+    # generated tokens between two looks at a job's cancel flag
+    CANCEL_CHECK_TOKENS: int = 8
+
+    # rule-based feedback for trivial messages; the dictionary is a
+    # one-word-per-line file such as /usr/share/dict/words
+    PRECHECK_ENABLED: bool = True
+    PRECHECK_MIN_CONFIDENCE: float = 0.8
+    PRECHECK_MAX_WORDS: int = 3
+    PRECHECK_DICTIONARY_PATH: str | None = None
+
+    FEEDBACK_CACHE_TTL_S: int = 86400
+    FEEDBACK_CACHE_MAX_ENTRIES: int = 50000
 
 
 @lru_cache(maxsize=1)
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import logging
+
+import torch
+from src.settings import Settings
+from transformers import AutoModelForCausalLM
+from transformers import StoppingCriteria
+
+logger = logging.getLogger('ai_worker.speculative')
+
+
+class DraftModel:
+    """
+    Small model of the same family used by assisted generation to
+    propose tokens. Every forward pass proposes one token, so counting the
+    passes gives the number of proposals of a generation.
+    """
+
+    def __init__(self, model, model_id: str):
+        self.model = model
+        self.model_id = model_id
+        self.calls = 0
+        model.register_forward_hook(self._count)
+
+    def _count(self, module, args, output) -> None:
+        self.calls += 1
+
+
+class VerifyStepCounter(StoppingCriteria):
+    """
+    Never stops generation; counts the verification passes of the main
+    model. Assisted decoding calls stopping criteria twice per pass, on
+    the draft candidates and then on the verified sequence.
+    """
+
+    def __init__(self):
+        self._calls = 0
+
+    @property
+    def steps(self) -> int:
+        return self._calls // 2
+
+    def __call__(
+            self,
+            input_ids: torch.LongTensor,
+            scores: torch.FloatTensor,
+            **kwargs,
+    ) -> torch.BoolTensor:
+        self._calls += 1
+        return torch.zeros(
+            (input_ids.shape[0],), dtype=torch.bool, device=input_ids.device,
+        )
+
+
+def load_draft_model(settings: Settings, vocab_size: int) -> DraftModel | None:
+    model_id = settings.DRAFT_MODEL_ID
+    if not model_id:
+        return None
+
+    dtype = torch.bfloat16 if torch.cuda.is_available() else torch.float32
+    logger.info('draft model: loading | model_id=%s dtype=%s', model_id, dtype)
+    try:
+        model = AutoModelForCausalLM.from_pretrained(
+            model_id,
+            device_map='auto' if torch.cuda.is_available() else None,
+            torch_dtype=dtype,
+        )
+    except Exception as e:
+        logger.warning(
+            'draft model: unavailable, speculative decoding off | '
+            'model_id=%s err=%s',
+            model_id, e,
+        )
+        return None
+
+    if model.config.vocab_size < vocab_size:
+        logger.warning(
+            'draft model: vocabulary does not cover the main tokenizer, '
+            'speculative decoding off | draft_vocab=%s main_vocab=%s',
+            model.config.vocab_size, vocab_size,
+        )
+        return None
+
+    model.eval()
+    model.generation_config.num_assistant_tokens = (
+        settings.DRAFT_NUM_TOKENS
+    )
+    logger.info('draft model: loaded | model_id=%s', model_id)
+    return DraftModel(model, model_id)
+
+
+def acceptance_stats(
+        draft: DraftModel,
+        *,
+        new_tokens: int,
+        verify_steps: int,
+        proposed: int,
+) -> dict:
+    # each verification pass keeps the accepted drafts plus one token of
+    # the main model
+    accepted = max(0, new_tokens - verify_steps)
+    return {
+        'draft_model': draft.model_id,
+        'proposed': proposed,
+        'accepted': accepted,
+        'acceptance_rate': round(accepted / proposed, 3) if proposed else 0.0,
+        'verify_steps': verify_steps,
+    }
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import json
+import logging
+from collections.abc import Callable
+
+from redis import Redis
+from src.utils import stream_key
+from transformers.generation.streamers import BaseStreamer
+
+logger = logging.getLogger('ai_worker.streaming')
+
+
+class TextChunker:
+    """
+    Incremental detokenizer, same flushing rules as TextIteratorStreamer:
+    text is emitted on word boundaries and held back while the tail is an
+    incomplete multi-byte character.
+    """
+
+    def __init__(self, tokenizer, on_text: Callable[[str], None]):
+        self.tokenizer = tokenizer
+        self.on_text = on_text
+        self._tokens: list[int] = []
+        self._printed = 0
+        self._started = False
+
+    def _decode(self) -> str:
+        return self.tokenizer.decode(
+            self._tokens,
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=True,
+        )
+
+    def _emit(self, text: str) -> None:
+        if not self._started:
+            text = text.lstrip()
+            if not text:
+                return
+            self._started = True
+        if text:
+            self.on_text(text)
+
+    def put(self, token_id: int) -> None:
+        self._tokens.append(token_id)
+        text = self._decode()
+
+        if text.endswith('\n'):
+            chunk = text[self._printed:]
+            self._tokens = []
+            self._printed = 0
+        elif text.endswith('�'):
+            return
+        else:
+            cut = text.rfind(' ') + 1
+            chunk = text[self._printed:cut]
+            self._printed = max(self._printed, cut)
+        self._emit(chunk)
+
+    def end(self) -> None:
+        if self._tokens:
+            self._emit(self._decode()[self._printed:].rstrip())
+        self._tokens = []
+        self._printed = 0
+
+
+class TokenCallbackStreamer(BaseStreamer):
+    """Adapts `model.generate(streamer=...)` to a per-token callback."""
+
+    def __init__(self, on_token: Callable[[int], None]):
+        self.on_token = on_token
+        self._prompt_seen = False
+
+    def put(self, value) -> None:
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+        for tok in value.reshape(-1).tolist():
+            self.on_token(tok)
+
+    def end(self) -> None:
+        pass
+
+
+class RedisStreamWriter:
+    """Publishes reply chunks of one job into a Redis stream."""
+
+    def __init__(self, redis: Redis, job_id: str, *, ttl_s: int):
+        self.redis = redis
+        self.key = stream_key(job_id)
+        self.ttl_s = ttl_s
+
+    def _add(self, fields: dict[str, str]) -> None:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.xadd(self.key, fields)
+        pipe.expire(self.key, self.ttl_s)
+        pipe.execute()
+
+    def chunk(self, text: str) -> None:
+        self._add({'type': 'chunk', 'text': text})
+
+    def end(self, reply: str, data: dict | None = None) -> None:
+        """Last entry: the whole reply plus what the job adds (`data`)."""
+        fields = {'type': 'end', 'text': reply}
+        if data:
+            fields['data'] = json.dumps(data, ensure_ascii=False)
+        self._add(fields)
+
+    def error(self, message: str) -> None:
+        self._add({'type': 'error', 'text': message})
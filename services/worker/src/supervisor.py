@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import logging
+import multiprocessing as mp
+import os
+import signal
+import socket
+import threading
+import time
+
+import torch
+from src.logging_config import setup_logging
+from src.queue import get_redis
+from src.readiness import ReadinessBeacon
+from src.readiness import record_startup
+from src.readiness import runner_id
+from src.runner import build_workers
+from src.runner import prepare
+from src.runner import run_workers
+from src.runner import ThreadedWorker
+from src.settings import get_settings
+from src.settings import Settings
+from src.tasks import get_service
+
+logger = logging.getLogger('ai_worker.supervisor')
+
+RUNNER_HEALTH_PREFIX = 'ai_worker:runner:'
+
+
+def runner_health_key(host: str, index: int) -> str:
+    return f"{RUNNER_HEALTH_PREFIX}{host}:{index}"
+
+
+def _rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf('SC_PAGE_SIZE') / 2**20, 1)
+    except (OSError, ValueError, IndexError):
+        return -1.0
+
+
+def plan_cores(settings: Settings) -> list[list[int]]:
+    """Split the cores this process may use into one slice per child."""
+    available = sorted(os.sched_getaffinity(0))
+    n = max(1, settings.RUNNER_PROCESSES)
+    per = settings.RUNNER_CORES_PER_PROCESS or max(1, len(available) // n)
+
+    plan = []
+    for i in range(n):
+        start = (i * per) % len(available)
+        cores = available[start:start + per] or available[:per]
+        plan.append(cores)
+    return plan
+
+
+def _heartbeat_loop(
+        settings: Settings,
+        index: int,
+        cores: list[int],
+        workers: list[ThreadedWorker],
+) -> None:
+    redis = get_redis(settings)
+    key = runner_health_key(socket.gethostname(), index)
+    interval = max(1, settings.RUNNER_HEARTBEAT_S)
+
+    while True:
+        try:
+            pipe = redis.pipeline(transaction=False)
+            pipe.hset(
+                key,
+                mapping={
+                    'pid': os.getpid(),
+                    'cores': ','.join(map(str, cores)),
+                    'torch_threads': torch.get_num_threads(),
+                    'workers': len(workers),
+                    'jobs_ok': sum(w.successful_job_count for w in workers),
+                    'jobs_failed': sum(w.failed_job_count for w in workers),
+                    'jobs_expired': sum(w.expired_job_count for w in workers),
+                    'rss_mb': _rss_mb(),
+                    'ts': int(time.time()),
+                },
+            )
+            pipe.expire(key, interval * 3)
+            pipe.execute()
+        except Exception as e:
+            logger.warning('heartbeat: failed | key=%s err=%s', key, e)
+        time.sleep(interval)
+
+
+def _child_main(index: int, cores: list[int]) -> None:
+    settings = get_settings()
+
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+    logger.info(
+        'child: start | index=%s pid=%s cores=%s torch_threads=%s',
+        index, os.getpid(), cores, torch.get_num_threads(),
+    )
+
+    # cached in the parent before fork on CPU, loaded here on CUDA; the
+    # prefix caches and the warmup are built here either way, with this
+    # child's threads and cores
+    timings = prepare(settings)
+    if not torch.cuda.is_available():
+        # the parent loaded the weights and recorded how long it took
+        del timings['load']
+    redis = get_redis(settings)
+    record_startup(redis, timings)
+
+    workers = build_workers(settings)
+    threading.Thread(
+        target=_heartbeat_loop,
+        args=(settings, index, cores, workers),
+        name='runner-heartbeat',
+        daemon=True,
+    ).start()
+    run_workers(
+        workers,
+        settings,
+        ready=ReadinessBeacon(redis, settings, runner_id(index)),
+        ready_info={
+            'models': get_service().registry.model_ids(),
+            'cores': cores,
+            **{f"{phase}_s": sec for phase, sec in timings.items()},
+        },
+    )
+
+
+def _load_shared(settings: Settings) -> None:
+    """
+    Load the model once in the parent and move its weights to shared
+    memory, so forked children map the same pages instead of copying them.
+    """
+    # a single-threaded parent never spins up an OpenMP pool before fork()
+    torch.set_num_threads(1)
+
+    t0 = time.monotonic()
+    svc = get_service()
+    for engine in svc.registry.resident():
+        engine.share_memory()
+    load_s = time.monotonic() - t0
+    record_startup(get_redis(settings), {'load': round(load_s, 2)})
+    logger.info(
+        'supervisor: weights shared | load_s=%.1f rss_mb=%s',
+        load_s, _rss_mb(),
+    )
+
+
+def main() -> None:
+    settings = get_settings()
+    setup_logging(settings.LOG_LEVEL)
+
+    plan = plan_cores(settings)
+    use_cuda = torch.cuda.is_available()
+    logger.info(
+        'supervisor: start | processes=%s cores=%s cuda=%s',
+        len(plan), plan, use_cuda,
+    )
+
+    if not use_cuda:
+        _load_shared(settings)
+    else:
+        # CUDA state cannot cross fork(); every child loads its own copy
+        logger.warning('supervisor: cuda detected, weights are not shared')
+
+    ctx = mp.get_context('fork')
+    children: dict[int, mp.Process] = {}
+    stopping = False
+
+    def spawn(index: int) -> None:
+        p = ctx.Process(
+            target=_child_main,
+            args=(index, plan[index]),
+            name=f"runner-{index}",
+        )
+        p.start()
+        children[index] = p
+        logger.info(
+            'supervisor: child started | index=%s pid=%s', index, p.pid,
+        )
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        logger.info('supervisor: stop requested | signal=%s', signum)
+        for p in children.values():
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGTERM)
+
+    for i in range(len(plan)):
+        spawn(i)
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    redis = get_redis(settings)
+    interval = max(1, settings.RUNNER_HEARTBEAT_S)
+    while True:
+        if stopping and not any(p.is_alive() for p in children.values()):
+            break
+
+        for index, p in list(children.items()):
+            if not p.is_alive() and not stopping:
+                logger.warning(
+                    'supervisor: child died | index=%s pid=%s exitcode=%s',
+                    index, p.pid, p.exitcode,
+                )
+                spawn(index)
+
+        health = []
+        for index in sorted(children):
+            raw = redis.hgetall(
+                runner_health_key(socket.gethostname(), index),
+            )
+            row = {k.decode(): v.decode() for k, v in raw.items()}
+            health.append(
+                f"{index}:pid={row.get('pid', '-')},"
+                f"ok={row.get('jobs_ok', '-')},"
+                f"failed={row.get('jobs_failed', '-')},"
+                f"expired={row.get('jobs_expired', '-')},"
+                f"rss_mb={row.get('rss_mb', '-')}",
+            )
+        logger.info('supervisor: health | %s', ' '.join(health))
+
+        time.sleep(interval)
+
+    logger.info('supervisor: stopped')
+
+
+if __name__ == '__main__':
+    main()
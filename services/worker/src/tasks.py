@@ -1,15 +1,37 @@
 from __future__ import annotations
 
 import logging
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
 from functools import lru_cache
 
-from src.model import AIWorkerModel
+from rq import get_current_job
+from rq.job import Job
+from src.budget import record_decode_rate
+from src.cancel import CancelToken
+from src.cancel import GenerationCancelled
+from src.metrics import generation_samples
+from src.metrics import observe
+from src.metrics import stage
+from src.precheck import precheck_meta
+from src.precheck import record_precheck
+from src.precheck import run_precheck
 from src.prompts import get_prompt
+from src.prompts import PromptKind
+from src.registry import ModelRegistry
+from src.schemas import ChatMessage
+from src.schemas import LanguageFeedback
+from src.schemas import TurnResponse
 from src.service import AIWorkerService
 from src.settings import get_settings
+from src.streaming import RedisStreamWriter
+from src.token_budget import fit_history
 from src.utils import fallback_language_feedback
+from src.utils import make_session_key
 from src.utils import safe_parse_language_feedback
+from src.utils import Timer
 
 logger = logging.getLogger('ai_worker.tasks')
 
@@ -18,41 +40,264 @@ logger = logging.getLogger('ai_worker.tasks')
 def get_service() -> AIWorkerService:
     settings = get_settings()
     logger.info(
-        'service cache: init | model_id=%s load_in_4bit=%s',
+        'service cache: init | engine=%s model_id=%s routes=%s '
+        'load_in_4bit=%s',
+        settings.ENGINE,
         settings.MODEL_ID,
+        settings.MODEL_ROUTES,
         settings.LOAD_IN_4BIT,
     )
 
-    model = AIWorkerModel(settings)
-    model.model.eval()
+    registry = ModelRegistry(settings)
+    registry.default()
 
-    svc = AIWorkerService(model=model, settings=settings)
+    svc = AIWorkerService(registry=registry, settings=settings)
     logger.info('service cache: ready')
     return svc
 
 
-def task_reply(level: str | None, history: list[dict], message: str):
+def _queue_wait_s() -> float | None:
+    job = get_current_job()
+    if job is None or job.enqueued_at is None:
+        return None
+    enqueued = job.enqueued_at
+    if enqueued.tzinfo is None:
+        enqueued = enqueued.replace(tzinfo=timezone.utc)
+    return max(0.0, time.time() - enqueued.timestamp())
+
+
+def _ms(seconds: float | None) -> float | None:
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def _export_timings(
+        queue_wait_s: float | None,
+        generations: dict[str, dict],
+) -> None:
+    """
+    Add time-to-first-token to each generation's stats and push queue
+    wait and stage timings to the histograms behind /metrics.
+    """
+    samples = []
+    for kind, stats in generations.items():
+        stages = stats.get('stages_ms') or {}
+        if 'prefill' in stages:
+            stats['ttft_ms'] = round(
+                (queue_wait_s or 0.0) * 1000
+                + sum(
+                    stages.get(k, 0.0)
+                    for k in ('chat_template', 'tokenize', 'prefill')
+                ),
+                1,
+            )
+        samples.extend(generation_samples(kind, stats))
+
+    job = get_current_job()
+    if job is None:
+        return
+    try:
+        for stats in generations.values():
+            if 'tokens_per_s' in stats:
+                record_decode_rate(
+                    job.connection,
+                    stats['tokens_per_s'],
+                    window=get_settings().BUDGET_RATE_WINDOW,
+                )
+    except Exception as e:
+        logger.warning('budget: rate export failed | err=%s', e)
+    if queue_wait_s is not None:
+        samples.append((
+            'ai_worker_queue_wait_seconds',
+            {'queue': job.origin},
+            queue_wait_s,
+        ))
+    try:
+        observe(job.connection, samples)
+    except Exception as e:
+        logger.warning('metrics: export failed | err=%s', e)
+
+
+def _cancel_token(svc: AIWorkerService) -> CancelToken | None:
+    job = get_current_job()
+    if job is None:
+        return None
+    return CancelToken(
+        job.connection,
+        job.id,
+        check_every=svc.settings.CANCEL_CHECK_TOKENS,
+    )
+
+
+def _precheck(
+        svc: AIWorkerService,
+        message: str,
+        stats: dict,
+        job: Job | None = None,
+) -> LanguageFeedback | None:
+    """
+    Rule-based feedback if the message is too trivial for the model.
+    `job` defaults to the current one (pass it from pool threads).
+    """
+    result = run_precheck(message, svc.settings)
+    job = job or get_current_job()
+    if job is not None and svc.settings.PRECHECK_ENABLED:
+        record_precheck(job.connection, result.reason if result else 'model')
+    if result is None:
+        return None
+    stats.update(precheck_meta(result))
+    logger.info(
+        'feedback: precheck hit | reason=%s confidence=%.2f items=%s',
+        result.reason,
+        result.confidence,
+        len(result.feedback.items),
+    )
+    return result.feedback
+
+
+def _budget(
+        svc: AIWorkerService,
+        kind: PromptKind,
+        level: str | None,
+) -> int | None:
+    """Load-adjusted max_new_tokens; None (the settings) outside a job."""
+    job = get_current_job()
+    if job is None:
+        return None
+    return svc.budget.max_new_tokens(job.connection, kind, level)
+
+
+def _reply_text(
+        svc: AIWorkerService,
+        level: str | None,
+        history: list[dict],
+        message: str,
+        session_key: str | None,
+        on_text=None,
+        cancel: CancelToken | None = None,
+        stats: dict | None = None,
+        max_new_tokens: int | None = None,
+) -> str:
+    system_prompt = get_prompt(level, kind='reply')
+    model_id, engine = svc.engine_for('reply', level)
+    if stats is not None:
+        stats['model'] = model_id
+        if max_new_tokens is not None:
+            stats['max_new_tokens'] = max_new_tokens
+
+    hist = [ChatMessage.model_validate(m) for m in history]
+    kept = fit_history(hist, svc.settings, engine.token_counter)
+    if len(kept) < len(hist):
+        # the conversation start moved, the cached prefix is useless now
+        engine.forget_session(session_key)
+
+    return engine.generate_reply(
+        system_prompt=system_prompt,
+        history=svc._history_to_dicts(kept),
+        user_message=message,
+        session_key=session_key,
+        on_text=on_text,
+        cancel=cancel,
+        stats=stats,
+        max_new_tokens=max_new_tokens,
+    )
+
+
+def _language_feedback(
+        svc: AIWorkerService,
+        level: str | None,
+        message: str,
+        cancel: CancelToken | None = None,
+        stats: dict | None = None,
+        max_new_tokens: int | None = None,
+) -> tuple[LanguageFeedback, bool]:
+    """Parsed feedback and whether the formatting fallback was used."""
+    system_prompt = get_prompt(level, kind='feedback')
+    model_id, engine = svc.engine_for('feedback', level)
+    if stats is not None:
+        stats['model'] = model_id
+        if max_new_tokens is not None:
+            stats['max_new_tokens'] = max_new_tokens
+
+    raw = engine.generate_feedback_raw(
+        system_prompt=system_prompt,
+        user_message=message,
+        cancel=cancel,
+        stats=stats,
+        max_new_tokens=max_new_tokens,
+    )
+
+    raw_preview = (raw or '')[:300].replace('\n', '\\n')
+    logger.info('feedback: model_output_preview | preview=%s', raw_preview)
+
+    with stage(stats, 'json_parse'):
+        parsed = safe_parse_language_feedback(raw)
+
+    if parsed is None:
+        logger.warning('feedback: parse failed -> fallback used')
+        return fallback_language_feedback(
+            'Feedback temporarily unavailable (formatting error).',
+        ), True
+
+    logger.info('feedback: parsed ok | items=%s', len(parsed.items))
+    return parsed, False
+
+
+def task_reply(
+        level: str | None,
+        history: list[dict],
+        message: str,
+        user_id: str | None = None,
+        session_id: str | None = None,
+        stream: bool = False,
+):
     logger.info(
-        'task_reply: start | level=%s hist_turns=%s msg_len=%s',
+        'task_reply: start | level=%s hist_turns=%s msg_len=%s stream=%s',
         level,
         len(history),
         len(message or ''),
+        stream,
     )
+    writer: RedisStreamWriter | None = None
+    queue_wait_s = _queue_wait_s()
     try:
         svc = get_service()
-        system_prompt = get_prompt(level, kind='reply')
+        if stream:
+            job = get_current_job()
+            writer = RedisStreamWriter(
+                job.connection, job.id, ttl_s=svc.settings.STREAM_TTL_S,
+            )
 
-        reply_text = svc.model.generate_reply(
-            system_prompt=system_prompt,
-            history=history,
-            user_message=message,
+        stats: dict = {}
+        reply_text = _reply_text(
+            svc,
+            level,
+            history,
+            message,
+            make_session_key(user_id, session_id),
+            on_text=writer.chunk if writer else None,
+            cancel=_cancel_token(svc),
+            stats=stats,
+            max_new_tokens=_budget(svc, 'reply', level),
         )
+        if writer is not None:
+            writer.end(reply_text)
+        _export_timings(queue_wait_s, {'reply': stats})
 
         logger.info('task_reply: ok | reply_len=%s', len(reply_text or ''))
-        return {'reply': reply_text}
+        return {
+            'reply': reply_text,
+            'meta': {'queue_wait_ms': _ms(queue_wait_s), **stats},
+        }
 
+    except GenerationCancelled as e:
+        logger.info('task_reply: cancelled | err=%s', e)
+        if writer is not None:
+            writer.error('cancelled')
+        return {'error': 'cancelled'}
     except Exception as e:
         logger.exception('task_reply: error | err=%s', e)
+        if writer is not None:
+            writer.error(str(e))
         tb = traceback.format_exc()
         return {'error': str(e), 'traceback': tb}
 
@@ -63,36 +308,216 @@ def task_feedback(level: str | None, message: str):
         level,
         len(message or ''),
     )
+    queue_wait_s = _queue_wait_s()
     try:
         svc = get_service()
-        system_prompt = get_prompt(level, kind='feedback')
+        stats: dict = {}
+        parsed, used_fallback = _precheck(svc, message, stats), False
+        if parsed is None:
+            parsed, used_fallback = _language_feedback(
+                svc, level, message, cancel=_cancel_token(svc), stats=stats,
+                max_new_tokens=_budget(svc, 'feedback', level),
+            )
+        _export_timings(queue_wait_s, {'feedback': stats})
+        return {
+            'language_feedback': parsed.model_dump(),
+            'meta': {
+                'fallback': used_fallback,
+                'queue_wait_ms': _ms(queue_wait_s),
+                **stats,
+            },
+        }
+
+    except GenerationCancelled as e:
+        logger.info('task_feedback: cancelled | err=%s', e)
+        return {'error': 'cancelled'}
+    except Exception as e:
+        logger.exception('task_feedback: error | err=%s', e)
+        tb = traceback.format_exc()
+        return {'error': str(e), 'traceback': tb}
+
 
-        raw = svc.model.generate_feedback_raw(
-            system_prompt=system_prompt,
-            user_message=message,
+def task_feedback_batch(items: list[dict]):
+    """
+    Feedback for many messages ({'level', 'message'} items) in one job.
+
+    With the batching scheduler up to BATCH_MAX_SIZE generations are
+    submitted at once and decode in shared forward passes. A failed item
+    gets an 'error' entry; the others are not affected.
+    """
+    logger.info('task_feedback_batch: start | items=%s', len(items))
+    queue_wait_s = _queue_wait_s()
+    try:
+        svc = get_service()
+        cancel = _cancel_token(svc)
+        job = get_current_job()
+        levels = {item.get('level') for item in items}
+        budgets = {lvl: _budget(svc, 'feedback', lvl) for lvl in levels}
+        concurrent = all(
+            svc.engine_for('feedback', lvl)[1].concurrent for lvl in levels
         )
 
-        raw_preview = (raw or '')[:300].replace('\n', '\\n')
+        def one(item: dict) -> dict:
+            stats: dict = {}
+            try:
+                parsed = _precheck(svc, item['message'], stats, job)
+                used_fallback = False
+                if parsed is None:
+                    parsed, used_fallback = _language_feedback(
+                        svc, item.get('level'), item['message'], cancel,
+                        stats, budgets[item.get('level')],
+                    )
+            except GenerationCancelled:
+                raise
+            except Exception as e:
+                logger.exception('task_feedback_batch: item error | err=%s', e)
+                return {'error': str(e)}
+            return {
+                'language_feedback': parsed.model_dump(),
+                'meta': {'fallback': used_fallback, **stats},
+            }
+
+        t = Timer.start()
+        workers = svc.settings.BATCH_MAX_SIZE if concurrent else 1
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            results = list(pool.map(one, items))
+        # the histograms are written from the job's own thread
+        for result in results:
+            if 'meta' in result:
+                _export_timings(None, {'feedback': result['meta']})
+        _export_timings(queue_wait_s, {})
+
         logger.info(
-            'task_feedback: model_output_preview | preview=%s', raw_preview,
+            'task_feedback_batch: ok | items=%s errors=%s latency_ms=%s',
+            len(items),
+            sum('error' in r for r in results),
+            t.elapsed_ms(),
         )
+        return {
+            'results': results,
+            'meta': {
+                'latency_ms': t.elapsed_ms(),
+                'queue_wait_ms': _ms(queue_wait_s),
+            },
+        }
 
-        parsed = safe_parse_language_feedback(raw)
+    except GenerationCancelled as e:
+        logger.info('task_feedback_batch: cancelled | err=%s', e)
+        return {'error': 'cancelled'}
+    except Exception as e:
+        logger.exception('task_feedback_batch: error | err=%s', e)
+        tb = traceback.format_exc()
+        return {'error': str(e), 'traceback': tb}
 
-        if parsed is None:
-            logger.warning('task_feedback: parse failed -> fallback used')
-            parsed = fallback_language_feedback(
-                'Feedback temporarily unavailable (formatting error).',
+
+def task_turn(
+        level: str | None,
+        history: list[dict],
+        message: str,
+        user_id: str | None = None,
+        session_id: str | None = None,
+        stream: bool = False,
+):
+    """
+    Reply and feedback for one user message in a single job.
+
+    With the batching scheduler both prompts are submitted at once and
+    decode in the same forward passes; otherwise they run back to back.
+    With `stream` the reply is also written to the job's Redis stream,
+    and its end entry carries the feedback.
+    """
+    logger.info(
+        'task_turn: start | level=%s hist_turns=%s msg_len=%s stream=%s',
+        level,
+        len(history),
+        len(message or ''),
+        stream,
+    )
+    writer: RedisStreamWriter | None = None
+    queue_wait_s = _queue_wait_s()
+    try:
+        svc = get_service()
+        if stream:
+            job = get_current_job()
+            writer = RedisStreamWriter(
+                job.connection, job.id, ttl_s=svc.settings.STREAM_TTL_S,
+            )
+        on_text = writer.chunk if writer else None
+        session_key = make_session_key(user_id, session_id)
+        cancel = _cancel_token(svc)
+        reply_budget = _budget(svc, 'reply', level)
+        stats: dict = {}
+        fb_stats: dict = {}
+        t = Timer.start()
+
+        parsed = _precheck(svc, message, fb_stats)
+        used_fallback = False
+        _, reply_engine = svc.engine_for('reply', level)
+        if parsed is not None:
+            reply_text = _reply_text(
+                svc, level, history, message, session_key, on_text,
+                cancel=cancel, stats=stats, max_new_tokens=reply_budget,
             )
+        # two different models never share a generate call
+        elif (
+                reply_engine.concurrent
+                or reply_engine is not svc.engine_for('feedback', level)[1]
+        ):
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                feedback = pool.submit(
+                    _language_feedback, svc, level, message, cancel, fb_stats,
+                    _budget(svc, 'feedback', level),
+                )
+                reply_text = _reply_text(
+                    svc, level, history, message, session_key, on_text,
+                    cancel=cancel, stats=stats, max_new_tokens=reply_budget,
+                )
+                parsed, used_fallback = feedback.result()
         else:
-            logger.info(
-                'task_feedback: parsed ok | items=%s',
-                len(parsed.items),
+            reply_text = _reply_text(
+                svc, level, history, message, session_key, on_text,
+                cancel=cancel, stats=stats, max_new_tokens=reply_budget,
             )
+            parsed, used_fallback = _language_feedback(
+                svc, level, message, cancel, fb_stats,
+                _budget(svc, 'feedback', level),
+            )
+        latency = t.elapsed_ms()
+        result = TurnResponse(
+            reply=reply_text,
+            language_feedback=parsed,
+            meta={
+                'latency_ms': latency, 'mode': 'turn',
+                'level': level or 'auto', 'fallback': used_fallback,
+                'queue_wait_ms': _ms(queue_wait_s),
+                'reply': stats, 'feedback': fb_stats,
+            },
+        ).model_dump()
+        if writer is not None:
+            # the feedback rides on the end entry, so a streaming client
+            # gets the whole turn without a second job
+            writer.end(reply_text, {
+                'language_feedback': result['language_feedback'],
+                'meta': result['meta'],
+            })
+        _export_timings(queue_wait_s, {'reply': stats, 'feedback': fb_stats})
 
-        return {'language_feedback': parsed.model_dump()}
+        logger.info(
+            'task_turn: ok | reply_len=%s items=%s latency_ms=%s',
+            len(reply_text or ''),
+            len(parsed.items),
+            latency,
+        )
+        return result
 
+    except GenerationCancelled as e:
+        logger.info('task_turn: cancelled | err=%s', e)
+        if writer is not None:
+            writer.error('cancelled')
+        return {'error': 'cancelled'}
     except Exception as e:
-        logger.exception('task_feedback: error | err=%s', e)
+        logger.exception('task_turn: error | err=%s', e)
+        if writer is not None:
+            writer.error(str(e))
         tb = traceback.format_exc()
         return {'error': str(e), 'traceback': tb}
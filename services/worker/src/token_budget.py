@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from src.schemas import ChatMessage
+from src.settings import get_settings
+from src.settings import Settings
+from src.utils import clamp_history
+from src.utils import clamp_history_by_chars
+from src.utils import clamp_history_by_tokens
+from transformers import AutoTokenizer
+
+logger = logging.getLogger('ai_worker.token_budget')
+
+
+class TokenCounter:
+    """
+    Tokenized length of chat messages, including the chat template
+    wrapper around each of them.
+
+    Counts are cached by a hash of (role, content), so a conversation that
+    grows by one turn only tokenizes the new messages.
+    """
+
+    def __init__(self, tokenizer, *, max_entries: int):
+        self.tokenizer = tokenizer
+        self.max_entries = max(0, max_entries)
+
+        self._counts: OrderedDict[str, int] = OrderedDict()
+        self._overhead: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _template_len(self, messages: list[dict[str, str]]) -> int:
+        text = self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=False,
+        )
+        return len(self.tokenizer(text, add_special_tokens=False)['input_ids'])
+
+    def _role_overhead(self, role: str) -> int:
+        n = self._overhead.get(role)
+        if n is None:
+            # measured after a system message, so templates that inject a
+            # default one do not count it against the history
+            system = {'role': 'system', 'content': ''}
+            n = self._template_len(
+                [system, {'role': role, 'content': ''}],
+            ) - self._template_len([system])
+            self._overhead[role] = n
+        return n
+
+    @staticmethod
+    def _key(msg: ChatMessage) -> str:
+        raw = f"{msg.role}\0{msg.content}".encode()
+        return hashlib.sha1(raw).hexdigest()
+
+    def count(self, msg: ChatMessage) -> int:
+        key = self._key(msg)
+        with self._lock:
+            n = self._counts.get(key)
+            if n is not None:
+                self._counts.move_to_end(key)
+                return n
+
+        n = self._role_overhead(msg.role) + len(
+            self.tokenizer(msg.content, add_special_tokens=False)['input_ids'],
+        )
+        with self._lock:
+            self._counts[key] = n
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return n
+
+    def counts(self, history: list[ChatMessage]) -> list[int]:
+        return [self.count(m) for m in history]
+
+
+class WordCounter:
+    """Whitespace word count, for engines that have no tokenizer."""
+
+    # rough size of the chat template wrapper around a message
+    overhead = 4
+
+    def count(self, msg: ChatMessage) -> int:
+        return self.overhead + len(msg.content.split())
+
+    def counts(self, history: list[ChatMessage]) -> list[int]:
+        return [self.count(m) for m in history]
+
+
+@lru_cache(maxsize=1)
+def get_token_counter() -> TokenCounter | WordCounter:
+    """Tokenizer-only counter for processes that do not load the model."""
+    settings = get_settings()
+    if settings.ENGINE == 'stub':
+        return WordCounter()
+    tokenizer = AutoTokenizer.from_pretrained(settings.MODEL_ID, use_fast=True)
+    logger.info('token counter: ready | model_id=%s', settings.MODEL_ID)
+    return TokenCounter(
+        tokenizer, max_entries=settings.TOKEN_COUNT_CACHE_SIZE,
+    )
+
+
+def fit_history(
+        history: list[ChatMessage],
+        settings: Settings,
+        counter: TokenCounter | WordCounter,
+) -> list[ChatMessage]:
+    """
+    Newest part of `history` that goes into the prompt: turn and char
+    limits first as cheap caps, then the token budget.
+    """
+    kept = clamp_history(history, max_turns=settings.MAX_HISTORY_TURNS)
+    kept = clamp_history_by_chars(
+        kept, max_total_chars=settings.MAX_HISTORY_CHARS,
+    )
+    return clamp_history_by_tokens(
+        kept,
+        max_total_tokens=settings.MAX_HISTORY_TOKENS,
+        counts=counter.counts(kept),
+    )
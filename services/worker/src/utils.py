@@ -4,16 +4,29 @@ import asyncio
 import json
 import logging
 import time
+from collections.abc import Awaitable
+from collections.abc import Callable
 from dataclasses import dataclass
 from typing import Any
 
+import anyio
 from pydantic import ValidationError
-from rq.job import Job
+from redis.asyncio import Redis as AsyncRedis
+from src.cancel import request_cancel
+from src.coalesce import leave_job
+from src.notify import JobNotifier
 from src.schemas import ChatMessage
 from src.schemas import LanguageFeedback
 
 log = logging.getLogger('ai_worker.utils')
 
+STREAM_KEY_PREFIX = 'ai_worker:stream:'
+DISCONNECT_POLL_S = 1.0
+
+
+class ClientDisconnected(Exception):
+    pass
+
 
 def trim_text(text: str, max_chars: int) -> str:
     if max_chars <= 0:
@@ -42,6 +55,25 @@ def clamp_history_by_chars(
     return list(reversed(kept))
 
 
+def clamp_history_by_tokens(
+        history: list[ChatMessage],
+        max_total_tokens: int,
+        counts: list[int],
+) -> list[ChatMessage]:
+    """Keep the newest messages whose token `counts` fit the budget."""
+    if max_total_tokens <= 0:
+        return []
+    total = 0
+    kept = 0
+
+    for n in reversed(counts):
+        if total + n > max_total_tokens:
+            break
+        total += n
+        kept += 1
+    return history[len(history) - kept:]
+
+
 @dataclass
 class Timer:
     start_ms: int
@@ -65,6 +97,15 @@ def clamp_history(
     return history[-max_turns:]
 
 
+def make_session_key(
+        user_id: str | None,
+        session_id: str | None,
+) -> str | None:
+    if not user_id:
+        return None
+    return f"{user_id}:{session_id or ''}"
+
+
 def extract_json_object(text: str) -> dict[str, Any]:
     if not text:
         raise ValueError('Empty text')
@@ -119,32 +160,152 @@ def fallback_language_feedback(
     )
 
 
+def stream_key(job_id: str) -> str:
+    return f"{STREAM_KEY_PREFIX}{job_id}"
+
+
+def sse_event(event: str, data: dict[str, Any]) -> str:
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
 async def wait_job_result(
-        job: Job,
+        notifier: JobNotifier,
+        job_id: str,
         *,
         timeout_s: int = 120,
-        poll_s: float = 0.2,
 ):
-    deadline = time.monotonic() + timeout_s
+    log.info('rq wait: start | job_id=%s timeout_s=%s', job_id, timeout_s)
 
-    log.info(
-        'rq wait: start | job_id=%s timeout_s=%s poll_s=%s',
-        job.id, timeout_s, poll_s,
-    )
+    try:
+        payload = await notifier.wait(job_id, timeout_s=timeout_s)
+    except TimeoutError:
+        log.warning('rq wait: timeout | job_id=%s', job_id)
+        raise TimeoutError('job timeout')
+
+    if payload.get('status') == 'expired':
+        log.warning('rq wait: expired in queue | job_id=%s', job_id)
+        raise TimeoutError('job deadline passed before it started')
 
-    while time.monotonic() < deadline:
-        job.refresh()
-        status = job.get_status()
+    if payload.get('status') == 'canceled':
+        # the same answer a job cancelled while running gives
+        log.info('rq wait: cancelled before start | job_id=%s', job_id)
+        return {'error': 'cancelled'}
 
-        if status == 'finished':
-            log.info('rq wait: finished | job_id=%s', job.id)
-            return job.result
+    if payload.get('status') == 'failed':
+        log.error('rq wait: failed | job_id=%s', job_id)
+        raise RuntimeError((payload.get('error') or 'job failed')[-2000:])
 
-        if status == 'failed':
-            log.error('rq wait: failed | job_id=%s', job.id)
-            raise RuntimeError((job.exc_info or 'job failed')[-2000:])
+    log.info('rq wait: finished | job_id=%s', job_id)
+    return payload.get('result')
 
-        await asyncio.sleep(poll_s)
 
-    log.warning('rq wait: timeout | job_id=%s', job.id)
-    raise TimeoutError('job timeout')
+async def wait_job_or_cancel(
+        notifier: JobNotifier,
+        job_id: str,
+        *,
+        is_disconnected,
+        timeout_s: int = 120,
+        cancel_ttl_s: int = 3600,
+):
+    """
+    `wait_job_result` that also watches the HTTP client: on timeout or
+    disconnect the job gets a cancel flag, so the runner stops generating
+    an answer nobody will read.
+    """
+    waiter = asyncio.ensure_future(
+        wait_job_result(notifier, job_id, timeout_s=timeout_s),
+    )
+    try:
+        while not waiter.done():
+            await asyncio.wait({waiter}, timeout=DISCONNECT_POLL_S)
+            if not waiter.done() and await is_disconnected():
+                log.warning('rq wait: client disconnected | job_id=%s', job_id)
+                raise ClientDisconnected('client disconnected')
+        return waiter.result()
+    except (TimeoutError, ClientDisconnected) as e:
+        # a coalesced job keeps running while others still wait for it
+        if await leave_job(notifier.redis, job_id) <= 0:
+            await request_cancel(
+                notifier.redis,
+                job_id,
+                reason=type(e).__name__,
+                ttl_s=cancel_ttl_s,
+            )
+        raise
+    finally:
+        waiter.cancel()
+
+
+async def iter_job_stream(
+        redis: AsyncRedis,
+        job_id: str,
+        *,
+        timeout_s: int = 120,
+        block_ms: int = 1000,
+        cancel_ttl_s: int = 3600,
+        done_extra: dict | None = None,
+        on_done: Callable[[dict], Awaitable[None]] | None = None,
+):
+    """
+    Relay the Redis stream of a streaming job as SSE events. A relay that
+    ends early (timeout, client gone) cancels the job.
+
+    The `done` event carries the reply, what the job attached to its end
+    entry and `done_extra`; `on_done` sees that payload before it is sent.
+    """
+    key = stream_key(job_id)
+    last_id = '0-0'
+    deadline = time.monotonic() + timeout_s
+    finished = False
+
+    log.info('stream relay: start | job_id=%s timeout_s=%s', job_id, timeout_s)
+
+    try:
+        while time.monotonic() < deadline:
+            resp = await redis.xread(
+                {key: last_id}, count=100, block=block_ms,
+            )
+            for _, entries in resp or []:
+                for entry_id, fields in entries:
+                    last_id = entry_id
+                    typ = fields.get(b'type', b'').decode()
+                    text = fields.get(b'text', b'').decode()
+
+                    if typ == 'chunk':
+                        yield sse_event('chunk', {'text': text})
+                    elif typ == 'end':
+                        finished = True
+                        log.info('stream relay: done | job_id=%s', job_id)
+                        done = {
+                            'reply': text,
+                            **json.loads(fields.get(b'data', b'{}')),
+                            **(done_extra or {}),
+                        }
+                        if on_done is not None:
+                            await on_done(done)
+                        yield sse_event('done', done)
+                        return
+                    else:
+                        finished = True
+                        log.error(
+                            'stream relay: job error | job_id=%s err=%s',
+                            job_id, text,
+                        )
+                        yield sse_event('error', {'detail': text})
+                        return
+
+        log.warning('stream relay: timeout | job_id=%s', job_id)
+        yield sse_event('error', {'detail': 'job timeout'})
+    finally:
+        if not finished:
+            # a client disconnect cancels the response's scope, so every
+            # unshielded await here would raise before the job is stopped
+            with anyio.CancelScope(shield=True):
+                if await leave_job(redis, job_id) <= 0:
+                    await request_cancel(
+                        redis,
+                        job_id,
+                        reason='stream closed',
+                        ttl_s=cancel_ttl_s,
+                    )
@@ -0,0 +1,195 @@
+import json
+import string
+
+import pytest
+import torch
+from src.constrained import close_len
+from src.constrained import compile_schema
+from src.constrained import JsonConstraint
+from src.constrained import MAX_STRING_CHARS
+from src.constrained import TokenVocabulary
+from src.schemas import FeedbackEnvelope
+
+ROOT = compile_schema(FeedbackEnvelope.model_json_schema())
+EOS = 0
+
+DOC = (
+    '{"language_feedback":{"items":[{"user_text":"I goed",'
+    '"error_type":"grammar","explanation":"past of go",'
+    '"text_corrected":"I went"}],"overall_comment":"Almost!"}}'
+)
+
+
+def make_vocab(*pieces: str | bytes) -> TokenVocabulary:
+    """EOS, every printable ASCII char, then `pieces` (bytes: partial)."""
+    texts: list[str | None] = [None]
+    texts += [c for c in string.printable if c not in '\x0b\x0c']
+    partial = {}
+    for piece in pieces:
+        if isinstance(piece, bytes):
+            partial[len(texts)] = piece
+            texts.append(None)
+        else:
+            texts.append(piece)
+    return TokenVocabulary(texts, partial)
+
+
+def ids_of(vocab: TokenVocabulary, *pieces: str | bytes) -> list[int]:
+    ids = []
+    for piece in pieces:
+        if isinstance(piece, bytes):
+            ids.append(next(
+                i for i, raw in vocab.partial.items() if raw == piece
+            ))
+        else:
+            ids.append(vocab.texts.index(piece))
+    return ids
+
+
+def feed(pieces, *, vocab=None, max_new_tokens=None):
+    """The constraint after `pieces`, or None once one is rejected."""
+    vocab = vocab or make_vocab(*pieces)
+    constraint = JsonConstraint(
+        ROOT, vocab, eos_token_ids={EOS}, max_new_tokens=max_new_tokens,
+    )
+    for tok in ids_of(vocab, *pieces):
+        if constraint._feed(constraint._state, tok) is None:
+            return None
+        constraint.advance(tok)
+    return constraint
+
+
+def test_accepts_a_full_document():
+    constraint = feed([DOC])
+    assert constraint is not None and constraint.done
+
+
+def test_accepts_a_document_char_by_char():
+    constraint = feed(list(DOC))
+    assert constraint is not None and constraint.done
+
+
+@pytest.mark.parametrize(
+    'prefix',
+    [
+        '[',
+        '{"language_feedbak"',
+        '{"language_feedback":{"items":{',
+        '{"language_feedback":{"items":[{"user_text":1',
+        '{"language_feedback":{"items":[{"user_text":"a","error_type":"x',
+        '{"language_feedback":{"items":[{"user_text":"a\nb',
+        '{"language_feedback":{"items":[{"user_text":"\\q',
+        '{"language_feedback":{"items":[],"overall_comment":"a"}},',
+    ],
+)
+def test_rejects_invalid_prefixes(prefix):
+    assert feed([prefix]) is None
+
+
+@pytest.mark.parametrize(
+    ('prefix', 'shortest_rest'),
+    [
+        ('', '{"language_feedback":{"items":[],"overall_comment":""}}'),
+        ('{"language_feedback":{"items":[', '],"overall_comment":""}}'),
+        (
+            '{"language_feedback":{"items":[{"user_text":"ab',
+            '","error_type":"style","explanation":"","text_corrected":""}]'
+            ',"overall_comment":""}}',
+        ),
+        (
+            '{"language_feedback":{"items":[],"overall_comment":"a\\u00',
+            '00"}}',
+        ),
+    ],
+)
+def test_close_len_is_the_shortest_completion(prefix, shortest_rest):
+    constraint = feed(list(prefix))
+    assert close_len(constraint._state[0]) == len(shortest_rest)
+    rest = feed(list(prefix + shortest_rest))
+    assert rest is not None and rest.done
+
+
+@pytest.mark.parametrize('budget', [60, 61, 75, 120])
+def test_budget_forces_the_close(budget):
+    # the logits love string content, so only the budget ends the strings
+    vocab = make_vocab()
+    constraint = JsonConstraint(
+        ROOT, vocab, eos_token_ids={EOS}, max_new_tokens=budget,
+    )
+    logits = torch.zeros(len(vocab.texts))
+    logits[vocab.texts.index('a')] = 10.0
+    logits[vocab.texts.index('[')] = 9.0
+    logits[vocab.texts.index('{')] = 8.0
+    out = []
+    for _ in range(budget):
+        tok = int(constraint.mask(logits.clone()).argmax())
+        if tok == EOS:
+            break
+        out.append(vocab.texts[tok])
+        constraint.advance(tok)
+    assert constraint.done
+    assert len(out) <= budget
+    FeedbackEnvelope.model_validate(json.loads(''.join(out)))
+
+
+def test_one_whitespace_token_per_gap():
+    head = '{"language_feedback":{'
+    assert feed([head, '\n  ', '"items"']) is not None
+    assert feed([head, '\n', ' ', '"items"']) is None
+
+
+def test_no_whitespace_at_the_top_level():
+    assert feed([' ', '{']) is None
+    assert feed(['{', ' ']) is None
+    assert feed(['{"language_feedback":', ' ']) is None
+
+
+def test_whitespace_inside_strings_is_text():
+    doc = '{"language_feedback":{"items":[],"overall_comment":"a   b"}}'
+    assert feed([doc]).done
+
+
+def test_partial_utf8_tokens_build_a_char():
+    # 'П' is d0 9f, '😀' is f0 9f 98 80
+    head = '{"language_feedback":{"items":[],"overall_comment":"'
+    vocab = make_vocab(head, b'\xd0', b'\x9f', b'\xf0\x9f', b'\x98\x80')
+    pieces = [head, b'\xd0', b'\x9f', b'\xf0\x9f', b'\x98\x80', '"', '}', '}']
+    assert feed(pieces, vocab=vocab).done
+
+
+def test_partial_utf8_is_counted_by_close_len():
+    head = '{"language_feedback":{"items":[],"overall_comment":"'
+    vocab = make_vocab(head, b'\xf0\x9f')
+    constraint = feed([head, b'\xf0\x9f'], vocab=vocab)
+    assert close_len(constraint._state[0]) == len('\x98\x80"}}')
+
+
+@pytest.mark.parametrize(
+    'pieces',
+    [
+        # a string already at MAX_STRING_CHARS
+        ['{"language_feedback":{"items":[],"overall_comment":"'
+         + 'a' * MAX_STRING_CHARS, b'\xd0'],
+        # outside a string
+        ['{"language_feedback":', b'\xd0'],
+        # a whole char in the middle of a multi-byte one
+        ['{"language_feedback":{"items":[],"overall_comment":"', b'\xd0', 'a'],
+        # not a continuation byte
+        ['{"language_feedback":{"items":[],"overall_comment":"', b'\xd0\xd0'],
+        # enums are ASCII
+        ['{"language_feedback":{"items":[{"user_text":"","error_type":"',
+         b'\xd0'],
+    ],
+)
+def test_rejects_misplaced_partial_utf8(pieces):
+    vocab = make_vocab(*pieces)
+    assert feed(pieces, vocab=vocab) is None
+
+
+def test_closing_index_holds_single_chars_and_structure():
+    vocab = make_vocab('"}', '],', 'word', ' the', b'\x9f', b'\xf0\x9f')
+    closing = {
+        vocab.texts[i] or vocab.partial[i] for i in vocab.closing_ids.tolist()
+    }
+    assert {'"}', '],', '"', 'a', ' ', b'\x9f'} <= closing
+    assert not {'word', ' the', b'\xf0\x9f'} & closing